@@ -1,13 +1,112 @@
 # Copyright (c) 2020. All rights reserved.
 
 from abc import ABCMeta, abstractmethod
-import aiofiles  # type: ignore
+import asyncio
+import hashlib
+import itertools
 import json
 import os
-from typing import AsyncIterator, Dict, Mapping, Tuple
+import time
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterator,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    MutableMapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple
+)
 import uuid
 
-from addrservice.datamodel import AddressEntry
+from addrservice.database.file_io import (
+    FILE_IO_POOL_SIZE,
+    FILE_IO_THREADS,
+    FILE_SCAN_CONCURRENCY,
+    FileIO,
+    make_file_io,
+    read_file,
+    replace_file
+)
+from addrservice.database.fs_layout import (
+    WAL_FILE_NAME,
+    entry_dirs,
+    open_layout,
+    shard_of,
+    sync_dir
+)
+from addrservice.database.indexes import (
+    SecondaryIndex,
+    SortedKeyIndex,
+    entry_search_words,
+    search_score,
+    search_words,
+    top_scored
+)
+from addrservice.database.locks import KeyLocks
+from addrservice.database.records import OP_DELETE, OP_PUT
+from addrservice.database.snapshot_file import SnapshotWriter, read_snapshot
+from addrservice.database.snapshots import ScanSnapshots
+from addrservice.database.wal import (
+    DURABILITY_BATCH,
+    DURABILITY_MODES,
+    DURABILITY_NONE,
+    WriteAheadLog
+)
+from addrservice.datamodel import AddressEntry, LazyAddressEntry
+
+SCAN_PAGE_SIZE = 1000
+
+# Entries that the in-memory DB writes to a snapshot file per step, between
+# which other tasks run
+SNAPSHOT_BATCH = 1000
+
+# Once the write-ahead log of the filesystem DB is this big, the files it
+# covers are fsynced and it is emptied.
+WAL_CHECKPOINT_BYTES = 16 * 1024 * 1024
+
+# A listing of the filesystem DB made within this long of the last change of
+# the store directory is not trusted: other processes may write within the
+# same filesystem timestamp tick without changing its mtime.
+DIR_LISTING_RACY_NS = 1000 * 1000 * 1000
+
+WRITE_CREATE = 'create'
+WRITE_UPDATE = 'update'
+WRITE_DELETE = 'delete'
+
+
+class AddressWrite(NamedTuple):
+    op: str  # WRITE_CREATE, WRITE_UPDATE or WRITE_DELETE
+    nickname: str
+    addr: Optional[AddressEntry] = None
+
+
+class VersionMismatchError(Exception):
+    pass
+
+
+def check_version(
+    nickname: str,
+    version: str,
+    if_match: Optional[Sequence[str]]
+) -> None:
+    # Optimistic concurrency: with if_match, the current version of the
+    # entry must be one of those
+    if if_match is not None and version not in if_match:
+        raise VersionMismatchError('{} has been modified'.format(nickname))
+
+
+def encode_entry(addr: AddressEntry) -> bytes:
+    # The API JSON of an entry. Engines that store it as is return it from
+    # the raw reads without decoding it, and so do lazy entries made from it.
+    if isinstance(addr, LazyAddressEntry):
+        return addr.to_json()
+    return json.dumps(addr.to_api_dm()).encode('utf-8')
 
 
 class AbstractAddressBookDB(metaclass=ABCMeta):
@@ -32,21 +131,428 @@ class AbstractAddressBookDB(metaclass=ABCMeta):
         raise NotImplementedError()
 
     @abstractmethod
-    async def update_address(self, nickname: str, addr: AddressEntry) -> None:
+    async def read_address_version(self, nickname: str) -> str:
+        # Changes whenever the entry is written; cheap to get, the entry is
+        # neither read nor hashed
+        raise NotImplementedError()
+
+    # With if_match, update and delete write the entry only if its version
+    # is one of those, and raise VersionMismatchError otherwise. The check
+    # and the write are not interleaved with other writes of the entry.
+
+    @abstractmethod
+    async def update_address(
+        self,
+        nickname: str,
+        addr: AddressEntry,
+        if_match: Sequence[str] = None
+    ) -> None:
         raise NotImplementedError()
 
     @abstractmethod
-    async def delete_address(self, nickname: str) -> None:
+    async def delete_address(
+        self,
+        nickname: str,
+        if_match: Sequence[str] = None
+    ) -> None:
         raise NotImplementedError()
 
     @abstractmethod
     def read_all_addresses(self) -> AsyncIterator[Tuple[str, AddressEntry]]:
         raise NotImplementedError()
 
+    @abstractmethod
+    async def read_addresses_version(self) -> str:
+        # Changes whenever any entry is created, updated or deleted
+        raise NotImplementedError()
+
+    # Pagination
+
+    @abstractmethod
+    async def read_addresses_page(
+        self,
+        limit: int,
+        after: str = None
+    ) -> List[Tuple[str, AddressEntry]]:
+        # Up to limit entries with nickname greater than after, in
+        # nickname order
+        raise NotImplementedError()
+
+    # Raw reads: the API JSON of entries, as encode_entry() makes it, for
+    # responses that pass it through. Engines that store that JSON return
+    # it as read; entries are validated when written, not when served.
+    # These defaults encode the entries read.
+
+    async def read_address_raw(self, nickname: str) -> bytes:
+        return encode_entry(await self.read_address(nickname))
+
+    async def read_all_addresses_raw(
+        self
+    ) -> AsyncIterator[Tuple[str, bytes]]:
+        async for nickname, addr in self.read_all_addresses():
+            yield nickname, encode_entry(addr)
+
+    async def read_addresses_page_raw(
+        self,
+        limit: int,
+        after: str = None
+    ) -> List[Tuple[str, bytes]]:
+        return [
+            (nickname, encode_entry(addr))
+            for nickname, addr in await self.read_addresses_page(limit, after)
+        ]
+
+    # Queries
+
+    @abstractmethod
+    async def find_nicknames(self, criteria: Mapping[str, Any]) -> List[str]:
+        # Nicknames, in order, of the entries that match all field values in
+        # criteria; fields are those in indexes.INDEXED_FIELDS
+        raise NotImplementedError()
+
+    async def search_nicknames(self, query: str, limit: int) -> List[str]:
+        # Nicknames of the limit entries that best match the words of query,
+        # best first (see indexes.search_score). This scans all entries; the
+        # search layer (search_db.SearchIndexedAddressBookDB) uses an index.
+        terms = set(search_words(query))
+        if not terms:
+            return []
+        scored = []
+        async for nickname, addr in self.read_all_addresses():
+            score = search_score(terms, entry_search_words(addr))
+            if score:
+                scored.append((score, nickname))
+        return top_scored(scored, limit)
+
+    # Batches
+
+    async def write_addresses(
+        self,
+        writes: Sequence[AddressWrite]
+    ) -> List[Optional[KeyError]]:
+        # Applies the writes in order. The result of each is None, or the
+        # KeyError it failed with; a failed write does not stop the rest.
+        # Engines that can apply a batch with less I/O override this.
+        results: List[Optional[KeyError]] = []
+        for write in writes:
+            try:
+                if write.op == WRITE_DELETE:
+                    await self.delete_address(write.nickname)
+                elif write.addr is None:
+                    raise ValueError('No address to {} {}'.format(
+                        write.op, write.nickname
+                    ))
+                elif write.op == WRITE_CREATE:
+                    await self.create_address(write.addr, write.nickname)
+                elif write.op == WRITE_UPDATE:
+                    await self.update_address(write.nickname, write.addr)
+                else:
+                    raise ValueError('Invalid write op {}'.format(write.op))
+                results.append(None)
+            except KeyError as e:
+                results.append(e)
+        return results
+
 
 class InMemoryAddressBookDB(AbstractAddressBookDB):
-    def __init__(self):
-        self.db: Dict[str, AddressEntry] = {}
+    '''
+    Keeps entries in memory.
+
+    With a snapshot path, stop() saves the entries to a snapshot file (see
+    snapshot_file), and start() loads them back. Loaded entries are kept as
+    the JSON they were saved as, and parsed when first used (see
+    LazyAddressEntry.from_json), so start() decodes nothing; the secondary
+    index is built by the first query. snapshot() saves the entries while
+    the DB serves, as does a timer every snapshot_interval seconds if set.
+    It scans them as of when it began (see read_all_addresses), a batch at
+    a time, so that writes carry on meanwhile.
+
+    Writes made since the last snapshot are lost in a crash, unless
+    durability is 'batch' or 'write': then each write is also appended to a
+    change log, with the fsyncs of FilesystemAddressBookDB, and start()
+    replays the logs. Each snapshot begins a new log, and removes the logs
+    it covers once saved. Only one process may open a snapshot with a log.
+    '''
+
+    def __init__(
+        self,
+        snapshot_path: str = None,
+        snapshot_interval: float = None,
+        durability: str = DURABILITY_NONE
+    ):
+        if durability not in DURABILITY_MODES:
+            raise ValueError('Invalid durability "{}"'.format(durability))
+        if snapshot_interval is not None and snapshot_interval <= 0:
+            raise ValueError('Invalid snapshot interval {}'.format(
+                snapshot_interval
+            ))
+        if snapshot_path is None:
+            if snapshot_interval is not None or durability != DURABILITY_NONE:
+                raise ValueError('No snapshot path')
+        else:
+            snapshot_path = os.path.abspath(snapshot_path)
+            snapshot_dir = os.path.dirname(snapshot_path)
+            if not os.path.exists(snapshot_dir):
+                os.makedirs(snapshot_dir)
+            if not (
+                os.path.isdir(snapshot_dir) and
+                os.access(snapshot_dir, os.W_OK)
+            ):
+                raise ValueError(
+                    'Snapshot directory "{}" is not a writable '
+                    'directory'.format(snapshot_dir)
+                )
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.durability = durability
+
+        self.db: MutableMapping[str, AddressEntry] = {}
+        self.nicknames = SortedKeyIndex()
+        # None until the first query after a load
+        self.secondary: Optional[SecondaryIndex] = SecondaryIndex()
+        # Every write stamps the entry with the next sequence number. The
+        # instance id keeps versions from repeating across restarts.
+        self.versions: Dict[str, int] = {}
+        self._instance_id = uuid.uuid4().hex[:8]
+        self._sequence = itertools.count(1)
+        self._last_sequence = 0
+        self._snapshots: ScanSnapshots[AddressEntry] = ScanSnapshots()
+
+        self._started = False
+        # The current change log, and those of snapshots not yet saved
+        self._log_number = 0
+        self._wal: Optional[WriteAheadLog] = None
+        self._old_wals: List[WriteAheadLog] = []
+        self._snapshot: Optional[asyncio.Future] = None
+        self._snapshot_timer: Optional[asyncio.Future] = None
+
+    @property
+    def wal(self) -> Optional[WriteAheadLog]:
+        return self._wal
+
+    def start(self):
+        if self.snapshot_path is None or self._started:
+            return
+
+        next_log = 0
+        if os.path.exists(self.snapshot_path):
+            next_log, entries = read_snapshot(self.snapshot_path)
+            self._load(entries)
+        self._log_number = next_log
+
+        # Logs from before the snapshot are left by a crash after it was
+        # saved; later ones hold the writes made since
+        replayed = []
+        for number in self._log_numbers():
+            if number < next_log:
+                os.remove(self._log_path(number))
+                continue
+            wal = WriteAheadLog(self._log_path(number))
+            try:
+                for op, nickname, value in wal.open():
+                    self._replay(op, nickname, value)
+            finally:
+                wal.close()
+            replayed.append(number)
+        if replayed:
+            self._log_number = replayed[-1]
+            self._save()
+
+        if self.durability != DURABILITY_NONE:
+            self._wal = self._open_log()
+        if self.snapshot_interval is not None:
+            self._snapshot_timer = asyncio.ensure_future(
+                self._snapshot_periodically()
+            )
+        self._started = True
+
+    def stop(self):
+        if not self._started:
+            return
+
+        for task in (self._snapshot_timer, self._snapshot):
+            if task is not None:
+                task.cancel()
+        self._snapshot_timer = None
+        self._snapshot = None
+        self._save()
+        for wal in [self._wal] + self._old_wals:
+            if wal is not None:
+                wal.close()
+        self._wal = None
+        self._old_wals = []
+        self._started = False
+
+    # Snapshots and change logs
+
+    def _log_path(self, number: int) -> str:
+        return '{}.log.{}'.format(self.snapshot_path, number)
+
+    def _log_numbers(self) -> List[int]:
+        assert self.snapshot_path is not None
+        prefix = os.path.basename(self.snapshot_path) + '.log.'
+        return sorted(
+            int(name[len(prefix):])
+            for name in os.listdir(os.path.dirname(self.snapshot_path))
+            if name.startswith(prefix) and name[len(prefix):].isdigit()
+        )
+
+    def _open_log(self) -> WriteAheadLog:
+        wal = WriteAheadLog(
+            self._log_path(self._log_number),
+            group_commit=self.durability == DURABILITY_BATCH
+        )
+        wal.open()
+        return wal
+
+    def _remove_logs(self) -> None:
+        # Those that the saved snapshot covers
+        for number in self._log_numbers():
+            if number < self._log_number:
+                os.remove(self._log_path(number))
+
+    def _load(self, entries: List[Tuple[str, bytes]]) -> None:
+        # Into the empty book, without decoding the entries
+        self.db.update(
+            (nickname, LazyAddressEntry.from_json(value))
+            for nickname, value in entries
+        )
+        self.versions = dict.fromkeys(self.db, self._next_version())
+        self.nicknames = SortedKeyIndex(self.db)
+        self.secondary = None
+
+    def _replay(self, op: int, nickname: str, value: bytes) -> None:
+        if op == OP_PUT:
+            self._put(nickname, LazyAddressEntry.from_json(value))
+        elif nickname in self.db:
+            self._delete(nickname)
+
+    def _save(self) -> None:
+        # All at once, beginning a new log, then removes the logs it covers
+        assert self.snapshot_path is not None
+        self._log_number += 1
+        writer = SnapshotWriter(self.snapshot_path, self._log_number)
+        try:
+            writer.write(
+                (nickname, encode_entry(addr))
+                for nickname, addr in self.db.items()
+            )
+            writer.commit()
+        except BaseException:
+            writer.abort()
+            raise
+        self._remove_logs()
+
+    async def snapshot(self) -> None:
+        '''
+        Saves the entries, as of when it begins, to the snapshot file. Writes
+        made meanwhile go to the next change log.
+        '''
+        if not self._started:
+            raise RuntimeError('No snapshot file is open')
+        # One at a time
+        while self._snapshot is not None:
+            await asyncio.wait([self._snapshot])
+        self._snapshot = asyncio.ensure_future(self._save_scan())
+        await asyncio.shield(self._snapshot)
+
+    async def _save_scan(self) -> None:
+        assert self.snapshot_path is not None
+        try:
+            # No await from here to the first step of the scan, which takes
+            # its snapshot: a write either is in the scan, or is logged in
+            # the new log
+            self._log_number += 1
+            if self._wal is not None:
+                self._old_wals.append(self._wal)
+                self._wal = self._open_log()
+            scan = self.read_all_addresses()
+            writer = SnapshotWriter(self.snapshot_path, self._log_number)
+            try:
+                batch = []
+                async for nickname, addr in scan:
+                    batch.append((nickname, encode_entry(addr)))
+                    if len(batch) == SNAPSHOT_BATCH:
+                        writer.write(batch)
+                        batch = []
+                        await asyncio.sleep(0)
+                writer.write(batch)
+                writer.commit()
+            except BaseException:
+                writer.abort()
+                raise
+            finally:
+                await scan.aclose()
+
+            for wal in self._old_wals:
+                await wal.drain()
+            for wal in self._old_wals:
+                wal.close()
+            self._old_wals = []
+            self._remove_logs()
+        finally:
+            self._snapshot = None
+
+    async def _snapshot_periodically(self) -> None:
+        assert self.snapshot_interval is not None
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                await self.snapshot()
+            except OSError:
+                # Tried again next time; the logs still hold the writes
+                pass
+
+    # Writes
+
+    def _next_version(self) -> int:
+        self._last_sequence = next(self._sequence)
+        return self._last_sequence
+
+    def _written(self, nickname: str) -> None:
+        # Before every write, for scans in progress
+        self._snapshots.written(
+            nickname,
+            self.db.get(nickname) if self._snapshots.active else None
+        )
+
+    def _put(self, nickname: str, addr: AddressEntry) -> None:
+        self._written(nickname)
+        if nickname not in self.db:
+            self.nicknames.add(nickname)
+        self.db[nickname] = addr
+        self.versions[nickname] = self._next_version()
+        if self.secondary is not None:
+            self.secondary.put(nickname, addr)
+
+    def _delete(self, nickname: str) -> None:
+        self._written(nickname)
+        del self.db[nickname]
+        del self.versions[nickname]
+        self._next_version()
+        self.nicknames.discard(nickname)
+        if self.secondary is not None:
+            self.secondary.discard(nickname)
+
+    async def _write(
+        self,
+        op: int,
+        nickname: str,
+        addr: AddressEntry = None
+    ) -> None:
+        # Logged and applied in one step, so that a snapshot either has the
+        # write or begins a log that has it; then the log is synced
+        wal = self._wal
+        if wal is not None:
+            wal.append(
+                op, nickname, b'' if addr is None else encode_entry(addr)
+            )
+        if addr is None:
+            self._delete(nickname)
+        else:
+            self._put(nickname, addr)
+        if wal is not None:
+            await wal.sync()
 
     async def create_address(
         self,
@@ -59,33 +565,151 @@ class InMemoryAddressBookDB(AbstractAddressBookDB):
         if nickname in self.db:
             raise KeyError('{} already exists'.format(nickname))
 
-        self.db[nickname] = addr
+        await self._write(OP_PUT, nickname, addr)
         return nickname
 
     async def read_address(self, nickname: str) -> AddressEntry:
         return self.db[nickname]
 
-    async def update_address(self, nickname: str, addr: AddressEntry) -> None:
+    def _version(self, nickname: str) -> str:
+        return '{}-{:x}'.format(self._instance_id, self.versions[nickname])
+
+    async def read_address_version(self, nickname: str) -> str:
+        return self._version(nickname)
+
+    # _write() applies the write before its first await, so nothing gets
+    # in between the checks and the write
+
+    async def update_address(
+        self,
+        nickname: str,
+        addr: AddressEntry,
+        if_match: Sequence[str] = None
+    ) -> None:
         if nickname is None or nickname not in self.db:
             raise KeyError('{} does not exist'.format(nickname))
+        check_version(nickname, self._version(nickname), if_match)
 
-        self.db[nickname] = addr
+        await self._write(OP_PUT, nickname, addr)
 
-    async def delete_address(self, nickname: str) -> None:
+    async def delete_address(
+        self,
+        nickname: str,
+        if_match: Sequence[str] = None
+    ) -> None:
         if nickname is None or nickname not in self.db:
             raise KeyError('{} does not exist'.format(nickname))
+        check_version(nickname, self._version(nickname), if_match)
 
-        del self.db[nickname]
+        await self._write(OP_DELETE, nickname)
 
     async def read_all_addresses(
         self
-    ) -> AsyncIterator[Tuple[str, AddressEntry]]:
-        for nickname, addr in self.db.items():
-            yield nickname, addr
+    ) -> AsyncGenerator[Tuple[str, AddressEntry], None]:
+        # The entries as of when the scan began, in nickname order. The
+        # index is walked a page at a time rather than the dict iterated
+        # over, so that writes made while the caller awaits do not break
+        # the scan; entries deleted since are merged in from the snapshots.
+        snapshots = self._snapshots
+        snapshot = snapshots.begin()
+        try:
+            after = None
+            while True:
+                nicknames = self.nicknames.page(SCAN_PAGE_SIZE, after)
+                last = (
+                    nicknames[-1] if len(nicknames) == SCAN_PAGE_SIZE
+                    else None
+                )
+                deleted = [
+                    nickname
+                    for nickname in snapshots.changed(snapshot, after, last)
+                    if nickname not in self.db
+                ]
+                if deleted:
+                    nicknames = sorted(nicknames + deleted)
+                for nickname in nicknames:
+                    addr = snapshots.get(
+                        nickname, snapshot, self.db.get(nickname)
+                    )
+                    if addr is not None:
+                        yield nickname, addr
+                if last is None:
+                    break
+                after = last
+        finally:
+            snapshots.end(snapshot)
+
+    async def read_addresses_version(self) -> str:
+        return '{}-{:x}'.format(self._instance_id, self._last_sequence)
+
+    async def read_addresses_page(
+        self,
+        limit: int,
+        after: str = None
+    ) -> List[Tuple[str, AddressEntry]]:
+        return [
+            (nickname, self.db[nickname])
+            for nickname in self.nicknames.page(limit, after)
+        ]
+
+    async def find_nicknames(self, criteria: Mapping[str, Any]) -> List[str]:
+        if self.secondary is None:
+            self.secondary = SecondaryIndex()
+            for nickname, addr in self.db.items():
+                if isinstance(addr, LazyAddressEntry):
+                    # From a copy, so that the entry is kept undecoded
+                    addr = LazyAddressEntry.from_json(addr.to_json())
+                self.secondary.put(nickname, addr)
+        return sorted(self.secondary.find(criteria))
 
 
 class FilesystemAddressBookDB(AbstractAddressBookDB):
-    def __init__(self, store_dir_path: str):
+    '''
+    Stores each entry in a JSON file of its own.
+
+    A write replaces the file with a new one. With durability 'none', files
+    are never fsynced, so a crash may lose recent writes. With 'batch' or
+    'write', every write is first appended to a write-ahead log, and only
+    returns once the log is fsynced; 'batch' lets concurrent writes share
+    one fsync (group commit). start() replays the log, which makes the
+    files match every write that returned. A checkpoint fsyncs the files
+    written since the last one, then empties the log. Only one process may
+    open a store with a log.
+
+    Writes of an entry check whether it exists (and its version, with
+    if_match), then write it, holding a lock on its nickname, so that
+    concurrent writes of the same entry in this process are made one after
+    the other.
+
+    With shards, entry files are spread over that many subdirectories of
+    the store (see fs_layout), which must have been created with as many.
+
+    File operations run off the event loop, in the executor of the I/O
+    backend (see file_io.make_file_io). A scan reads scan_concurrency
+    batches of files at once, and yields them in directory order if
+    scan_ordered, or as soon as each is read.
+    '''
+
+    def __init__(
+        self,
+        store_dir_path: str,
+        durability: str = DURABILITY_NONE,
+        io: str = FILE_IO_THREADS,
+        io_threads: int = FILE_IO_POOL_SIZE,
+        scan_concurrency: int = FILE_SCAN_CONCURRENCY,
+        scan_ordered: bool = False,
+        shards: int = 0
+    ):
+        if durability not in DURABILITY_MODES:
+            raise ValueError('Invalid durability "{}"'.format(durability))
+        if scan_concurrency < 1:
+            raise ValueError('Invalid scan concurrency {}'.format(
+                scan_concurrency
+            ))
+        self._io = make_file_io(io, io_threads)
+        self.scan_concurrency = scan_concurrency
+        self.scan_ordered = scan_ordered
+
         store_dir = os.path.abspath(store_dir_path)
         if not os.path.exists(store_dir):
             os.makedirs(store_dir)
@@ -95,53 +719,330 @@ class FilesystemAddressBookDB(AbstractAddressBookDB):
                     store_dir
                 )
             )
+        open_layout(store_dir, shards)
         self._store = store_dir
+        self.shards = shards
+        self._entry_dirs = entry_dirs(store_dir, shards)
+        # Writes to shard directories also mark the store directory as
+        # modified, see read_addresses_version
+        self._touch_dir = store_dir if shards else None
+        self._nicknames: Optional[SortedKeyIndex] = None
+        # mtime of the store directory when the nicknames were listed, None
+        # if the listing is to be made again
+        self._nicknames_mtime: Optional[int] = None
+        self._secondary: Optional[SecondaryIndex] = None
+        self._secondary_build: Optional[
+            'asyncio.Future[SecondaryIndex]'
+        ] = None
+        # Nicknames deleted while the secondary index is built, which the
+        # scan may have read before they were deleted
+        self._secondary_deleted: Set[str] = set()
+        # mtime of the store directory when the secondary index was built,
+        # as _nicknames_mtime
+        self._secondary_mtime: Optional[int] = None
+        self._write_locks = KeyLocks()
+        # Contents replaced by writes made while scans run
+        self._snapshots: ScanSnapshots[bytes] = ScanSnapshots()
+
+        self.durability = durability
+        self._wal: Optional[WriteAheadLog] = None
+        # Nicknames written since the last checkpoint
+        self._wal_dirty: Set[str] = set()
+        # Records appended since the last _wal_sync(), and the task that
+        # applies the last batch of records to the files
+        self._wal_unapplied: List[Tuple[int, str, bytes]] = []
+        self._wal_applying: Optional[asyncio.Future] = None
+        self._checkpoint: Optional[asyncio.Future] = None
 
     @property
     def store(self) -> str:
         return self._store
 
+    @property
+    def wal(self) -> Optional[WriteAheadLog]:
+        return self._wal
+
+    @property
+    def io(self) -> FileIO:
+        return self._io
+
+    def start(self):
+        self._io.start()
+        if self.durability == DURABILITY_NONE or self._wal is not None:
+            return
+
+        wal = WriteAheadLog(
+            os.path.join(self.store, WAL_FILE_NAME),
+            group_commit=self.durability == DURABILITY_BATCH
+        )
+        records = wal.open()
+        self._write_records(records)
+        self._sync_files({nickname for _, nickname, _ in records})
+        wal.truncate()
+        self._wal = wal
+        # No other process writes while the log is open, so whether an
+        # entry exists is known without a stat
+        self._nicknames = SortedKeyIndex(
+            nickname for nickname, _ in self._file_list()
+        )
+
+    def stop(self):
+        if self._wal is not None:
+            if self._checkpoint is not None:
+                self._checkpoint.cancel()
+                self._checkpoint = None
+            self._sync_files(self._wal_dirty)
+            self._wal_dirty = set()
+            # Records still being applied are applied again on start()
+            applying = self._wal_applying
+            if applying is None or applying.done():
+                self._wal.truncate()
+            self._wal.close()
+            self._wal = None
+        self._io.stop()
+
+    @property
+    def nicknames(self) -> SortedKeyIndex:
+        # Built from a directory listing on first use, then kept up to date
+        # by create and delete. Only complete while the store is open with a
+        # log: other processes may write otherwise, see _nickname_index().
+        if self._nicknames is None:
+            self._nicknames = SortedKeyIndex(
+                nickname for nickname, _ in self._file_list()
+            )
+        return self._nicknames
+
+    async def _nickname_index(self) -> SortedKeyIndex:
+        # Without a log, other processes (such as the other workers of the
+        # server) may share the store, so the directory is listed again
+        # once it has been modified since, as read_addresses_version does.
+        if self._wal is not None:
+            return self.nicknames
+
+        mtime = (await self._io.stat(self.store)).st_mtime_ns
+        if self._nicknames is None or mtime != self._nicknames_mtime:
+            files = await self._io.run(self._file_list)
+            self._nicknames = SortedKeyIndex(
+                nickname for nickname, _ in files
+            )
+            racy = time.time_ns() - mtime < DIR_LISTING_RACY_NS
+            self._nicknames_mtime = None if racy else mtime
+        return self._nicknames
+
     def _file_name(self, nickname: str) -> str:
+        entry_dir = self.store
+        if self.shards:
+            entry_dir = self._entry_dirs[shard_of(nickname, self.shards)]
         return os.path.join(
-            self.store,
+            entry_dir,
             nickname + '.json'
         )
 
-    def _file_exists(self, nickname: str) -> bool:
-        return os.path.exists(self._file_name(nickname))
+    async def _file_exists(self, nickname: str) -> bool:
+        if self._wal is not None:
+            return nickname in self.nicknames
+        return await self._io.exists(self._file_name(nickname))
 
-    async def _file_read(self, nickname: str) -> Dict:
+    async def _file_read(self, nickname: str) -> bytes:
         try:
-            async with aiofiles.open(
-                self._file_name(nickname),
-                encoding='utf-8',
-                mode='r'
-            ) as f:
-                contents = await f.read()
-                return json.loads(contents)
+            return await self._io.read(self._file_name(nickname))
         except FileNotFoundError:
             raise KeyError(nickname)
 
-    async def _file_write(self, nickname: str, addr: Mapping) -> None:
-        async with aiofiles.open(
-            self._file_name(nickname),
-            mode='w',
-            encoding='utf-8'
-        ) as f:
-            await f.write(json.dumps(addr))
+    async def _file_written(self, nickname: str) -> None:
+        # Before a write to the file, for scans in progress
+        old = None
+        if self._snapshots.active:
+            try:
+                old = await self._io.read(self._file_name(nickname))
+            except FileNotFoundError:
+                pass
+        self._snapshots.written(nickname, old)
+
+    async def _file_write(self, nickname: str, data: bytes) -> None:
+        if self._wal is not None:
+            await self._wal_write(OP_PUT, nickname, data)
+            return
+
+        await self._file_written(nickname)
+        # The file is replaced by a new one, so every write also modifies
+        # the directory (see read_addresses_version)
+        await self._io.write(self._file_name(nickname), data, self._touch_dir)
 
     async def _file_delete(self, nickname: str) -> None:
-        os.remove(self._file_name(nickname))
+        if self._wal is not None:
+            await self._wal_write(OP_DELETE, nickname)
+            return
+
+        await self._file_written(nickname)
+        await self._io.remove(self._file_name(nickname), self._touch_dir)
+
+    # Write-ahead log
 
-    async def _file_read_all(self) -> AsyncIterator[Tuple[str, Dict]]:
-        all_files = os.listdir(self.store)
+    def _write_records(
+        self,
+        records: Sequence[Tuple[int, str, bytes]]
+    ) -> None:
+        # Applies records of the log to the files, in order
+        for op, nickname, value in records:
+            file_name = self._file_name(nickname)
+            if op == OP_PUT:
+                replace_file(file_name, value)
+            else:
+                try:
+                    os.remove(file_name)
+                except FileNotFoundError:
+                    pass
+
+    def _replaced_values(
+        self,
+        records: Sequence[Tuple[int, str, bytes]]
+    ) -> List[Optional[bytes]]:
+        # The contents each of records replaces, for scans in progress
+        values: Dict[str, Optional[bytes]] = {}
+        olds: List[Optional[bytes]] = []
+        for op, nickname, value in records:
+            if nickname not in values:
+                try:
+                    values[nickname] = read_file(self._file_name(nickname))
+                except FileNotFoundError:
+                    values[nickname] = None
+            olds.append(values[nickname])
+            values[nickname] = value if op == OP_PUT else None
+        return olds
+
+    async def _apply_records(
+        self,
+        previous: Optional[asyncio.Future],
+        records: Sequence[Tuple[int, str, bytes]]
+    ) -> None:
+        # After the previous batch, so that files are written in log order
+        if previous is not None:
+            await asyncio.wait([previous])
+        olds: Sequence[Optional[bytes]] = [None] * len(records)
+        if self._snapshots.active:
+            olds = await self._io.run(self._replaced_values, records)
+        for (_, nickname, _), old in zip(records, olds):
+            self._snapshots.written(nickname, old)
+        await self._io.run(self._write_records, records)
+
+    def _sync_files(self, nicknames: Iterable[str]) -> None:
+        # Directories of renames and removes
+        dirs = {self.store}
+        for nickname in nicknames:
+            file_name = self._file_name(nickname)
+            dirs.add(os.path.dirname(file_name))
+            try:
+                fd = os.open(file_name, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        for path in dirs:
+            sync_dir(path)
+
+    async def _wal_ready(self) -> WriteAheadLog:
+        # No record may be appended during a checkpoint, which empties the
+        # log once the files are synced
+        while self._checkpoint is not None:
+            await asyncio.shield(self._checkpoint)
+        if self._wal is None:
+            raise RuntimeError('Store {} is not open'.format(self.store))
+        return self._wal
+
+    def _wal_append(self, op: int, nickname: str, value: bytes = b'') -> None:
+        # The caller must have awaited _wal_ready(), with no await since
+        wal = self._wal
+        assert wal is not None and self._checkpoint is None
+        wal.append(op, nickname, value)
+        self._wal_unapplied.append((op, nickname, value))
+        self._wal_dirty.add(nickname)
+
+    async def _wal_sync(self) -> None:
+        # Applies the records appended since the last call in the file I/O
+        # executor, one batch at a time, while the log is synced
+        records, self._wal_unapplied = self._wal_unapplied, []
+        applying = None
+        if records:
+            applying = asyncio.ensure_future(
+                self._apply_records(self._wal_applying, records)
+            )
+            self._wal_applying = applying
+        wal = await self._wal_ready()
+        await wal.sync()
+        if applying is not None:
+            await asyncio.shield(applying)
+        if wal.size >= WAL_CHECKPOINT_BYTES and self._checkpoint is None:
+            self._checkpoint = asyncio.ensure_future(self._run_checkpoint())
+
+    async def _wal_write(
+        self,
+        op: int,
+        nickname: str,
+        value: bytes = b''
+    ) -> None:
+        await self._wal_ready()
+        self._wal_append(op, nickname, value)
+        await self._wal_sync()
+
+    async def _run_checkpoint(self) -> None:
+        # Nothing is written until it is done, so the dirty set stays as is
+        try:
+            if self._wal_applying is not None:
+                await asyncio.wait([self._wal_applying])
+            await self._io.run(self._sync_files, set(self._wal_dirty))
+            if self._wal is not None:
+                await self._wal.empty()
+                self._wal_dirty = set()
+        finally:
+            self._checkpoint = None
+
+    def _file_list(self) -> List[Tuple[str, str]]:
         extn_end = '.json'
         extn_len = len(extn_end)
-        for f in all_files:
-            if f.endswith(extn_end):
-                nickname = f[:-extn_len]
-                addr = await self._file_read(nickname)
-                yield nickname, addr
+        return [
+            (f[:-extn_len], f)
+            for entry_dir in self._entry_dirs
+            for f in os.listdir(entry_dir) if f.endswith(extn_end)
+        ]
+
+    async def _file_read_snapshot(self) -> AsyncIterator[Tuple[str, bytes]]:
+        # The files as of when the scan began, as far as writes made through
+        # this engine go: those of other processes can not be undone. Files
+        # deleted since, and not listed, are yielded last.
+        snapshots = self._snapshots
+        snapshot = snapshots.begin()
+        try:
+            listed: Set[str] = set()
+            async for nickname, data in self._file_read_all():
+                listed.add(nickname)
+                value = snapshots.get(nickname, snapshot, data)
+                if value is not None:
+                    yield nickname, value
+            for nickname in snapshots.changed(snapshot):
+                if nickname not in listed:
+                    value = snapshots.get(nickname, snapshot, None)
+                    if value is not None:
+                        yield nickname, value
+        finally:
+            snapshots.end(snapshot)
+
+    async def _file_read_all(self) -> AsyncIterator[Tuple[str, bytes]]:
+        # The directory is listed lazily, unlike _file_list(), and files
+        # are read in batches
+        extn_end = '.json'
+        for entry_dir in self._entry_dirs:
+            batches = self._io.read_dir(
+                entry_dir,
+                extn_end,
+                concurrency=self.scan_concurrency,
+                ordered=self.scan_ordered
+            )
+            async for batch in batches:
+                for file_name, contents in batch:
+                    yield file_name[:-len(extn_end)], contents
 
     async def create_address(
         self,
@@ -151,30 +1052,251 @@ class FilesystemAddressBookDB(AbstractAddressBookDB):
         if nickname is None:
             nickname = uuid.uuid4().hex
 
-        if self._file_exists(nickname):
-            raise KeyError('{} already exists'.format(nickname))
+        async with self._write_locks.hold([nickname]):
+            if await self._file_exists(nickname):
+                raise KeyError('{} already exists'.format(nickname))
 
-        await self._file_write(nickname, addr.to_api_dm())
+            await self._file_write(nickname, encode_entry(addr))
+            self._indexes_put(nickname, addr)
         return nickname
 
     async def read_address(self, nickname: str) -> AddressEntry:
         addr = await self._file_read(nickname)
-        return AddressEntry.from_api_dm(addr)
+        return LazyAddressEntry.from_api_dm(json.loads(addr))
 
-    async def update_address(self, nickname: str, addr: AddressEntry) -> None:
-        if self._file_exists(nickname):
-            await self._file_write(nickname, addr.to_api_dm())
-        else:
+    async def read_address_raw(self, nickname: str) -> bytes:
+        # The files hold the API JSON
+        return await self._file_read(nickname)
+
+    async def read_address_version(self, nickname: str) -> str:
+        try:
+            st = await self._io.stat(self._file_name(nickname))
+        except FileNotFoundError:
             raise KeyError(nickname)
+        return '{:x}-{:x}-{:x}'.format(st.st_ino, st.st_mtime_ns, st.st_size)
 
-    async def delete_address(self, nickname: str) -> None:
-        if self._file_exists(nickname):
-            await self._file_delete(nickname)
-        else:
+    async def _check_file(
+        self,
+        nickname: str,
+        if_match: Optional[Sequence[str]]
+    ) -> None:
+        # Under the lock of the nickname, whose writes (and their records of
+        # the log) have all been made to the file
+        if if_match is not None:
+            version = await self.read_address_version(nickname)
+            check_version(nickname, version, if_match)
+        elif not await self._file_exists(nickname):
             raise KeyError(nickname)
 
+    async def update_address(
+        self,
+        nickname: str,
+        addr: AddressEntry,
+        if_match: Sequence[str] = None
+    ) -> None:
+        async with self._write_locks.hold([nickname]):
+            await self._check_file(nickname, if_match)
+            await self._file_write(nickname, encode_entry(addr))
+            self._indexes_put(nickname, addr)
+
+    async def delete_address(
+        self,
+        nickname: str,
+        if_match: Sequence[str] = None
+    ) -> None:
+        async with self._write_locks.hold([nickname]):
+            await self._check_file(nickname, if_match)
+            await self._file_delete(nickname)
+            self._indexes_discard(nickname)
+
+    def _indexes_put(self, nickname: str, addr: AddressEntry) -> None:
+        if self._nicknames is not None:
+            self._nicknames.add(nickname)
+        if self._secondary is not None:
+            self._secondary.put(nickname, addr)
+            self._secondary_deleted.discard(nickname)
+
+    def _indexes_discard(self, nickname: str) -> None:
+        if self._nicknames is not None:
+            self._nicknames.discard(nickname)
+        if self._secondary is not None:
+            self._secondary.discard(nickname)
+        if (
+            self._secondary_build is not None and
+            not self._secondary_build.done()
+        ):
+            self._secondary_deleted.add(nickname)
+
     async def read_all_addresses(
         self
     ) -> AsyncIterator[Tuple[str, AddressEntry]]:
-        async for nickname, addr in self._file_read_all():
-            yield nickname, AddressEntry.from_api_dm(addr)
+        async for nickname, addr in self._file_read_snapshot():
+            yield nickname, LazyAddressEntry.from_api_dm(json.loads(addr))
+
+    async def read_all_addresses_raw(
+        self
+    ) -> AsyncIterator[Tuple[str, bytes]]:
+        async for nickname, addr in self._file_read_snapshot():
+            yield nickname, addr
+
+    def _listing_version(self, dir_version: str) -> str:
+        # Of the store directory and the files of all entries: every write
+        # replaces a file (with a new inode) or removes one. Files removed
+        # while listed are left out, which changes it all the same.
+        digest = hashlib.blake2b(dir_version.encode('utf-8'), digest_size=16)
+        for entry_dir in self._entry_dirs:
+            for name in sorted(os.listdir(entry_dir)):
+                if not name.endswith('.json'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(entry_dir, name))
+                except FileNotFoundError:
+                    continue
+                digest.update('{}:{:x}-{:x}-{:x}\n'.format(
+                    name, st.st_ino, st.st_mtime_ns, st.st_size
+                ).encode('utf-8'))
+        return digest.hexdigest()
+
+    async def read_addresses_version(self) -> str:
+        # Made from what is on disk only, so that all processes sharing the
+        # store agree on it. Every write modifies the store directory, but
+        # other writes within the same filesystem timestamp tick do not
+        # change its mtime: until it is DIR_LISTING_RACY_NS old, the entry
+        # files are listed and stat()ed instead.
+        st = await self._io.stat(self.store)
+        version = '{:x}-{:x}'.format(st.st_ino, st.st_mtime_ns)
+        if time.time_ns() - st.st_mtime_ns < DIR_LISTING_RACY_NS:
+            return await self._io.run(self._listing_version, version)
+        return version
+
+    async def read_addresses_page(
+        self,
+        limit: int,
+        after: str = None
+    ) -> List[Tuple[str, AddressEntry]]:
+        return [
+            (nickname, LazyAddressEntry.from_api_dm(json.loads(addr)))
+            for nickname, addr in await self.read_addresses_page_raw(
+                limit, after
+            )
+        ]
+
+    async def read_addresses_page_raw(
+        self,
+        limit: int,
+        after: str = None
+    ) -> List[Tuple[str, bytes]]:
+        # The files of the page are read in batches. Files deleted by
+        # another process since the directory was listed are skipped, and
+        # the page is filled up with the next ones, as read_dir does.
+        index = await self._nickname_index()
+        page: List[Tuple[str, bytes]] = []
+        while len(page) < limit:
+            nicknames = index.page(limit - len(page), after)
+            if not nicknames:
+                break
+            contents = await self._io.read_many(
+                [self._file_name(nickname) for nickname in nicknames]
+            )
+            for nickname, addr in zip(nicknames, contents):
+                if addr is None:
+                    index.discard(nickname)
+                else:
+                    page.append((nickname, addr))
+            after = nicknames[-1]
+        return page
+
+    async def _build_secondary_index(
+        self,
+        index: SecondaryIndex
+    ) -> SecondaryIndex:
+        # Writes made while the files are read go to the index directly,
+        # and are newer than what the scan read, which may also have read
+        # files before they were deleted.
+        try:
+            async for nickname, addr in self._file_read_all():
+                if (
+                    nickname not in index and
+                    nickname not in self._secondary_deleted
+                ):
+                    entry = LazyAddressEntry.from_api_dm(json.loads(addr))
+                    index.put(nickname, entry)
+            if self._secondary is index:
+                self._secondary_deleted = set()
+            return index
+        except BaseException:
+            if self._secondary is index:
+                self._reset_secondary()
+            raise
+
+    def _reset_secondary(self) -> None:
+        # The index is built again by the next query
+        self._secondary = None
+        self._secondary_build = None
+        self._secondary_deleted = set()
+        self._secondary_mtime = None
+
+    async def find_nicknames(self, criteria: Mapping[str, Any]) -> List[str]:
+        # The index is built by reading all files on the first query, then
+        # kept up to date by create, update and delete. Without a log, other
+        # processes may share the store, so it is built again once the
+        # directory has been modified since, as _nickname_index() does.
+        if self._wal is None:
+            mtime = (await self._io.stat(self.store)).st_mtime_ns
+            if mtime != self._secondary_mtime:
+                self._reset_secondary()
+                racy = time.time_ns() - mtime < DIR_LISTING_RACY_NS
+                self._secondary_mtime = None if racy else mtime
+        if self._secondary_build is None:
+            self._secondary = SecondaryIndex()
+            self._secondary_build = asyncio.ensure_future(
+                self._build_secondary_index(self._secondary)
+            )
+        index = await asyncio.shield(self._secondary_build)
+        return sorted(index.find(criteria))
+
+    # Batches
+
+    async def write_addresses(
+        self,
+        writes: Sequence[AddressWrite]
+    ) -> List[Optional[KeyError]]:
+        # With a log, all the writes are appended, then synced at once
+        if self._wal is None:
+            return await super().write_addresses(writes)
+
+        async with self._write_locks.hold(w.nickname for w in writes):
+            return await self._wal_write_batch(writes)
+
+    async def _wal_write_batch(
+        self,
+        writes: Sequence[AddressWrite]
+    ) -> List[Optional[KeyError]]:
+        await self._wal_ready()
+        results: List[Optional[KeyError]] = []
+        for write in writes:
+            exists = write.nickname in self.nicknames
+            if write.op == WRITE_CREATE and exists:
+                results.append(
+                    KeyError('{} already exists'.format(write.nickname))
+                )
+            elif write.op in (WRITE_UPDATE, WRITE_DELETE) and not exists:
+                results.append(KeyError(write.nickname))
+            elif write.op == WRITE_DELETE:
+                self._wal_append(OP_DELETE, write.nickname)
+                self._indexes_discard(write.nickname)
+                results.append(None)
+            elif write.addr is None:
+                raise ValueError('No address to {} {}'.format(
+                    write.op, write.nickname
+                ))
+            elif write.op in (WRITE_CREATE, WRITE_UPDATE):
+                value = encode_entry(write.addr)
+                self._wal_append(OP_PUT, write.nickname, value)
+                self._indexes_put(write.nickname, write.addr)
+                results.append(None)
+            else:
+                raise ValueError('Invalid write op {}'.format(write.op))
+
+        await self._wal_sync()
+        return results
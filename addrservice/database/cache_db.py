@@ -0,0 +1,176 @@
+# Copyright (c) 2020. All rights reserved.
+
+from collections import OrderedDict
+import time
+from typing import (
+    Any,
+    AsyncIterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple
+)
+
+from addrservice.database.addressbook_db import (
+    AbstractAddressBookDB, AddressWrite, encode_entry
+)
+from addrservice.datamodel import AddressEntry
+
+
+class CachedAddressBookDB(AbstractAddressBookDB):
+    '''
+    Read-through LRU cache of AddressEntry objects in front of another DB.
+
+    Holds at most max_size entries, each for at most ttl seconds (forever if
+    ttl is None). update_address, delete_address and write_addresses
+    invalidate the cached entries. Scans and pages are passed through to
+    the underlying DB, and so are raw reads of entries not cached: caching
+    them would mean decoding them.
+    '''
+
+    def __init__(
+        self,
+        db: AbstractAddressBookDB,
+        max_size: int = 1024,
+        ttl: float = None
+    ):
+        if max_size <= 0:
+            raise ValueError('Invalid cache max size {}'.format(max_size))
+
+        self.db = db
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._cache: OrderedDict = OrderedDict()
+        # Bumped on every invalidation. A read that raced a write does not
+        # put the value it read into the cache.
+        self._generation = 0
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def start(self):
+        self.db.start()
+
+    def stop(self):
+        self.db.stop()
+
+    def _invalidate(self, nickname: str) -> None:
+        self._generation += 1
+        self._cache.pop(nickname, None)
+
+    # CRUD
+
+    async def create_address(
+        self,
+        addr: AddressEntry,
+        nickname: str = None
+    ) -> str:
+        return await self.db.create_address(addr, nickname)
+
+    def _get(self, nickname: str) -> Optional[AddressEntry]:
+        cached = self._cache.get(nickname)
+        if cached is not None:
+            expires_at, addr = cached
+            if self.ttl is None or time.monotonic() < expires_at:
+                self.hits += 1
+                self._cache.move_to_end(nickname)
+                return addr
+            del self._cache[nickname]
+
+        self.misses += 1
+        return None
+
+    async def read_address(self, nickname: str) -> AddressEntry:
+        addr = self._get(nickname)
+        if addr is not None:
+            return addr
+
+        generation = self._generation
+        addr = await self.db.read_address(nickname)
+        if generation == self._generation:
+            expires_at = time.monotonic() + (self.ttl or 0)
+            self._cache[nickname] = (expires_at, addr)
+            if len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+        return addr
+
+    async def read_address_raw(self, nickname: str) -> bytes:
+        addr = self._get(nickname)
+        if addr is not None:
+            return encode_entry(addr)
+        return await self.db.read_address_raw(nickname)
+
+    async def read_address_version(self, nickname: str) -> str:
+        return await self.db.read_address_version(nickname)
+
+    async def update_address(
+        self,
+        nickname: str,
+        addr: AddressEntry,
+        if_match: Sequence[str] = None
+    ) -> None:
+        try:
+            await self.db.update_address(nickname, addr, if_match)
+        finally:
+            self._invalidate(nickname)
+
+    async def delete_address(
+        self,
+        nickname: str,
+        if_match: Sequence[str] = None
+    ) -> None:
+        try:
+            await self.db.delete_address(nickname, if_match)
+        finally:
+            self._invalidate(nickname)
+
+    async def read_all_addresses(
+        self
+    ) -> AsyncIterator[Tuple[str, AddressEntry]]:
+        async for nickname, addr in self.db.read_all_addresses():
+            yield nickname, addr
+
+    async def read_all_addresses_raw(
+        self
+    ) -> AsyncIterator[Tuple[str, bytes]]:
+        async for nickname, addr in self.db.read_all_addresses_raw():
+            yield nickname, addr
+
+    async def read_addresses_version(self) -> str:
+        return await self.db.read_addresses_version()
+
+    async def read_addresses_page(
+        self,
+        limit: int,
+        after: str = None
+    ) -> List[Tuple[str, AddressEntry]]:
+        return await self.db.read_addresses_page(limit, after)
+
+    async def read_addresses_page_raw(
+        self,
+        limit: int,
+        after: str = None
+    ) -> List[Tuple[str, bytes]]:
+        return await self.db.read_addresses_page_raw(limit, after)
+
+    async def find_nicknames(self, criteria: Mapping[str, Any]) -> List[str]:
+        return await self.db.find_nicknames(criteria)
+
+    async def search_nicknames(self, query: str, limit: int) -> List[str]:
+        return await self.db.search_nicknames(query, limit)
+
+    # Batches
+
+    async def write_addresses(
+        self,
+        writes: Sequence[AddressWrite]
+    ) -> List[Optional[KeyError]]:
+        try:
+            return await self.db.write_addresses(writes)
+        finally:
+            for write in writes:
+                self._invalidate(write.nickname)
@@ -0,0 +1,497 @@
+# Copyright (c) 2020. All rights reserved.
+
+from array import array
+import itertools
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    MutableMapping,
+    Optional,
+    Sequence,
+    Tuple
+)
+
+from addrservice.database.addressbook_db import InMemoryAddressBookDB
+from addrservice.database.wal import DURABILITY_NONE
+from addrservice.datamodel import (
+    Address,
+    AddressEntry,
+    AddressType,
+    Email,
+    LazyAddressEntry,
+    Phone
+)
+
+KINDS = list(AddressType)
+KIND_CODES = {kind: code for code, kind in enumerate(KINDS)}
+
+# Address fields after kind, in the order of the Address constructor. All
+# are dictionary encoded.
+ADDRESS_FIELDS = (
+    'street_name',
+    'pincode',
+    'country',
+    'building_name',
+    'unit_number',
+    'street_number',
+    'locality',
+    'city',
+    'province',
+)
+
+# Columns of the entry table
+(
+    NAME_OFFSET,
+    NAME_LENGTH,
+    ADDRESSES_START,
+    ADDRESSES_COUNT,
+    PHONES_START,
+    PHONES_COUNT,
+    FAXES_START,
+    FAXES_COUNT,
+    EMAILS_START,
+    EMAILS_COUNT,
+) = range(10)
+ENTRY_COLUMN_TYPES = 'QIIIIIIIII'
+
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+# The store is rebuilt once dead rows (or bytes) outnumber live ones, and
+# there are at least this many of them.
+COMPACTION_MIN_ROWS = 4096
+COMPACTION_MIN_BYTES = 64 * 1024
+
+# Entries moved into the new columns by each write made while the store is
+# rebuilt
+COMPACTION_STEP = 64
+
+
+class ValueDictionary:
+    '''
+    Dictionary encoding: each distinct value is stored once and columns
+    hold its integer code. Code 0 stands for None.
+
+    For fields with few distinct values, such as country or city. Values are
+    never removed; the store is rebuilt with a new dictionary on compaction.
+    '''
+
+    def __init__(self) -> None:
+        self._values: List[Any] = [None]
+        # Keyed by type too, so that 1 and 1.0 get different codes
+        self._codes: Dict[Tuple[type, Any], int] = {}
+
+    def __len__(self) -> int:
+        return len(self._values) - 1
+
+    def encode(self, value: Any) -> int:
+        if value is None:
+            return 0
+        key = (type(value), value)
+        code = self._codes.get(key)
+        if code is None:
+            code = len(self._values)
+            self._values.append(value)
+            self._codes[key] = code
+        return code
+
+    def decode(self, code: int) -> Any:
+        return self._values[code]
+
+
+class StringHeap:
+    '''
+    Strings with many distinct values, such as names and emails, stored as
+    UTF-8 in one bytearray and addressed by offset and length. This saves
+    the ~50 bytes of header of each str object.
+    '''
+
+    def __init__(self) -> None:
+        self._data = bytearray()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def add(self, value: str) -> Tuple[int, int]:
+        data = value.encode('utf-8')
+        offset = len(self._data)
+        self._data += data
+        return offset, len(data)
+
+    def get(self, offset: int, length: int) -> str:
+        return self._data[offset:offset + length].decode('utf-8')
+
+
+class IntColumn:
+    '''
+    Array of int64. The rare value that is not an int64 (a float, a big int
+    or None) is kept in a dict by row, with INT64_MIN in the array.
+    '''
+
+    def __init__(self) -> None:
+        self._array = array('q')
+        self._others: Dict[int, Any] = {}
+
+    def __len__(self) -> int:
+        return len(self._array)
+
+    def append(self, value: Any) -> None:
+        if type(value) is int and INT64_MIN < value <= INT64_MAX:
+            self._array.append(value)
+        else:
+            self._others[len(self._array)] = value
+            self._array.append(INT64_MIN)
+
+    def __getitem__(self, row: int) -> Any:
+        value = self._array[row]
+        return self._others[row] if value == INT64_MIN else value
+
+
+class EntryColumns:
+    '''
+    Address entries stored column by column.
+
+    An entry is a row of the entry table, which holds its full name and,
+    for each of addresses, phone numbers, fax numbers and emails, the first
+    row and the count of its records in the table of that record type. A
+    write appends new records; those of the entry it replaces become dead.
+    '''
+
+    def __init__(self) -> None:
+        self.values = ValueDictionary()
+        self.strings = StringHeap()
+        self.entries = [array(t) for t in ENTRY_COLUMN_TYPES]
+
+        self.address_kinds = array('B')
+        self.address_fields = [array('I') for _ in ADDRESS_FIELDS]
+
+        # Phone and fax numbers
+        self.phone_kinds = array('B')
+        self.phone_country_codes = array('I')
+        self.phone_area_codes = array('I')
+        self.phone_local_numbers = IntColumn()
+
+        self.email_kinds = array('B')
+        self.email_offsets = array('Q')
+        self.email_lengths = array('I')
+
+        self.live_rows = 0
+        self.dead_rows = 0
+        self.dead_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self.entries[0])
+
+    def _add_addresses(self, addresses: Sequence[Address]) -> int:
+        start = len(self.address_kinds)
+        encode = self.values.encode
+        for addr in addresses:
+            self.address_kinds.append(KIND_CODES[addr.kind])
+            for column, field in zip(self.address_fields, ADDRESS_FIELDS):
+                column.append(encode(getattr(addr, field)))
+        return start
+
+    def _add_phones(self, phones: Sequence[Phone]) -> int:
+        start = len(self.phone_kinds)
+        encode = self.values.encode
+        for phone in phones:
+            self.phone_kinds.append(KIND_CODES[phone.kind])
+            self.phone_country_codes.append(encode(phone.country_code))
+            self.phone_area_codes.append(encode(phone.area_code))
+            self.phone_local_numbers.append(phone.local_number)
+        return start
+
+    def _add_emails(self, emails: Sequence[Email]) -> int:
+        start = len(self.email_kinds)
+        for email in emails:
+            offset, length = self.strings.add(email.email)
+            self.email_kinds.append(KIND_CODES[email.kind])
+            self.email_offsets.append(offset)
+            self.email_lengths.append(length)
+        return start
+
+    def put(self, row: int, entry: AddressEntry) -> int:
+        # Writes entry at row, or in a new row if row is len(self)
+        name_offset, name_length = self.strings.add(entry.full_name)
+        values = (
+            name_offset,
+            name_length,
+            self._add_addresses(entry.addresses),
+            len(entry.addresses),
+            self._add_phones(entry.phone_numbers),
+            len(entry.phone_numbers),
+            self._add_phones(entry.fax_numbers),
+            len(entry.fax_numbers),
+            self._add_emails(entry.emails),
+            len(entry.emails),
+        )
+        if row == len(self):
+            for column, value in zip(self.entries, values):
+                column.append(value)
+        else:
+            for column, value in zip(self.entries, values):
+                column[row] = value
+
+        self.live_rows += (
+            values[ADDRESSES_COUNT] + values[PHONES_COUNT] +
+            values[FAXES_COUNT] + values[EMAILS_COUNT]
+        )
+        return row
+
+    def release(self, row: int) -> None:
+        # The records of the entry at row become dead
+        entries = self.entries
+        rows = (
+            entries[ADDRESSES_COUNT][row] + entries[PHONES_COUNT][row] +
+            entries[FAXES_COUNT][row] + entries[EMAILS_COUNT][row]
+        )
+        self.live_rows -= rows
+        self.dead_rows += rows
+
+        start = entries[EMAILS_START][row]
+        self.dead_bytes += entries[NAME_LENGTH][row] + sum(
+            self.email_lengths[start:start + entries[EMAILS_COUNT][row]]
+        )
+
+    def get(self, row: int) -> AddressEntry:
+        decode = self.values.decode
+        entry = [column[row] for column in self.entries]
+
+        addresses = []
+        start = entry[ADDRESSES_START]
+        for i in range(start, start + entry[ADDRESSES_COUNT]):
+            addresses.append(Address(
+                KINDS[self.address_kinds[i]],
+                *(decode(column[i]) for column in self.address_fields)
+            ))
+
+        return AddressEntry(
+            self.strings.get(entry[NAME_OFFSET], entry[NAME_LENGTH]),
+            addresses,
+            self._get_phones(entry[PHONES_START], entry[PHONES_COUNT]),
+            self._get_phones(entry[FAXES_START], entry[FAXES_COUNT]),
+            [
+                Email(
+                    KINDS[self.email_kinds[i]],
+                    self.strings.get(
+                        self.email_offsets[i], self.email_lengths[i]
+                    )
+                )
+                for i in range(
+                    entry[EMAILS_START],
+                    entry[EMAILS_START] + entry[EMAILS_COUNT]
+                )
+            ],
+        )
+
+    def _get_phones(self, start: int, count: int) -> List[Phone]:
+        decode = self.values.decode
+        return [
+            Phone(
+                KINDS[self.phone_kinds[i]],
+                decode(self.phone_country_codes[i]),
+                self.phone_local_numbers[i],
+                decode(self.phone_area_codes[i]),
+            )
+            for i in range(start, start + count)
+        ]
+
+
+class ColumnarEntryStore(MutableMapping[str, AddressEntry]):
+    '''
+    Mapping of nickname to AddressEntry that keeps entries in EntryColumns,
+    and builds an AddressEntry on every lookup.
+
+    Entries stored as the JSON they were read from (see
+    LazyAddressEntry.from_json), such as those of a snapshot, are kept as
+    is, so that loading decodes nothing, and looked up as such. Every other
+    write moves COMPACTION_STEP of them into the columns.
+
+    Rows of deleted entries are reused. Once dead records outnumber live
+    ones, entries are moved into new columns, which also drops values no
+    longer used from the dictionary. This is done a few entries at a time,
+    COMPACTION_STEP by every write, so that no write pays for all of them.
+    Until every entry is moved, lookups try the new columns first, and
+    writes go to them.
+    '''
+
+    def __init__(self) -> None:
+        self._rows: Dict[str, int] = {}
+        self._free_rows: List[int] = []
+        self._columns = EntryColumns()
+        # While compacting: the new columns, and the rows and free rows in
+        # them. Entries left in _rows are still to be moved.
+        self._new_columns: Optional[EntryColumns] = None
+        self._new_rows: Dict[str, int] = {}
+        self._new_free_rows: List[int] = []
+        # JSON of the entries not in the columns yet
+        self._raw: Dict[str, bytes] = {}
+
+    def __len__(self) -> int:
+        return len(self._rows) + len(self._new_rows) + len(self._raw)
+
+    def __iter__(self) -> Iterator[str]:
+        return itertools.chain(self._new_rows, self._rows, self._raw)
+
+    def __contains__(self, nickname: object) -> bool:
+        return (
+            nickname in self._new_rows or nickname in self._rows or
+            nickname in self._raw
+        )
+
+    def __getitem__(self, nickname: str) -> AddressEntry:
+        raw = self._raw.get(nickname)
+        if raw is not None:
+            return LazyAddressEntry.from_json(raw)
+        row = self._new_rows.get(nickname)
+        if row is not None and self._new_columns is not None:
+            return self._new_columns.get(row)
+        return self._columns.get(self._rows[nickname])
+
+    def __setitem__(self, nickname: str, entry: AddressEntry) -> None:
+        raw = entry.raw_json if isinstance(entry, LazyAddressEntry) else None
+        if raw is not None:
+            if nickname not in self._raw:
+                self._delete_columns(nickname)
+            self._raw[nickname] = raw
+            return
+
+        self._raw.pop(nickname, None)
+        self._put_columns(nickname, entry)
+        self._written()
+
+    def __delitem__(self, nickname: str) -> None:
+        if nickname in self._raw:
+            del self._raw[nickname]
+            return
+
+        if nickname not in self:
+            raise KeyError(nickname)
+        self._delete_columns(nickname)
+        self._written()
+
+    def _put_columns(self, nickname: str, entry: AddressEntry) -> None:
+        if self._new_columns is None:
+            self._put(
+                self._columns, self._rows, self._free_rows, nickname, entry
+            )
+            return
+
+        # The old row is dropped with the old columns
+        self._rows.pop(nickname, None)
+        self._put(
+            self._new_columns, self._new_rows, self._new_free_rows,
+            nickname, entry
+        )
+
+    def _delete_columns(self, nickname: str) -> None:
+        if self._new_columns is not None and nickname in self._new_rows:
+            row = self._new_rows.pop(nickname)
+            self._new_columns.release(row)
+            self._new_free_rows.append(row)
+        elif nickname in self._rows:
+            row = self._rows.pop(nickname)
+            if self._new_columns is None:
+                self._columns.release(row)
+                self._free_rows.append(row)
+
+    def _written(self) -> None:
+        # After a write to the columns
+        for _ in range(min(COMPACTION_STEP, len(self._raw))):
+            nickname, raw = self._raw.popitem()
+            self._put_columns(nickname, LazyAddressEntry.from_json(raw))
+        if self._new_columns is None:
+            self._maybe_compact()
+        else:
+            self._compact_step()
+
+    @staticmethod
+    def _put(
+        columns: EntryColumns,
+        rows: Dict[str, int],
+        free_rows: List[int],
+        nickname: str,
+        entry: AddressEntry
+    ) -> None:
+        row = rows.get(nickname)
+        if row is not None:
+            columns.release(row)
+        elif free_rows:
+            row = free_rows.pop()
+        else:
+            row = len(columns)
+        rows[nickname] = columns.put(row, entry)
+
+    @property
+    def columns(self) -> EntryColumns:
+        # Those being compacted, until every entry is moved
+        return self._columns
+
+    @property
+    def compacting(self) -> bool:
+        return self._new_columns is not None
+
+    def _maybe_compact(self) -> None:
+        columns = self._columns
+        if (
+            columns.dead_rows >= COMPACTION_MIN_ROWS and
+            columns.dead_rows > columns.live_rows
+        ) or (
+            columns.dead_bytes >= COMPACTION_MIN_BYTES and
+            columns.dead_bytes > len(columns.strings) - columns.dead_bytes
+        ):
+            self._new_columns = EntryColumns()
+            self._compact_step()
+
+    def _compact_step(self, count: int = None) -> None:
+        # Moves up to count (COMPACTION_STEP if None) entries into the new
+        # columns, and swaps them in once all are
+        new_columns = self._new_columns
+        if new_columns is None:
+            return
+        if count is None:
+            count = COMPACTION_STEP
+        for _ in range(count):
+            if not self._rows:
+                break
+            nickname, row = self._rows.popitem()
+            self._put(
+                new_columns, self._new_rows, self._new_free_rows,
+                nickname, self._columns.get(row)
+            )
+
+        if not self._rows:
+            self._columns = new_columns
+            self._rows = self._new_rows
+            self._free_rows = self._new_free_rows
+            self._new_columns = None
+            self._new_rows = {}
+            self._new_free_rows = []
+
+    def compact(self) -> None:
+        # All at once
+        if self._new_columns is None:
+            self._new_columns = EntryColumns()
+        self._compact_step(len(self._rows))
+
+
+class ColumnarAddressBookDB(InMemoryAddressBookDB):
+    '''
+    In-memory address book that stores entries column by column.
+
+    Fields with few distinct values are dictionary encoded, names and
+    emails are packed into one UTF-8 heap, and numbers are kept in arrays.
+    This takes several times less memory than AddressEntry objects, at the
+    cost of building an AddressEntry on every read.
+    '''
+
+    def __init__(
+        self,
+        snapshot_path: str = None,
+        snapshot_interval: float = None,
+        durability: str = DURABILITY_NONE
+    ):
+        super().__init__(snapshot_path, snapshot_interval, durability)
+        self.db = ColumnarEntryStore()
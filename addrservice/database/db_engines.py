@@ -1,17 +1,106 @@
 # Copyright (c) 2020. All rights reserved.
 
-from typing import Dict
+from typing import Any, Callable, Dict, Optional, Type
 
 from addrservice.database.addressbook_db import (
     AbstractAddressBookDB, InMemoryAddressBookDB, FilesystemAddressBookDB
 )
+from addrservice.database.cache_db import CachedAddressBookDB
+from addrservice.database.columnar_db import ColumnarAddressBookDB
+from addrservice.database.file_io import (
+    FILE_IO_POOL_SIZE,
+    FILE_IO_THREADS,
+    FILE_SCAN_CONCURRENCY
+)
+from addrservice.database.search_db import SearchIndexedAddressBookDB
+from addrservice.database.segment_db import SegmentAddressBookDB
+from addrservice.database.sqlite_db import SqliteAddressBookDB
+from addrservice.database.tiered_db import (
+    TIERED_MAX_BYTES, TieredAddressBookDB
+)
+from addrservice.database.wal import DURABILITY_NONE
+
+# Keys under addr-db that configure layers stacked over the DB engine
+DB_LAYERS = ['cache', 'search', 'tiered']
+
+
+def create_memory_db(
+    cls: Type[InMemoryAddressBookDB],
+    cfg: Optional[Dict]
+) -> InMemoryAddressBookDB:
+    # None, or a mapping with the snapshot options
+    if cfg is None:
+        return cls()
+    return cls(
+        snapshot_path=cfg.get('snapshot'),
+        snapshot_interval=cfg.get('snapshot-interval'),
+        durability=cfg.get('durability', DURABILITY_NONE),
+    )
+
+
+def create_fs_db(cfg: Any) -> FilesystemAddressBookDB:
+    # The store directory, or a mapping with it and more options
+    if isinstance(cfg, str):
+        return FilesystemAddressBookDB(cfg)
+    return FilesystemAddressBookDB(
+        cfg['path'],
+        durability=cfg.get('durability', DURABILITY_NONE),
+        io=cfg.get('io', FILE_IO_THREADS),
+        io_threads=cfg.get('io-threads', FILE_IO_POOL_SIZE),
+        scan_concurrency=cfg.get('scan-concurrency', FILE_SCAN_CONCURRENCY),
+        scan_ordered=cfg.get('scan-ordered', False),
+        shards=cfg.get('shards', 0),
+    )
+
+
+def create_segment_db(cfg: Dict) -> SegmentAddressBookDB:
+    return SegmentAddressBookDB(
+        cfg['path'],
+        compaction_ratio=cfg.get('compaction-ratio', 0.5),
+        compaction_min_bytes=cfg.get('compaction-min-bytes', 1024 * 1024),
+        sync=cfg.get('sync', False),
+        read_mode=cfg.get('read-mode', 'pread'),
+    )
+
+
+def create_sqlite_db(cfg: Dict) -> SqliteAddressBookDB:
+    return SqliteAddressBookDB(
+        cfg['path'],
+        readers=cfg.get('readers', 4),
+        sync=cfg.get('sync', False),
+    )
 
 
 def create_addressbook_db(addr_db_config: Dict) -> AbstractAddressBookDB:
-    db_type = list(addr_db_config.keys())[0]
+    db_type = [k for k in addr_db_config if k not in DB_LAYERS][0]
     db_config = addr_db_config[db_type]
 
-    return {
-        'memory': lambda cfg: InMemoryAddressBookDB(),
-        'fs': lambda cfg: FilesystemAddressBookDB(cfg),
-    }[db_type](db_config)
+    db_engines: Dict[str, Callable[[Any], AbstractAddressBookDB]] = {
+        'memory': lambda cfg: create_memory_db(InMemoryAddressBookDB, cfg),
+        'columnar': lambda cfg: create_memory_db(ColumnarAddressBookDB, cfg),
+        'fs': create_fs_db,
+        'segment': create_segment_db,
+        'sqlite': create_sqlite_db,
+    }
+
+    db = db_engines[db_type](db_config)
+
+    if 'tiered' in addr_db_config:
+        tiered_config = addr_db_config['tiered'] or {}
+        db = TieredAddressBookDB(
+            db,
+            max_bytes=tiered_config.get('max-bytes', TIERED_MAX_BYTES),
+        )
+
+    if 'search' in addr_db_config:
+        db = SearchIndexedAddressBookDB(db)
+
+    if 'cache' in addr_db_config:
+        cache_config = addr_db_config['cache'] or {}
+        db = CachedAddressBookDB(
+            db,
+            max_size=cache_config.get('max-size', 1024),
+            ttl=cache_config.get('ttl'),
+        )
+
+    return db
@@ -0,0 +1,302 @@
+# Copyright (c) 2020. All rights reserved.
+
+import aiofiles  # type: ignore
+import asyncio
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+import itertools
+import os
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Deque,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar
+)
+import uuid
+
+T = TypeVar('T')
+
+# Backends of FilesystemAddressBookDB, see make_file_io()
+FILE_IO_THREADS = 'threads'    # a dedicated thread pool, batched calls
+FILE_IO_AIOFILES = 'aiofiles'  # aiofiles, in the default executor
+FILE_IO_BACKENDS = [FILE_IO_THREADS, FILE_IO_AIOFILES]
+
+# Threads of the pool of the 'threads' backend
+FILE_IO_POOL_SIZE = 8
+
+# Files read by one call in a pool thread
+FILE_READ_BATCH = 64
+
+# Batches of files read at once by a directory scan
+FILE_SCAN_CONCURRENCY = 4
+
+
+# Blocking, run in an executor
+
+def read_file(path: str) -> bytes:
+    with open(path, mode='rb') as f:
+        return f.read()
+
+
+def read_files(paths: Sequence[str]) -> List[Optional[bytes]]:
+    # None for each file that does not exist
+    contents: List[Optional[bytes]] = []
+    for path in paths:
+        try:
+            contents.append(read_file(path))
+        except FileNotFoundError:
+            contents.append(None)
+    return contents
+
+
+def replace_file(
+    path: str,
+    data: bytes,
+    touch_dir: Optional[str] = None
+) -> None:
+    # Write a new file and rename it over the old one, so that readers
+    # never see a partial file, and the directory is modified too
+    tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+    with open(tmp_path, mode='wb') as f:
+        f.write(data)
+    rename_file(tmp_path, path, touch_dir)
+
+
+def rename_file(
+    src: str,
+    dst: str,
+    touch_dir: Optional[str] = None
+) -> None:
+    # touch_dir is a directory that is marked as modified too
+    os.replace(src, dst)
+    if touch_dir is not None:
+        os.utime(touch_dir)
+
+
+def remove_file(path: str, touch_dir: Optional[str] = None) -> None:
+    os.remove(path)
+    if touch_dir is not None:
+        os.utime(touch_dir)
+
+
+def list_dir_batch(
+    entries: Iterator[os.DirEntry],
+    suffix: str,
+    size: int
+) -> Tuple[List[str], bool]:
+    # The next file names of a directory listing, and whether it is
+    # exhausted. scandir() gets names without a stat per file.
+    names = []
+    listed = 0
+    for entry in itertools.islice(entries, size):
+        listed += 1
+        if entry.name.endswith(suffix):
+            names.append(entry.name)
+    return names, listed < size
+
+
+class FileIO:
+    '''
+    File operations of FilesystemAddressBookDB, off the event loop.
+
+    Every method runs the blocking calls in an executor, by default the one
+    of the event loop, which is small and shared with everything else in
+    the process. Subclasses pick the executor, and how calls are grouped
+    into executor jobs.
+    '''
+
+    def __init__(self) -> None:
+        self._executor: Optional[Executor] = None
+
+    def start(self) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+    async def run(self, func: Callable[..., T], *args: Any) -> T:
+        return await asyncio.get_event_loop().run_in_executor(
+            self._executor, func, *args
+        )
+
+    async def read(self, path: str) -> bytes:
+        return await self.run(read_file, path)
+
+    async def read_many(self, paths: Sequence[str]) -> List[Optional[bytes]]:
+        # Batches of files are read in parallel
+        batches = await asyncio.gather(*(
+            self.run(read_files, paths[i:i + FILE_READ_BATCH])
+            for i in range(0, len(paths), FILE_READ_BATCH)
+        ))
+        return list(itertools.chain.from_iterable(batches))
+
+    async def write(
+        self,
+        path: str,
+        data: bytes,
+        touch_dir: Optional[str] = None
+    ) -> None:
+        await self.run(replace_file, path, data, touch_dir)
+
+    async def remove(
+        self,
+        path: str,
+        touch_dir: Optional[str] = None
+    ) -> None:
+        await self.run(remove_file, path, touch_dir)
+
+    async def exists(self, path: str) -> bool:
+        return await self.run(os.path.exists, path)
+
+    async def stat(self, path: str) -> os.stat_result:
+        return await self.run(os.stat, path)
+
+    async def _read_named(
+        self,
+        path: str,
+        names: List[str]
+    ) -> List[Tuple[str, bytes]]:
+        contents = await self.read_many(
+            [os.path.join(path, name) for name in names]
+        )
+        # Files deleted since they were listed are skipped
+        return [
+            (name, data) for name, data in zip(names, contents)
+            if data is not None
+        ]
+
+    async def read_dir(
+        self,
+        path: str,
+        suffix: str,
+        concurrency: int = 1,
+        ordered: bool = True
+    ) -> AsyncIterator[List[Tuple[str, bytes]]]:
+        '''
+        (file name, contents) of the files of a directory whose name ends
+        with suffix, in batches of up to FILE_READ_BATCH files.
+
+        The directory is listed lazily, and up to concurrency batches are
+        read at once. Batches are yielded in listing order if ordered, and
+        as soon as they are read otherwise.
+        '''
+        if concurrency < 1:
+            raise ValueError('Invalid scan concurrency {}'.format(
+                concurrency
+            ))
+
+        entries = await self.run(os.scandir, path)
+        reads: Deque['asyncio.Future[List[Tuple[str, bytes]]]'] = deque()
+        try:
+            listed = False
+            while reads or not listed:
+                while not listed and len(reads) < concurrency:
+                    names, listed = await self.run(
+                        list_dir_batch, entries, suffix, FILE_READ_BATCH
+                    )
+                    if names:
+                        reads.append(asyncio.ensure_future(
+                            self._read_named(path, names)
+                        ))
+                if not reads:
+                    break
+
+                if ordered:
+                    read = reads.popleft()
+                else:
+                    done, _ = await asyncio.wait(
+                        reads, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    read = done.pop()
+                    reads.remove(read)
+                batch = await read
+                if batch:
+                    yield batch
+        finally:
+            for read in reads:
+                read.cancel()
+            entries.close()
+
+
+class ThreadPoolFileIO(FileIO):
+    '''
+    Runs file operations in a thread pool of its own, so that they neither
+    wait for nor delay other users of the default executor. stop() shuts
+    the pool down, and start() makes a new one.
+    '''
+
+    def __init__(self, threads: int = FILE_IO_POOL_SIZE) -> None:
+        if threads < 1:
+            raise ValueError('Invalid number of I/O threads {}'.format(
+                threads
+            ))
+        super().__init__()
+        self.threads = threads
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self.start()
+
+    def start(self) -> None:
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(
+                self.threads, thread_name_prefix='fs-io'
+            )
+            self._executor = self._pool
+
+    def stop(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+            self._executor = None
+
+    async def run(self, func: Callable[..., T], *args: Any) -> T:
+        if self._pool is None:
+            raise RuntimeError('File I/O thread pool is shut down')
+        return await super().run(func, *args)
+
+
+class AiofilesFileIO(FileIO):
+    '''
+    Reads and writes files with aiofiles, which sends every open, read,
+    write and close to the default executor on its own.
+    '''
+
+    async def read(self, path: str) -> bytes:
+        async with aiofiles.open(path, mode='rb') as f:
+            return await f.read()
+
+    async def read_many(self, paths: Sequence[str]) -> List[Optional[bytes]]:
+        contents: List[Optional[bytes]] = []
+        for path in paths:
+            try:
+                contents.append(await self.read(path))
+            except FileNotFoundError:
+                contents.append(None)
+        return contents
+
+    async def write(
+        self,
+        path: str,
+        data: bytes,
+        touch_dir: Optional[str] = None
+    ) -> None:
+        tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        async with aiofiles.open(tmp_path, mode='wb') as f:
+            await f.write(data)
+        await self.run(rename_file, tmp_path, path, touch_dir)
+
+
+def make_file_io(
+    backend: str = FILE_IO_THREADS,
+    threads: int = FILE_IO_POOL_SIZE
+) -> FileIO:
+    if backend == FILE_IO_THREADS:
+        return ThreadPoolFileIO(threads)
+    if backend == FILE_IO_AIOFILES:
+        return AiofilesFileIO()
+    raise ValueError('Invalid file I/O backend "{}"'.format(backend))
@@ -0,0 +1,226 @@
+# Copyright (c) 2020. All rights reserved.
+
+'''
+Directory layout of the store of FilesystemAddressBookDB.
+
+A flat store keeps every <nickname>.json in the store directory. A sharded
+store with N shards keeps it in one of N subdirectories, picked by a hash
+of the nickname, so that no directory holds more than a fraction of the
+entries. A sharded store records its number of shards in LAYOUT_FILE_NAME;
+a flat store has no such file. While a migration runs, the file also
+records the numbers of shards that the store had before, whose
+directories may still hold entries.
+
+To change the layout of a store, stop every process using it, then run:
+
+    python3 -m addrservice.database.fs_layout /tmp/addrservice-db -s 256
+
+-s 0 makes the store flat again.
+'''
+
+import argparse
+import json
+import os
+import sys
+from typing import Dict, Iterable, Iterator, List, Tuple
+import zlib
+
+from addrservice.database.file_io import replace_file
+from addrservice.database.wal import WriteAheadLog
+
+LAYOUT_FILE_NAME = 'addresses.layout'
+
+# Write-ahead log of the store, see FilesystemAddressBookDB
+WAL_FILE_NAME = 'addresses.wal'
+
+ENTRY_FILE_SUFFIX = '.json'
+
+
+def shard_names(shards: int) -> List[str]:
+    # Hex digits, zero padded to the same width
+    width = len('{:x}'.format(max(shards - 1, 0)))
+    return ['{:0{}x}'.format(i, width) for i in range(shards)]
+
+
+def shard_of(nickname: str, shards: int) -> int:
+    # Stable across processes and runs, unlike hash()
+    return zlib.crc32(nickname.encode('utf-8')) % shards
+
+
+def entry_dirs(store: str, shards: int) -> List[str]:
+    '''Directories that hold the entry files of a store.'''
+    if shards == 0:
+        return [store]
+    return [os.path.join(store, name) for name in shard_names(shards)]
+
+
+def read_layout(store: str) -> Dict:
+    try:
+        with open(os.path.join(store, LAYOUT_FILE_NAME), mode='rb') as f:
+            return json.loads(f.read())
+    except FileNotFoundError:
+        return {'shards': 0}
+
+
+def write_layout(store: str, layout: Dict) -> None:
+    replace_file(
+        os.path.join(store, LAYOUT_FILE_NAME), json.dumps(layout).encode()
+    )
+    sync_dir(store)
+
+
+def sync_dir(path: str) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def has_entries(path: str) -> bool:
+    with os.scandir(path) as entries:
+        return any(
+            entry.name.endswith(ENTRY_FILE_SUFFIX) for entry in entries
+        )
+
+
+def open_layout(store: str, shards: int) -> None:
+    '''
+    Checks that a store has the given number of shards. A flat store
+    without entries, such as a new one, is given that many.
+    '''
+    if shards < 0:
+        raise ValueError('Invalid number of shards {}'.format(shards))
+
+    layout = read_layout(store)
+    if layout.get('migrating'):
+        raise ValueError(
+            'Layout migration of store "{}" did not finish, run '
+            'addrservice.database.fs_layout again'.format(store)
+        )
+    if layout['shards'] == shards:
+        return
+    if layout['shards'] != 0 or has_entries(store):
+        raise ValueError(
+            'Store "{}" has {} shards, not {}, migrate it with '
+            'addrservice.database.fs_layout'.format(
+                store, layout['shards'], shards
+            )
+        )
+    migrate(store, shards)
+
+
+def find_entry_files(
+    store: str,
+    layouts: Iterable[int]
+) -> Iterator[Tuple[str, str]]:
+    # (nickname, path) of entry files in the directories of the layouts
+    # with these numbers of shards
+    dirs = {path for shards in layouts for path in entry_dirs(store, shards)}
+    for path in sorted(dirs):
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.name.endswith(ENTRY_FILE_SUFFIX):
+                        name = entry.name[:-len(ENTRY_FILE_SUFFIX)]
+                        yield name, entry.path
+        except FileNotFoundError:
+            # Removed by an interrupted migration, or never made
+            continue
+
+
+def migrate(store: str, shards: int) -> int:
+    '''
+    Moves the entry files of a store into the layout with the given number
+    of shards, and returns the number of files moved.
+
+    Files are renamed, never copied. The layout file is marked as migrating
+    first, with the numbers of shards the store had, so that the engine
+    refuses to open the store until a migration finishes; if one is
+    interrupted, running it again completes it. Only the shard directories
+    of those layouts are read and removed, so other directories in the store
+    are left alone. No other process may use the store meanwhile. The
+    write-ahead log, if any, is locked to check that.
+    '''
+    if shards < 0:
+        raise ValueError('Invalid number of shards {}'.format(shards))
+
+    wal_path = os.path.join(store, WAL_FILE_NAME)
+    wal = None
+    if os.path.exists(wal_path):
+        wal = WriteAheadLog(wal_path)
+        # Raises if an engine has it open. Records left in it are replayed
+        # by the engine into the new layout.
+        wal.open()
+    try:
+        layout = read_layout(store)
+        # An interrupted migration may have left entries in the layout it
+        # was migrating to, and in those it was migrating from
+        old_layouts = {layout['shards']}
+        if layout.get('migrating'):
+            old_layouts.update(layout.get('from', []))
+        write_layout(store, {
+            'shards': shards,
+            'migrating': True,
+            'from': sorted(old_layouts)
+        })
+        dirs = entry_dirs(store, shards)
+        for path in dirs:
+            os.makedirs(path, exist_ok=True)
+
+        moved = 0
+        for nickname, path in list(find_entry_files(store, old_layouts)):
+            target = os.path.join(
+                dirs[shard_of(nickname, shards)] if shards else store,
+                nickname + ENTRY_FILE_SUFFIX
+            )
+            if path != target:
+                os.replace(path, target)
+                moved += 1
+        for path in set(dirs) | {store}:
+            sync_dir(path)
+
+        # Shard directories of the old layouts are empty now
+        old_dirs = {
+            path for old_shards in old_layouts
+            for path in entry_dirs(store, old_shards)
+        } - set(dirs) - {store}
+        for path in sorted(old_dirs):
+            if os.path.isdir(path) and not has_entries(path):
+                for name in os.listdir(path):
+                    os.remove(os.path.join(path, name))
+                os.rmdir(path)
+
+        if shards == 0:
+            os.remove(os.path.join(store, LAYOUT_FILE_NAME))
+            sync_dir(store)
+        else:
+            write_layout(store, {'shards': shards})
+        return moved
+    finally:
+        if wal is not None:
+            wal.close()
+
+
+def main(args=None) -> None:
+    parser = argparse.ArgumentParser(
+        description='Change the directory layout of an fs address book store'
+    )
+    parser.add_argument('store', help='store directory')
+    parser.add_argument(
+        '-s', '--shards',
+        type=int,
+        required=True,
+        help='number of shard directories, 0 for a flat store'
+    )
+    args = parser.parse_args(args)
+
+    try:
+        moved = migrate(os.path.abspath(args.store), args.shards)
+    except (OSError, RuntimeError, ValueError) as e:
+        sys.exit('Migration failed: {}'.format(e))
+    print('Moved {} entries into {} shards'.format(moved, args.shards))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,412 @@
+# Copyright (c) 2020. All rights reserved.
+
+from bisect import bisect_left, bisect_right, insort
+import heapq
+import re
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Tuple
+)
+
+from addrservice.datamodel import AddressEntry
+
+# Fields that entries can be looked up by
+INDEXED_FIELDS = ['email', 'phone', 'city', 'pincode']
+
+# Weights of the words of the searchable fields in search scores
+SEARCH_NAME_WEIGHT = 3
+SEARCH_ADDRESS_WEIGHT = 1
+
+SEARCH_WORD_REGEX = re.compile(r'\w+')
+
+
+class SortedKeyIndex:
+    '''
+    Keys kept in sorted order, split into buckets of a bounded size so that
+    an insert or delete moves O(bucket) items instead of O(index).
+
+    Serves keyset pagination: a page of keys after a given key costs
+    O(log n + page size).
+    '''
+
+    BUCKET_SIZE = 1024
+
+    def __init__(self, keys: Iterable[str] = ()) -> None:
+        all_keys = sorted(set(keys))
+        size = self.BUCKET_SIZE
+        self._buckets: List[List[str]] = [
+            all_keys[i:i + size] for i in range(0, len(all_keys), size)
+        ]
+        self._maxes: List[str] = [b[-1] for b in self._buckets]
+        self._len = len(all_keys)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __contains__(self, key: object) -> bool:
+        if not isinstance(key, str) or not self._buckets:
+            return False
+        i = bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            return False
+        bucket = self._buckets[i]
+        j = bisect_left(bucket, key)
+        return j < len(bucket) and bucket[j] == key
+
+    def __iter__(self) -> Iterator[str]:
+        for bucket in self._buckets:
+            yield from bucket
+
+    def add(self, key: str) -> None:
+        if not self._buckets:
+            self._buckets.append([key])
+            self._maxes.append(key)
+            self._len = 1
+            return
+
+        i = bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            # Beyond the last key: append to the last bucket
+            i -= 1
+            self._buckets[i].append(key)
+            self._maxes[i] = key
+        else:
+            bucket = self._buckets[i]
+            j = bisect_left(bucket, key)
+            if j < len(bucket) and bucket[j] == key:
+                return
+            insort(bucket, key)
+
+        self._len += 1
+
+        bucket = self._buckets[i]
+        if len(bucket) > 2 * self.BUCKET_SIZE:
+            half = len(bucket) // 2
+            self._buckets[i:i + 1] = [bucket[:half], bucket[half:]]
+            self._maxes[i:i + 1] = [bucket[half - 1], bucket[-1]]
+
+    def discard(self, key: str) -> None:
+        i = bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            return
+        bucket = self._buckets[i]
+        j = bisect_left(bucket, key)
+        if j == len(bucket) or bucket[j] != key:
+            return
+
+        del bucket[j]
+        self._len -= 1
+        if not bucket:
+            del self._buckets[i]
+            del self._maxes[i]
+        elif j == len(bucket):
+            self._maxes[i] = bucket[-1]
+
+    def page(self, limit: int, after: Optional[str] = None) -> List[str]:
+        '''Up to limit keys greater than after (from the first if None).'''
+        if after is None:
+            i, j = 0, 0
+        else:
+            i = bisect_right(self._maxes, after)
+            j = 0 if i == len(self._maxes) else bisect_right(
+                self._buckets[i], after
+            )
+
+        keys: List[str] = []
+        while i < len(self._buckets) and len(keys) < limit:
+            bucket = self._buckets[i]
+            keys.extend(bucket[j:j + limit - len(keys)])
+            i, j = i + 1, 0
+
+        return keys
+
+    def between(
+        self,
+        after: Optional[str] = None,
+        last: Optional[str] = None
+    ) -> Iterator[str]:
+        '''Keys greater than after and up to last (unbounded if None).'''
+        if after is None:
+            i, j = 0, 0
+        else:
+            i = bisect_right(self._maxes, after)
+            j = 0 if i == len(self._maxes) else bisect_right(
+                self._buckets[i], after
+            )
+        while i < len(self._buckets):
+            bucket = self._buckets[i]
+            while j < len(bucket):
+                if last is not None and bucket[j] > last:
+                    return
+                yield bucket[j]
+                j += 1
+            i, j = i + 1, 0
+
+    def prefixed(self, prefix: str) -> Iterator[str]:
+        '''Keys that start with prefix, in order.'''
+        i = bisect_left(self._maxes, prefix)
+        j = 0 if i == len(self._maxes) else bisect_left(
+            self._buckets[i], prefix
+        )
+        while i < len(self._buckets):
+            bucket = self._buckets[i]
+            while j < len(bucket):
+                if not bucket[j].startswith(prefix):
+                    return
+                yield bucket[j]
+                j += 1
+            i, j = i + 1, 0
+
+
+def index_key(field: str, value: Any) -> Tuple[str, str]:
+    '''
+    Normalizes a value of an indexed field, as found in an entry or given in
+    a query: emails and cities are case-insensitive, spaces in pincodes and
+    everything but the digits in phone numbers are ignored.
+    '''
+    text = str(value).strip()
+    if field == 'phone':
+        text = ''.join(c for c in text if c.isdigit())
+    elif field == 'pincode':
+        text = ''.join(text.split()).casefold()
+    else:
+        text = text.casefold()
+    return field, text
+
+
+def check_criteria(criteria: Mapping[str, Any]) -> None:
+    for field in criteria:
+        if field not in INDEXED_FIELDS:
+            raise ValueError('{} is not an indexed field'.format(field))
+    if not criteria:
+        raise ValueError('No criteria')
+
+
+def entry_index_keys(entry: AddressEntry) -> Set[Tuple[str, str]]:
+    keys = {index_key('email', email.email) for email in entry.emails}
+    for phone in list(entry.phone_numbers) + list(entry.fax_numbers):
+        # Country code, area code and local number, as one string of digits
+        keys.add(index_key('phone', '{}{}{}'.format(
+            phone.country_code,
+            '' if phone.area_code is None else phone.area_code,
+            phone.local_number
+        )))
+    for addr in entry.addresses:
+        if addr.city is not None:
+            keys.add(index_key('city', addr.city))
+        keys.add(index_key('pincode', addr.pincode))
+    return keys
+
+
+class SecondaryIndex:
+    '''
+    Nicknames of the entries with each value of the INDEXED_FIELDS.
+
+    The keys of each entry are remembered, so that put() and discard() do
+    not need the entry being replaced. A lookup costs O(matches).
+    '''
+
+    def __init__(self) -> None:
+        self._nicknames: Dict[Tuple[str, str], Set[str]] = {}
+        self._keys: Dict[str, Set[Tuple[str, str]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, nickname: object) -> bool:
+        return nickname in self._keys
+
+    def put(self, nickname: str, entry: AddressEntry) -> None:
+        self.discard(nickname)
+        keys = entry_index_keys(entry)
+        self._keys[nickname] = keys
+        for key in keys:
+            self._nicknames.setdefault(key, set()).add(nickname)
+
+    def discard(self, nickname: str) -> None:
+        for key in self._keys.pop(nickname, ()):
+            nicknames = self._nicknames[key]
+            nicknames.discard(nickname)
+            if not nicknames:
+                del self._nicknames[key]
+
+    def find(self, criteria: Mapping[str, Any]) -> Set[str]:
+        '''Nicknames of the entries that match all field values.'''
+        check_criteria(criteria)
+
+        matches = sorted(
+            (
+                self._nicknames.get(index_key(field, value), set())
+                for field, value in criteria.items()
+            ),
+            key=len
+        )
+        # Intersection iterates over the smaller set
+        return matches[0].intersection(*matches[1:])
+
+
+def search_words(text: str) -> List[str]:
+    return SEARCH_WORD_REGEX.findall(text.casefold())
+
+
+def entry_search_words(entry: AddressEntry) -> Dict[str, int]:
+    '''
+    Words of the full name, street names and localities of an entry, with
+    the weight of the field each was found in (the highest, if several).
+    '''
+    words: Dict[str, int] = {}
+    for addr in entry.addresses:
+        for text in (addr.street_name, addr.locality):
+            for word in search_words(text or ''):
+                words[word] = SEARCH_ADDRESS_WEIGHT
+    for word in search_words(entry.full_name):
+        words[word] = SEARCH_NAME_WEIGHT
+    return words
+
+
+def search_score(terms: Iterable[str], words: Mapping[str, int]) -> int:
+    '''
+    Score of an entry with the given words for the search terms, 0 if some
+    term is not a prefix of any word. Each term adds the weight of the best
+    word it matches, doubled if it matches the whole word.
+    '''
+    score = 0
+    for term in terms:
+        best = 0
+        for word, weight in words.items():
+            if word.startswith(term):
+                best = max(best, 2 * weight if word == term else weight)
+        if best == 0:
+            return 0
+        score += best
+    return score
+
+
+def top_scored(scored: Iterable[Tuple[int, str]], limit: int) -> List[str]:
+    # Nicknames of the limit best (score, nickname), by score then nickname
+    top = heapq.nsmallest(
+        limit,
+        ((-score, nickname) for score, nickname in scored if score > 0)
+    )
+    return [nickname for _, nickname in top]
+
+
+class SearchIndex:
+    '''
+    Prefix search over the words of full names, street names and
+    localities, ranked by search_score.
+
+    For each field weight, an inverted index maps each word to the
+    nicknames of the entries that have it, and the sorted list of words
+    finds the words with a prefix. The entries a term matches thus fall in
+    tiers by score: whole name word, name word prefix, whole address word,
+    address word prefix. Searches work on these tiers with set operations,
+    rather than score every match of a common term one by one.
+    '''
+
+    def __init__(self) -> None:
+        self._fields: Dict[int, Tuple[Dict[str, Set[str]], SortedKeyIndex]] = {
+            weight: ({}, SortedKeyIndex())
+            for weight in (SEARCH_NAME_WEIGHT, SEARCH_ADDRESS_WEIGHT)
+        }
+        self._entry_words: Dict[str, Dict[str, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entry_words)
+
+    def __contains__(self, nickname: object) -> bool:
+        return nickname in self._entry_words
+
+    def put(self, nickname: str, entry: AddressEntry) -> None:
+        self.discard(nickname)
+        words = entry_search_words(entry)
+        self._entry_words[nickname] = words
+        for word, weight in words.items():
+            postings, sorted_words = self._fields[weight]
+            nicknames = postings.get(word)
+            if nicknames is None:
+                nicknames = postings[word] = set()
+                sorted_words.add(word)
+            nicknames.add(nickname)
+
+    def discard(self, nickname: str) -> None:
+        for word, weight in self._entry_words.pop(nickname, {}).items():
+            postings, sorted_words = self._fields[weight]
+            nicknames = postings[word]
+            nicknames.discard(nickname)
+            if not nicknames:
+                del postings[word]
+                sorted_words.discard(word)
+
+    def _tiers(self, term: str) -> List[Tuple[int, Set[str]]]:
+        # (score, nicknames) of the entries term matches, best score first.
+        # An entry is in every tier it qualifies for; its score is that of
+        # the first.
+        tiers = []
+        for weight, (postings, sorted_words) in self._fields.items():
+            exact = postings.get(term)
+            if exact:
+                tiers.append((2 * weight, exact))
+            prefixed = [
+                postings[word] for word in sorted_words.prefixed(term)
+                if word != term
+            ]
+            if len(prefixed) == 1:
+                tiers.append((weight, prefixed[0]))
+            elif prefixed:
+                tiers.append((weight, set.union(*prefixed)))
+        tiers.sort(key=lambda tier: -tier[0])
+        return tiers
+
+    def search(self, query: str, limit: int) -> List[str]:
+        '''Nicknames of the limit best matches of query, best first.'''
+        terms = set(search_words(query))
+        tiers = {term: self._tiers(term) for term in terms}
+        if not terms or not all(tiers.values()):
+            return []
+
+        if len(terms) == 1:
+            # Whole tiers, in order, each by nickname
+            results: List[str] = []
+            seen: Set[str] = set()
+            for _, nicknames in next(iter(tiers.values())):
+                fresh = nicknames - seen if seen else nicknames
+                results.extend(heapq.nsmallest(limit - len(results), fresh))
+                if len(results) >= limit:
+                    break
+                seen |= nicknames
+            return results
+
+        # Entries that match all terms, starting from the term with the
+        # fewest matches. Only these are scored one by one.
+        ordered = sorted(
+            terms, key=lambda term: sum(len(n) for _, n in tiers[term])
+        )
+        candidates: Set[str] = set()
+        candidates.update(*(n for _, n in tiers[ordered[0]]))
+        for term in ordered[1:]:
+            matched: Set[str] = set()
+            for _, nicknames in tiers[term]:
+                matched |= candidates & nicknames
+            candidates = matched
+
+        return top_scored(
+            (
+                (
+                    sum(
+                        next(s for s, n in tiers[term] if nickname in n)
+                        for term in terms
+                    ),
+                    nickname
+                )
+                for nickname in candidates
+            ),
+            limit
+        )
@@ -0,0 +1,55 @@
+# Copyright (c) 2020. All rights reserved.
+
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Iterable, List
+
+
+class _KeyLock:
+    __slots__ = ('lock', 'users')
+
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        # Tasks holding or awaiting the lock
+        self.users = 0
+
+
+class KeyLocks:
+    '''
+    An asyncio lock per key, such as the nickname of an entry, so that
+    checking an entry and writing it is not interleaved with other writes
+    of the same entry.
+
+    A lock is made when first needed, and dropped once no task holds it or
+    waits for it.
+    '''
+
+    def __init__(self) -> None:
+        self._locks: Dict[str, _KeyLock] = {}
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def hold(self, keys: Iterable[str]) -> AsyncIterator[None]:
+        # Taken in key order, so that tasks holding several do not deadlock
+        ordered = sorted(set(keys))
+        used: List[_KeyLock] = []
+        acquired: List[_KeyLock] = []
+        try:
+            for key in ordered:
+                key_lock = self._locks.get(key)
+                if key_lock is None:
+                    key_lock = self._locks[key] = _KeyLock()
+                key_lock.users += 1
+                used.append(key_lock)
+                await key_lock.lock.acquire()
+                acquired.append(key_lock)
+            yield
+        finally:
+            for key_lock in acquired:
+                key_lock.lock.release()
+            for key, key_lock in zip(ordered, used):
+                key_lock.users -= 1
+                if key_lock.users == 0:
+                    del self._locks[key]
@@ -0,0 +1,55 @@
+# Copyright (c) 2020. All rights reserved.
+
+import struct
+from typing import BinaryIO, Iterator, Tuple
+import zlib
+
+# Record layout: crc32 | op | key length | value length | key | value
+# The crc covers everything after it, so a torn write at the tail of a file
+# of records is detected (and dropped) when the file is replayed.
+RECORD_CRC = struct.Struct('<I')
+RECORD_HEADER = struct.Struct('<BHI')
+RECORD_PREFIX_SIZE = RECORD_CRC.size + RECORD_HEADER.size
+
+OP_PUT = 1
+OP_DELETE = 2
+
+
+def encode_record(op: int, key: bytes, value: bytes = b'') -> bytes:
+    body = RECORD_HEADER.pack(op, len(key), len(value)) + key + value
+    return RECORD_CRC.pack(zlib.crc32(body)) + body
+
+
+def record_crc(record: bytes) -> int:
+    (crc,) = RECORD_CRC.unpack_from(record)
+    return crc
+
+
+def record_op(record: bytes) -> int:
+    op, _, _ = RECORD_HEADER.unpack_from(record, RECORD_CRC.size)
+    return op
+
+
+def read_records(
+    f: BinaryIO
+) -> Iterator[Tuple[int, bytes, bytes, int, int]]:
+    '''
+    (op, key, value, crc, end offset) of each record of a file, from the
+    current position up to the first torn or corrupt record.
+    '''
+    offset = 0
+    while True:
+        prefix = f.read(RECORD_PREFIX_SIZE)
+        if len(prefix) < RECORD_PREFIX_SIZE:
+            return
+        (crc,) = RECORD_CRC.unpack_from(prefix)
+        op, key_len, value_len = RECORD_HEADER.unpack_from(
+            prefix, RECORD_CRC.size
+        )
+        data = f.read(key_len + value_len)
+        if len(data) < key_len + value_len:
+            return
+        if zlib.crc32(prefix[RECORD_CRC.size:] + data) != crc:
+            return
+        offset += RECORD_PREFIX_SIZE + key_len + value_len
+        yield op, data[:key_len], data[key_len:], crc, offset
@@ -0,0 +1,176 @@
+# Copyright (c) 2020. All rights reserved.
+
+import asyncio
+from typing import (
+    Any,
+    AsyncIterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple
+)
+
+from addrservice.database.addressbook_db import (
+    AbstractAddressBookDB, AddressWrite, WRITE_DELETE
+)
+from addrservice.database.indexes import SearchIndex
+from addrservice.datamodel import AddressEntry
+
+
+class SearchIndexedAddressBookDB(AbstractAddressBookDB):
+    '''
+    Layer that keeps a SearchIndex of the entries of another DB, and serves
+    search_nicknames from it.
+
+    The index is built by scanning the DB on the first search, then kept up
+    to date by the writes made through this layer. Writes made by other
+    processes to a shared DB (fs) are not seen.
+    '''
+
+    def __init__(self, db: AbstractAddressBookDB):
+        self.db = db
+        self._index: Optional[SearchIndex] = None
+        self._index_build: Optional['asyncio.Future[SearchIndex]'] = None
+        # Nicknames deleted while the index is built, which the scan may
+        # have read before they were deleted
+        self._deleted: Set[str] = set()
+
+    def start(self):
+        self.db.start()
+
+    def stop(self):
+        self.db.stop()
+
+    def _put(self, nickname: str, addr: AddressEntry) -> None:
+        if self._index is not None:
+            self._index.put(nickname, addr)
+            self._deleted.discard(nickname)
+
+    def _discard(self, nickname: str) -> None:
+        if self._index is not None:
+            self._index.discard(nickname)
+        if self._index_build is not None and not self._index_build.done():
+            self._deleted.add(nickname)
+
+    def _reset(self) -> None:
+        # The index is rebuilt by the next search
+        self._index = None
+        self._index_build = None
+        self._deleted = set()
+
+    # CRUD
+
+    async def create_address(
+        self,
+        addr: AddressEntry,
+        nickname: str = None
+    ) -> str:
+        nickname = await self.db.create_address(addr, nickname)
+        self._put(nickname, addr)
+        return nickname
+
+    async def read_address(self, nickname: str) -> AddressEntry:
+        return await self.db.read_address(nickname)
+
+    async def read_address_raw(self, nickname: str) -> bytes:
+        return await self.db.read_address_raw(nickname)
+
+    async def read_address_version(self, nickname: str) -> str:
+        return await self.db.read_address_version(nickname)
+
+    async def update_address(
+        self,
+        nickname: str,
+        addr: AddressEntry,
+        if_match: Sequence[str] = None
+    ) -> None:
+        await self.db.update_address(nickname, addr, if_match)
+        self._put(nickname, addr)
+
+    async def delete_address(
+        self,
+        nickname: str,
+        if_match: Sequence[str] = None
+    ) -> None:
+        await self.db.delete_address(nickname, if_match)
+        self._discard(nickname)
+
+    async def read_all_addresses(
+        self
+    ) -> AsyncIterator[Tuple[str, AddressEntry]]:
+        async for nickname, addr in self.db.read_all_addresses():
+            yield nickname, addr
+
+    async def read_all_addresses_raw(
+        self
+    ) -> AsyncIterator[Tuple[str, bytes]]:
+        async for nickname, addr in self.db.read_all_addresses_raw():
+            yield nickname, addr
+
+    async def read_addresses_version(self) -> str:
+        return await self.db.read_addresses_version()
+
+    async def read_addresses_page(
+        self,
+        limit: int,
+        after: str = None
+    ) -> List[Tuple[str, AddressEntry]]:
+        return await self.db.read_addresses_page(limit, after)
+
+    async def read_addresses_page_raw(
+        self,
+        limit: int,
+        after: str = None
+    ) -> List[Tuple[str, bytes]]:
+        return await self.db.read_addresses_page_raw(limit, after)
+
+    # Queries
+
+    async def find_nicknames(self, criteria: Mapping[str, Any]) -> List[str]:
+        return await self.db.find_nicknames(criteria)
+
+    async def _build_index(self, index: SearchIndex) -> SearchIndex:
+        # Writes made during the scan go to the index directly, and are
+        # newer than what the scan read.
+        try:
+            async for nickname, addr in self.db.read_all_addresses():
+                if nickname not in index and nickname not in self._deleted:
+                    index.put(nickname, addr)
+            self._deleted = set()
+            return index
+        except BaseException:
+            self._reset()
+            raise
+
+    async def search_nicknames(self, query: str, limit: int) -> List[str]:
+        if self._index_build is None:
+            self._index = SearchIndex()
+            self._index_build = asyncio.ensure_future(
+                self._build_index(self._index)
+            )
+        index = await asyncio.shield(self._index_build)
+        return index.search(query, limit)
+
+    # Batches
+
+    async def write_addresses(
+        self,
+        writes: Sequence[AddressWrite]
+    ) -> List[Optional[KeyError]]:
+        try:
+            results = await self.db.write_addresses(writes)
+        except BaseException:
+            # Some of the writes may have been made
+            self._reset()
+            raise
+
+        for write, error in zip(writes, results):
+            if error is not None:
+                continue
+            if write.op == WRITE_DELETE:
+                self._discard(write.nickname)
+            elif write.addr is not None:
+                self._put(write.nickname, write.addr)
+        return results
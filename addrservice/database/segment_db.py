@@ -0,0 +1,725 @@
+# Copyright (c) 2020. All rights reserved.
+
+import asyncio
+import itertools
+import json
+import mmap
+import os
+from typing import (
+    Any,
+    AsyncIterator,
+    BinaryIO,
+    Callable,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TypeVar
+)
+import uuid
+
+from addrservice.database.addressbook_db import (
+    AbstractAddressBookDB,
+    AddressWrite,
+    VersionMismatchError,
+    WRITE_CREATE,
+    WRITE_DELETE,
+    WRITE_UPDATE,
+    check_version,
+    encode_entry,
+)
+from addrservice.database.fs_layout import sync_dir
+from addrservice.database.indexes import SecondaryIndex, SortedKeyIndex
+from addrservice.database.records import (
+    OP_DELETE,
+    OP_PUT,
+    RECORD_CRC,
+    RECORD_HEADER,
+    RECORD_PREFIX_SIZE,
+    encode_record,
+    read_records,
+    record_crc,
+    record_op,
+)
+from addrservice.datamodel import AddressEntry, LazyAddressEntry
+
+READ_MODES = ['pread', 'mmap']
+
+SCAN_CHUNK_SIZE = 1024 * 1024
+# Records copied by compaction per executor job
+COMPACTION_BATCH = 1000
+
+T = TypeVar('T')
+
+# (offset, length, crc) of the value of an entry in the segment
+IndexEntry = Tuple[int, int, int]
+
+# (seq, nickname, record, entry put by the record)
+QueuedRecord = Tuple[int, str, bytes, Optional[AddressEntry]]
+
+
+class SegmentFile:
+    '''
+    A segment file open for reading and appending, and its memory mapping
+    in read mode 'mmap'.
+
+    Scans hold the segment file they began on with acquire() and release().
+    Once compaction has swapped in a new one, retire() closes the old one,
+    right away or when the last scan holding it is done.
+    '''
+
+    def __init__(self, path: str, read_mode: str) -> None:
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.read_mode = read_mode
+        self._mmap: Optional[mmap.mmap] = None
+        self._readers = 0
+        self._retired = False
+
+    def acquire(self) -> 'SegmentFile':
+        self._readers += 1
+        return self
+
+    def release(self) -> None:
+        self._readers -= 1
+        if self._retired and self._readers == 0:
+            self._close()
+
+    def retire(self) -> None:
+        self._retired = True
+        if self._readers == 0:
+            self._close()
+
+    def _close(self) -> None:
+        self._unmap()
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def _unmap(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def read_at(self, offset: int, length: int) -> bytes:
+        if self.read_mode == 'pread':
+            return os.pread(self.fd, length, offset)
+
+        if self._mmap is None or offset + length > len(self._mmap):
+            # Values are only sliced out as bytes, and no buffer exported
+            # from the old mapping outlives a call, so it can be closed.
+            self._unmap()
+            self._mmap = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+        return self._mmap[offset:offset + length]
+
+
+# Compaction, blocking, run in an executor
+
+def copy_records(
+    fd: int,
+    out: BinaryIO,
+    entries: Sequence[Tuple[str, IndexEntry]],
+    new_index: Dict[str, IndexEntry],
+    new_size: int
+) -> int:
+    # Appends the values at entries in the segment of fd to out, which is
+    # new_size bytes long, as put records indexed in new_index. Returns the
+    # new size of out.
+    for nickname, (offset, length, crc) in entries:
+        key = nickname.encode('utf-8')
+        out.write(encode_record(OP_PUT, key, os.pread(fd, length, offset)))
+        new_size += RECORD_PREFIX_SIZE + len(key)
+        new_index[nickname] = (new_size, length, crc)
+        new_size += length
+    return new_size
+
+
+def create_file(path: str) -> BinaryIO:
+    return open(path, mode='wb')
+
+
+def sync_file(out: BinaryIO) -> None:
+    out.flush()
+    os.fsync(out.fileno())
+
+
+def replace_segment(
+    out: BinaryIO,
+    tail: bytes,
+    tmp_path: str,
+    path: str
+) -> None:
+    out.write(tail)
+    sync_file(out)
+    out.close()
+    os.replace(tmp_path, path)
+    sync_dir(os.path.dirname(path))
+
+
+def discard_file(out: Optional[BinaryIO], path: str) -> None:
+    if out is not None:
+        out.close()
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class SegmentAddressBookDB(AbstractAddressBookDB):
+    '''
+    Stores all entries in one append-only segment file.
+
+    Every create, update and delete appends a record; an in-memory index
+    maps each nickname to the offset, length and crc of its latest value,
+    so a point read is a single pread(). The crc doubles as the version of
+    the entry: it changes with the content and survives compaction. Full
+    scans read the segment in offset order. Space held by overwritten and
+    deleted records is reclaimed by compact(), which runs in the background
+    once garbage crosses the configured ratio.
+
+    In read mode 'mmap' the segment is also mapped read-only into memory
+    and values are sliced out of the mapping without a system call. The
+    mapping is extended when a read goes past its end. Writes always go
+    through the file descriptor, with an fsync when sync is set.
+
+    Records are appended off the event loop, in the default executor. The
+    records of writes made while an append runs go to the segment together
+    in the next one, with one fsync when sync is set (group commit). A
+    write returns once its record is written and in the index.
+
+    Compaction copies records in the default executor too. Writes only
+    wait for it while the entries they made during the copy are recopied
+    and the new segment is swapped in; scans keep reading the old one.
+
+    The segment is opened and replayed by start() and closed by stop().
+    Only one process may open a segment at a time.
+    '''
+
+    def __init__(
+        self,
+        path: str,
+        compaction_ratio: float = 0.5,
+        compaction_min_bytes: int = 1024 * 1024,
+        sync: bool = False,
+        read_mode: str = 'pread',
+    ):
+        if read_mode not in READ_MODES:
+            raise ValueError('Invalid read mode "{}"'.format(read_mode))
+
+        self._path = os.path.abspath(path)
+        store_dir = os.path.dirname(self._path)
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        if not (os.path.isdir(store_dir) and os.access(store_dir, os.W_OK)):
+            raise ValueError(
+                'Segment directory "{}" is not a writable directory'.format(
+                    store_dir
+                )
+            )
+
+        self.compaction_ratio = compaction_ratio
+        self.compaction_min_bytes = compaction_min_bytes
+        self.compaction_batch = COMPACTION_BATCH
+        self.sync = sync
+        self.read_mode = read_mode
+        self.appends = 0
+
+        self._file: Optional[SegmentFile] = None
+        self._size = 0
+        self._live_bytes = 0
+        self._index: Dict[str, IndexEntry] = {}
+        self.nicknames = SortedKeyIndex()
+        # Built on the first query
+        self._secondary: Optional[SecondaryIndex] = None
+
+        self._instance_id = uuid.uuid4().hex[:8]
+        self._writes = 0
+        # Records waiting for the next append, and for each nickname they
+        # write, the last of them and whether the entry then exists
+        self._queued: List[QueuedRecord] = []
+        self._pending: Dict[str, Tuple[int, bool]] = {}
+        self._seqs = itertools.count()
+        # Waited on by the writes queued since the running append began
+        self._next_append: Optional[asyncio.Future] = None
+        self._appending: Optional[asyncio.Future] = None
+        # Set while compaction swaps segments, during which nothing is
+        # appended
+        self._appends_held = False
+        self._compaction: Optional[asyncio.Future] = None
+        self._compaction_dirty: Optional[Set[str]] = None
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def garbage_bytes(self) -> int:
+        return self._size - self._live_bytes
+
+    def start(self):
+        if self._file is None:
+            self._load()
+
+    def stop(self):
+        if self._compaction is not None:
+            self._compaction.cancel()
+        # Scans and a compaction still running hold it open until done
+        if self._file is not None:
+            self._file.retire()
+            self._file = None
+
+    # Segment file
+
+    def _load(self) -> None:
+        index: Dict[str, IndexEntry] = {}
+        offset = 0
+        with open(self._path, mode='ab+') as f:
+            f.seek(0)
+            for op, key, value, crc, offset in read_records(f):
+                nickname = key.decode('utf-8')
+                if op == OP_PUT:
+                    value_offset = offset - len(value)
+                    index[nickname] = (value_offset, len(value), crc)
+                else:
+                    index.pop(nickname, None)
+
+            # Drop a torn record left at the tail by a crash
+            f.truncate(offset)
+
+        self._file = SegmentFile(self._path, self.read_mode)
+        self._size = offset
+        self._index = index
+        self._live_bytes = sum(
+            self._record_size(nickname, length)
+            for nickname, (_, length, _) in index.items()
+        )
+        self.nicknames = SortedKeyIndex(index.keys())
+
+    def _segment(self) -> SegmentFile:
+        if self._file is None:
+            raise RuntimeError('Segment {} is not open'.format(self._path))
+        return self._file
+
+    def _segment_fd(self) -> int:
+        return self._segment().fd
+
+    @staticmethod
+    def _record_size(nickname: str, value_len: int) -> int:
+        return RECORD_PREFIX_SIZE + len(nickname.encode('utf-8')) + value_len
+
+    def _write_records(self, data: bytes) -> None:
+        # Blocking, run in an executor
+        fd = self._segment_fd()
+        view = memoryview(data)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+        if self.sync:
+            os.fsync(fd)
+        self.appends += 1
+
+    def _exists(self, nickname: str) -> bool:
+        # After the writes queued so far
+        pending = self._pending.get(nickname)
+        if pending is not None:
+            return pending[1]
+        return nickname in self._index
+
+    async def _append(
+        self,
+        records: Sequence[Tuple[str, bytes, Optional[AddressEntry]]]
+    ) -> None:
+        # Queues (nickname, record, entry put) for the next append, and
+        # waits until they are written and in the index
+        loop = asyncio.get_event_loop()
+        for nickname, record, addr in records:
+            seq = next(self._seqs)
+            self._queued.append((seq, nickname, record, addr))
+            self._pending[nickname] = (seq, record_op(record) == OP_PUT)
+        if self._next_append is None:
+            self._next_append = loop.create_future()
+        waiter = self._next_append
+        self._start_appending()
+        await asyncio.shield(waiter)
+
+    def _start_appending(self) -> None:
+        if self._appends_held or not self._queued:
+            return
+        if self._appending is None or self._appending.done():
+            self._appending = asyncio.ensure_future(self._append_groups())
+
+    async def _append_groups(self) -> None:
+        loop = asyncio.get_event_loop()
+        while self._queued and not self._appends_held:
+            queued, self._queued = self._queued, []
+            group, self._next_append = self._next_append, None
+            assert group is not None
+            data = b''.join(record for _, _, record, _ in queued)
+            try:
+                await loop.run_in_executor(None, self._write_records, data)
+            except Exception as e:
+                # Drop what part of the records may have been written
+                try:
+                    os.ftruncate(self._segment_fd(), self._size)
+                except Exception:
+                    pass
+                self._dequeued(queued)
+                group.set_exception(e)
+                continue
+
+            offset = self._size
+            self._size += len(data)
+            for _, nickname, record, addr in queued:
+                self._appended(nickname, record, offset, addr)
+                offset += len(record)
+            self._dequeued(queued)
+            group.set_result(None)
+
+    def _dequeued(self, queued: Sequence[QueuedRecord]) -> None:
+        for seq, nickname, _, _ in queued:
+            pending = self._pending.get(nickname)
+            if pending is not None and pending[0] == seq:
+                del self._pending[nickname]
+
+    async def _hold_appends(self) -> None:
+        # Waits for the running append; nothing is appended from then on
+        # until _release_appends()
+        self._appends_held = True
+        if self._appending is not None and not self._appending.done():
+            await asyncio.shield(self._appending)
+
+    def _release_appends(self) -> None:
+        self._appends_held = False
+        self._start_appending()
+
+    @staticmethod
+    def _put_record(nickname: str, addr: AddressEntry) -> bytes:
+        key = nickname.encode('utf-8')
+        return encode_record(OP_PUT, key, encode_entry(addr))
+
+    @staticmethod
+    def _delete_record(nickname: str) -> bytes:
+        return encode_record(OP_DELETE, nickname.encode('utf-8'))
+
+    def _appended(
+        self,
+        nickname: str,
+        record: bytes,
+        offset: int,
+        addr: Optional[AddressEntry] = None
+    ) -> None:
+        # Brings the indexes up to date with a record appended at offset;
+        # addr is the entry put by the record, if it is a put
+        op, key_len, value_len = RECORD_HEADER.unpack_from(
+            record, RECORD_CRC.size
+        )
+        old = self._index.pop(nickname, None)
+        if old is not None:
+            self._live_bytes -= self._record_size(nickname, old[1])
+        if op == OP_PUT:
+            self._index[nickname] = (
+                offset + RECORD_PREFIX_SIZE + key_len, value_len,
+                record_crc(record)
+            )
+            self._live_bytes += self._record_size(nickname, value_len)
+            self.nicknames.add(nickname)
+            if self._secondary is not None and addr is not None:
+                self._secondary.put(nickname, addr)
+        else:
+            self.nicknames.discard(nickname)
+            if self._secondary is not None:
+                self._secondary.discard(nickname)
+        self._written(nickname)
+
+    async def _put(self, nickname: str, addr: AddressEntry) -> None:
+        record = self._put_record(nickname, addr)
+        await self._append([(nickname, record, addr)])
+
+    async def _delete(self, nickname: str) -> None:
+        await self._append([(nickname, self._delete_record(nickname), None)])
+
+    def _written(self, nickname: str) -> None:
+        self._writes += 1
+        if self._compaction_dirty is not None:
+            self._compaction_dirty.add(nickname)
+        elif self._compaction is None and (
+            self.garbage_bytes >= self.compaction_min_bytes and
+            self.garbage_bytes >= self.compaction_ratio * self._size
+        ):
+            self._compaction = asyncio.ensure_future(self.compact())
+
+    def _read_value(self, nickname: str) -> bytes:
+        offset, length, _ = self._index[nickname]
+        return self._segment().read_at(offset, length)
+
+    # Compaction
+
+    async def compact(self) -> None:
+        '''
+        Rewrites the live records into a new segment and swaps it in.
+
+        Records are copied in the default executor, compaction_batch at a
+        time, while writes carry on. Appends are then held while the
+        nicknames written meanwhile are recopied and the new segment
+        replaces the old one. Scans running at the swap keep reading the
+        old segment, which is closed once they are done.
+        '''
+        if self._compaction_dirty is not None:
+            return
+
+        loop = asyncio.get_event_loop()
+        # The executor job running, waited for before cleaning up
+        job: Optional[asyncio.Future] = None
+
+        async def run(func: Callable[..., T], *args: Any) -> T:
+            nonlocal job
+            future = asyncio.ensure_future(
+                loop.run_in_executor(None, func, *args)
+            )
+            job = future
+            return await asyncio.shield(future)
+
+        source = self._segment().acquire()
+        tmp_path = self._path + '.compact'
+        out: Optional[BinaryIO] = None
+        dirty: Set[str] = set()
+        self._compaction_dirty = dirty
+        held = False
+        try:
+            out = await run(create_file, tmp_path)
+            new_index: Dict[str, IndexEntry] = {}
+            new_size = 0
+            entries = sorted(self._index.items(), key=lambda kv: kv[1])
+            batch_size = self.compaction_batch
+            for i in range(0, len(entries), batch_size):
+                batch = [
+                    (nickname, entry)
+                    for nickname, entry in entries[i:i + batch_size]
+                    if nickname not in dirty
+                ]
+                new_size = await run(
+                    copy_records, source.fd, out, batch, new_index, new_size
+                )
+            # Synced before appends are held, which leaves them little to
+            # wait for
+            await run(sync_file, out)
+
+            await self._hold_appends()
+            held = True
+            # The index does not change until appends are released
+            recopied = []
+            tail = b''
+            for nickname in dirty:
+                copied = new_index.pop(nickname, None)
+                if nickname in self._index:
+                    recopied.append((nickname, self._index[nickname]))
+                elif copied is not None:
+                    # Deleted since it was copied
+                    tail += self._delete_record(nickname)
+            new_size = await run(
+                copy_records, source.fd, out, recopied, new_index, new_size
+            )
+            await run(replace_segment, out, tail, tmp_path, self._path)
+            out = None
+            new_size += len(tail)
+            new_file = await run(SegmentFile, self._path, self.read_mode)
+
+            if self._file is not source:
+                # Stopped meanwhile
+                new_file.retire()
+                return
+            self._file = new_file
+            source.retire()
+            self._index = new_index
+            self._size = new_size
+            self._live_bytes = sum(
+                self._record_size(nickname, length)
+                for nickname, (_, length, _) in new_index.items()
+            )
+        finally:
+            if job is not None and not job.done():
+                await asyncio.wait([job])
+            discard_file(out, tmp_path)
+            source.release()
+            self._compaction_dirty = None
+            self._compaction = None
+            if held:
+                self._release_appends()
+
+    # CRUD
+
+    async def create_address(
+        self,
+        addr: AddressEntry,
+        nickname: str = None
+    ) -> str:
+        if nickname is None:
+            nickname = uuid.uuid4().hex
+
+        if self._exists(nickname):
+            raise KeyError('{} already exists'.format(nickname))
+
+        await self._put(nickname, addr)
+        return nickname
+
+    async def read_address(self, nickname: str) -> AddressEntry:
+        value = self._read_value(nickname)
+        return LazyAddressEntry.from_api_dm(json.loads(value))
+
+    async def read_address_raw(self, nickname: str) -> bytes:
+        # Values are the API JSON
+        return self._read_value(nickname)
+
+    def _version(self, nickname: str) -> str:
+        _, length, crc = self._index[nickname]
+        return '{:08x}{:x}'.format(crc, length)
+
+    async def read_address_version(self, nickname: str) -> str:
+        return self._version(nickname)
+
+    def _check_version(
+        self,
+        nickname: str,
+        if_match: Optional[Sequence[str]]
+    ) -> None:
+        # A queued write is not in the index yet, and changes the version.
+        # The write is queued with no await after this check.
+        if if_match is not None and nickname in self._pending:
+            raise VersionMismatchError('{} has been modified'.format(nickname))
+        check_version(nickname, self._version(nickname), if_match)
+
+    async def update_address(
+        self,
+        nickname: str,
+        addr: AddressEntry,
+        if_match: Sequence[str] = None
+    ) -> None:
+        if not self._exists(nickname):
+            raise KeyError(nickname)
+        self._check_version(nickname, if_match)
+
+        await self._put(nickname, addr)
+
+    async def delete_address(
+        self,
+        nickname: str,
+        if_match: Sequence[str] = None
+    ) -> None:
+        if not self._exists(nickname):
+            raise KeyError(nickname)
+        self._check_version(nickname, if_match)
+
+        await self._delete(nickname)
+
+    async def write_addresses(
+        self,
+        writes: Sequence[AddressWrite]
+    ) -> List[Optional[KeyError]]:
+        # All records of the batch go to the segment in one append (and one
+        # fsync when sync is set), then the index is updated.
+        results: List[Optional[KeyError]] = []
+        records: List[Tuple[str, bytes, Optional[AddressEntry]]] = []
+        exists: Dict[str, bool] = {}  # after the writes so far
+        for write in writes:
+            nickname = write.nickname
+            if write.op not in (WRITE_CREATE, WRITE_UPDATE, WRITE_DELETE):
+                raise ValueError('Invalid write op {}'.format(write.op))
+            found = exists.get(nickname, self._exists(nickname))
+            if write.op == WRITE_CREATE and found:
+                results.append(KeyError('{} already exists'.format(nickname)))
+                continue
+            if write.op != WRITE_CREATE and not found:
+                results.append(KeyError(nickname))
+                continue
+
+            if write.op == WRITE_DELETE:
+                records.append(
+                    (nickname, self._delete_record(nickname), None)
+                )
+            elif write.addr is None:
+                raise ValueError('No address to {} {}'.format(
+                    write.op, nickname
+                ))
+            else:
+                records.append((
+                    nickname, self._put_record(nickname, write.addr),
+                    write.addr
+                ))
+            exists[nickname] = write.op != WRITE_DELETE
+            results.append(None)
+
+        if records:
+            await self._append(records)
+
+        return results
+
+    async def read_all_addresses(
+        self
+    ) -> AsyncIterator[Tuple[str, AddressEntry]]:
+        async for nickname, value in self.read_all_addresses_raw():
+            yield nickname, LazyAddressEntry.from_api_dm(json.loads(value))
+
+    async def read_all_addresses_raw(
+        self
+    ) -> AsyncIterator[Tuple[str, bytes]]:
+        # Records are immutable, so the index as of now is a consistent
+        # view. Reading it in offset order makes the scan sequential.
+        # The scan holds the segment it began on, which compaction may
+        # replace meanwhile.
+        segment = self._segment().acquire()
+        entries = sorted(self._index.items(), key=lambda kv: kv[1])
+        try:
+            chunk = b''
+            chunk_offset = 0
+            for nickname, (offset, length, _) in entries:
+                if self.read_mode == 'mmap':
+                    value = segment.read_at(offset, length)
+                else:
+                    start = offset - chunk_offset
+                    if start < 0 or start + length > len(chunk):
+                        chunk = os.pread(
+                            segment.fd, max(SCAN_CHUNK_SIZE, length), offset
+                        )
+                        chunk_offset, start = offset, 0
+                    value = chunk[start:start + length]
+                yield nickname, value
+        finally:
+            segment.release()
+
+    async def read_addresses_version(self) -> str:
+        return '{}-{:x}'.format(self._instance_id, self._writes)
+
+    async def find_nicknames(self, criteria: Mapping[str, Any]) -> List[str]:
+        # The index is built on the first query, reading every value, then
+        # kept up to date by every write.
+        if self._secondary is None:
+            index = SecondaryIndex()
+            for nickname in self._index:
+                value = json.loads(self._read_value(nickname))
+                index.put(nickname, LazyAddressEntry.from_api_dm(value))
+            self._secondary = index
+        return sorted(self._secondary.find(criteria))
+
+    async def read_addresses_page(
+        self,
+        limit: int,
+        after: str = None
+    ) -> List[Tuple[str, AddressEntry]]:
+        return [
+            (nickname, await self.read_address(nickname))
+            for nickname in self.nicknames.page(limit, after)
+        ]
+
+    async def read_addresses_page_raw(
+        self,
+        limit: int,
+        after: str = None
+    ) -> List[Tuple[str, bytes]]:
+        return [
+            (nickname, self._read_value(nickname))
+            for nickname in self.nicknames.page(limit, after)
+        ]
@@ -0,0 +1,111 @@
+# Copyright (c) 2020. All rights reserved.
+
+import os
+import struct
+from typing import Iterable, List, Tuple
+import zlib
+
+from addrservice.database.fs_layout import sync_dir
+
+# Snapshot file layout: magic | header | entries | count | crc32
+# The header holds the format version and the number of the first change
+# log that the snapshot does not cover. Each entry is: nickname length |
+# value length | nickname | value. The crc covers everything before it.
+SNAPSHOT_MAGIC = b'ADDRSNAP'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('<HQ')
+SNAPSHOT_ENTRY = struct.Struct('<HI')
+SNAPSHOT_COUNT = struct.Struct('<Q')
+SNAPSHOT_CRC = struct.Struct('<I')
+
+
+class SnapshotWriter:
+    '''
+    Writes a snapshot file under a temporary name. commit() fsyncs it and
+    moves it over the previous snapshot, so that a crash leaves one or the
+    other whole; abort() drops it.
+    '''
+
+    def __init__(self, path: str, next_log: int) -> None:
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        # A new file, as an abandoned writer may still hold the old one
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        self._file = open(self.tmp_path, mode='xb')
+        self._crc = 0
+        self._count = 0
+        self._write(
+            SNAPSHOT_MAGIC + SNAPSHOT_HEADER.pack(SNAPSHOT_VERSION, next_log)
+        )
+
+    def _write(self, data: bytes) -> None:
+        self._crc = zlib.crc32(data, self._crc)
+        self._file.write(data)
+
+    def write(self, entries: Iterable[Tuple[str, bytes]]) -> None:
+        chunk: List[bytes] = []
+        for nickname, value in entries:
+            key = nickname.encode('utf-8')
+            chunk += (SNAPSHOT_ENTRY.pack(len(key), len(value)), key, value)
+            self._count += 1
+        self._write(b''.join(chunk))
+
+    def commit(self) -> None:
+        self._write(SNAPSHOT_COUNT.pack(self._count))
+        self._file.write(SNAPSHOT_CRC.pack(self._crc))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self.tmp_path, self.path)
+        sync_dir(os.path.dirname(self.path))
+
+    def abort(self) -> None:
+        stat = os.fstat(self._file.fileno())
+        self._file.close()
+        try:
+            # Unless another writer has made a file of its own since
+            if os.path.samestat(stat, os.stat(self.tmp_path)):
+                os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+def read_snapshot(path: str) -> Tuple[int, List[Tuple[str, bytes]]]:
+    '''
+    The number of the first change log that a snapshot file does not cover,
+    and its (nickname, value) entries. Raises ValueError if the file is not
+    a whole snapshot.
+    '''
+    with open(path, mode='rb') as f:
+        data = f.read()
+
+    start = len(SNAPSHOT_MAGIC) + SNAPSHOT_HEADER.size
+    end = len(data) - SNAPSHOT_COUNT.size - SNAPSHOT_CRC.size
+    if end < start or not data.startswith(SNAPSHOT_MAGIC):
+        raise ValueError('{} is not a snapshot'.format(path))
+    version, next_log = SNAPSHOT_HEADER.unpack_from(data, len(SNAPSHOT_MAGIC))
+    if version != SNAPSHOT_VERSION:
+        raise ValueError('Snapshot {} has unknown version {}'.format(
+            path, version
+        ))
+    (count,) = SNAPSHOT_COUNT.unpack_from(data, end)
+    (crc,) = SNAPSHOT_CRC.unpack_from(data, end + SNAPSHOT_COUNT.size)
+    if zlib.crc32(memoryview(data)[:end + SNAPSHOT_COUNT.size]) != crc:
+        raise ValueError('Snapshot {} is corrupt'.format(path))
+
+    entries = []
+    unpack_entry = SNAPSHOT_ENTRY.unpack_from
+    offset = start
+    while offset < end:
+        key_len, value_len = unpack_entry(data, offset)
+        offset += SNAPSHOT_ENTRY.size
+        key_end = offset + key_len
+        value_end = key_end + value_len
+        entries.append(
+            (data[offset:key_end].decode('utf-8'), data[key_end:value_end])
+        )
+        offset = value_end
+    if offset != end or len(entries) != count:
+        raise ValueError('Snapshot {} is corrupt'.format(path))
+    return next_log, entries
@@ -0,0 +1,101 @@
+# Copyright (c) 2020. All rights reserved.
+
+import itertools
+from typing import Dict, Generic, List, Optional, Tuple, TypeVar
+
+from addrservice.database.indexes import SortedKeyIndex
+
+T = TypeVar('T')
+
+
+class ScanSnapshots(Generic[T]):
+    '''
+    Point-in-time views of an engine's entries for scans, without copying
+    them and without holding writes back.
+
+    Every write is numbered. A scan takes the number of the last write as
+    its snapshot. While any scan is running, each write keeps the value it
+    replaced (None if there was none), so that get() can give a scan the
+    value an entry had at its snapshot. Kept values are dropped once no
+    running scan is older than the write that replaced them.
+
+    A scan that is abandoned without being closed keeps its snapshot, and
+    the values kept for it, until it is garbage collected.
+    '''
+
+    def __init__(self) -> None:
+        self._sequence = itertools.count(1)
+        self._last = 0
+        # Snapshots of running scans, with repeats
+        self._scans: List[int] = []
+        # Per nickname, (write number, value before that write)
+        self._replaced: Dict[str, List[Tuple[int, Optional[T]]]] = {}
+        # The nicknames of _replaced, in order
+        self._changed = SortedKeyIndex()
+
+    @property
+    def active(self) -> bool:
+        # Whether writes must pass the values they replace to written()
+        return bool(self._scans)
+
+    def begin(self) -> int:
+        self._scans.append(self._last)
+        return self._last
+
+    def end(self, snapshot: int) -> None:
+        self._scans.remove(snapshot)
+        if not self._scans:
+            self._replaced = {}
+            self._changed = SortedKeyIndex()
+            return
+
+        oldest = min(self._scans)
+        for nickname in list(self._replaced):
+            kept = [
+                (write, value) for write, value in self._replaced[nickname]
+                if write > oldest
+            ]
+            if kept:
+                self._replaced[nickname] = kept
+            else:
+                del self._replaced[nickname]
+                self._changed.discard(nickname)
+
+    def written(self, nickname: str, old: Optional[T] = None) -> None:
+        # Call before nickname is written, with the value it has until then
+        # if active
+        self._last = next(self._sequence)
+        if self._scans:
+            replaced = self._replaced.get(nickname)
+            if replaced is None:
+                replaced = self._replaced[nickname] = []
+                self._changed.add(nickname)
+            replaced.append((self._last, old))
+
+    def get(
+        self,
+        nickname: str,
+        snapshot: int,
+        current: Optional[T]
+    ) -> Optional[T]:
+        # The value of nickname at snapshot, given its current value: the
+        # value replaced by the first write since, if any
+        first = None
+        for write, value in self._replaced.get(nickname, ()):
+            if write > snapshot and (first is None or write < first[0]):
+                first = (write, value)
+        return current if first is None else first[1]
+
+    def changed(
+        self,
+        snapshot: int,
+        after: str = None,
+        last: str = None
+    ) -> List[str]:
+        # Nicknames written since snapshot, in order; only those greater
+        # than after and up to last, if given, so that a scan can merge them
+        # in a page at a time without walking all of them for every page
+        return [
+            nickname for nickname in self._changed.between(after, last)
+            if any(write > snapshot for write, _ in self._replaced[nickname])
+        ]
@@ -0,0 +1,575 @@
+# Copyright (c) 2020. All rights reserved.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sqlite3
+import threading
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar
+)
+import uuid
+
+from addrservice.database.addressbook_db import (
+    AbstractAddressBookDB,
+    AddressWrite,
+    SCAN_PAGE_SIZE,
+    VersionMismatchError,
+    WRITE_CREATE,
+    WRITE_DELETE,
+    WRITE_UPDATE,
+    encode_entry,
+)
+from addrservice.database.indexes import (
+    check_criteria,
+    entry_index_keys,
+    index_key
+)
+from addrservice.datamodel import AddressEntry, LazyAddressEntry
+
+T = TypeVar('T')
+
+# Other processes may hold the write lock; wait this long for it
+BUSY_TIMEOUT_MS = 5000
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS addresses (
+        nickname TEXT PRIMARY KEY,
+        addr TEXT NOT NULL,
+        version INTEGER NOT NULL
+    )
+    ''',
+    # Normalized values of the indexes.INDEXED_FIELDS of each entry
+    '''
+    CREATE TABLE IF NOT EXISTS index_keys (
+        field TEXT NOT NULL,
+        value TEXT NOT NULL,
+        nickname TEXT NOT NULL,
+        PRIMARY KEY (field, value, nickname)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS index_keys_nickname ON index_keys (nickname)
+    ''',
+    # One row: an id made when the DB is created, and the number of write
+    # transactions. Every write transaction stamps the entries it writes
+    # with the new count.
+    '''
+    CREATE TABLE IF NOT EXISTS book (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        uid TEXT NOT NULL,
+        version INTEGER NOT NULL
+    )
+    ''',
+]
+
+# Statements are always the same strings, so that each connection prepares
+# them once and then finds them in its statement cache.
+SQL_INIT_BOOK = '''
+    INSERT OR IGNORE INTO book (id, uid, version) VALUES (0, ?, 0)
+'''
+SQL_READ_BOOK = 'SELECT uid, version FROM book WHERE id = 0'
+SQL_BUMP_BOOK = 'UPDATE book SET version = version + 1 WHERE id = 0'
+
+SQL_READ = 'SELECT addr FROM addresses WHERE nickname = ?'
+SQL_READ_VERSION = 'SELECT version FROM addresses WHERE nickname = ?'
+SQL_READ_PAGE = '''
+    SELECT nickname, addr FROM addresses
+    WHERE nickname > ? ORDER BY nickname LIMIT ?
+'''
+SQL_CREATE = '''
+    INSERT OR IGNORE INTO addresses (nickname, addr, version)
+    VALUES (?, ?, ?)
+'''
+SQL_UPDATE = 'UPDATE addresses SET addr = ?, version = ? WHERE nickname = ?'
+SQL_DELETE = 'DELETE FROM addresses WHERE nickname = ?'
+SQL_UPDATE_IF = '''
+    UPDATE addresses SET addr = ?, version = ?
+    WHERE nickname = ? AND version = ?
+'''
+SQL_DELETE_IF = 'DELETE FROM addresses WHERE nickname = ? AND version = ?'
+
+SQL_ADD_KEY = 'INSERT OR IGNORE INTO index_keys VALUES (?, ?, ?)'
+SQL_DELETE_KEYS = 'DELETE FROM index_keys WHERE nickname = ?'
+SQL_FIND_KEY = 'SELECT nickname FROM index_keys WHERE field = ? AND value = ?'
+
+
+class SqliteAddressBookDB(AbstractAddressBookDB):
+    '''
+    Stores entries as JSON text in an SQLite database.
+
+    The database is in WAL mode, so reads do not block the writer or each
+    other, and several processes can share it. Queries run in a pool of
+    reader threads, each with its own connection; writes run in a single
+    writer thread, one transaction per write or batch. Entry versions and
+    the address book version come from a write counter in the database, so
+    they are the same in every process.
+
+    With sync, every transaction is fsynced (synchronous=FULL); otherwise
+    (synchronous=NORMAL) a power loss may drop the last transactions, but
+    never corrupts the database.
+
+    Scans read every page in one read transaction, so they see the entries
+    as they were when they began, whatever is written meanwhile, also by
+    other processes.
+
+    The thread pools are made by start() and shut down by stop().
+    '''
+
+    def __init__(self, path: str, readers: int = 4, sync: bool = False):
+        if readers <= 0:
+            raise ValueError('Invalid number of readers {}'.format(readers))
+
+        self._path = os.path.abspath(path)
+        store_dir = os.path.dirname(self._path)
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        if not (os.path.isdir(store_dir) and os.access(store_dir, os.W_OK)):
+            raise ValueError(
+                'SQLite directory "{}" is not a writable directory'.format(
+                    store_dir
+                )
+            )
+
+        self.readers = readers
+        self.sync = sync
+        self._uid = ''
+        self._reader_pool: Optional[ThreadPoolExecutor] = None
+        self._writer_pool: Optional[ThreadPoolExecutor] = None
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def start(self):
+        if self._writer_pool is not None:
+            return
+
+        conn = self._connect()
+        try:
+            conn.execute('PRAGMA journal_mode = WAL')
+            for sql in SCHEMA:
+                conn.execute(sql)
+            conn.execute(SQL_INIT_BOOK, (uuid.uuid4().hex[:8],))
+            self._uid = conn.execute(SQL_READ_BOOK).fetchone()[0]
+        finally:
+            conn.close()
+
+        self._reader_pool = ThreadPoolExecutor(
+            self.readers, thread_name_prefix='sqlite-reader'
+        )
+        self._writer_pool = ThreadPoolExecutor(
+            1, thread_name_prefix='sqlite-writer'
+        )
+
+    def stop(self):
+        for pool in (self._reader_pool, self._writer_pool):
+            if pool is not None:
+                pool.shutdown(wait=True)
+        self._reader_pool = None
+        self._writer_pool = None
+
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+    # Connections and threads
+
+    def _connect(self) -> sqlite3.Connection:
+        # Autocommit; write transactions are begun explicitly. Connections
+        # are used by one thread at a time, but closed by stop().
+        conn = sqlite3.connect(
+            self._path,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        conn.execute('PRAGMA busy_timeout = {:d}'.format(BUSY_TIMEOUT_MS))
+        conn.execute(
+            'PRAGMA synchronous = {}'.format('FULL' if self.sync else 'NORMAL')
+        )
+        return conn
+
+    def _connection(self) -> sqlite3.Connection:
+        # The connection of the current pool thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    async def _run(
+        self,
+        pool: Optional[ThreadPoolExecutor],
+        func: Callable[..., T],
+        *args: Any,
+        conn: sqlite3.Connection = None
+    ) -> T:
+        # On conn if given, else on the connection of the pool thread
+        if pool is None:
+            raise RuntimeError('SQLite DB {} is not open'.format(self._path))
+        return await asyncio.get_event_loop().run_in_executor(
+            pool, lambda: func(conn or self._connection(), *args)
+        )
+
+    async def _read(
+        self,
+        func: Callable[..., T],
+        *args: Any,
+        conn: sqlite3.Connection = None
+    ) -> T:
+        return await self._run(self._reader_pool, func, *args, conn=conn)
+
+    async def _write(self, func: Callable[..., T], *args: Any) -> T:
+        return await self._run(self._writer_pool, func, *args)
+
+    # Run in the pool threads
+
+    @staticmethod
+    def _read_text(conn: sqlite3.Connection, nickname: str) -> str:
+        row = conn.execute(SQL_READ, (nickname,)).fetchone()
+        if row is None:
+            raise KeyError(nickname)
+        return row[0]
+
+    @staticmethod
+    def _read_entry(conn: sqlite3.Connection, nickname: str) -> AddressEntry:
+        text = SqliteAddressBookDB._read_text(conn, nickname)
+        return LazyAddressEntry.from_api_dm(json.loads(text))
+
+    @staticmethod
+    def _read_version(conn: sqlite3.Connection, nickname: str) -> int:
+        row = conn.execute(SQL_READ_VERSION, (nickname,)).fetchone()
+        if row is None:
+            raise KeyError(nickname)
+        return row[0]
+
+    @staticmethod
+    def _read_book_version(conn: sqlite3.Connection) -> int:
+        return conn.execute(SQL_READ_BOOK).fetchone()[1]
+
+    @staticmethod
+    def _begin_snapshot(conn: sqlite3.Connection) -> None:
+        # A deferred transaction takes its snapshot at its first read
+        conn.execute('BEGIN')
+        conn.execute(SQL_READ_BOOK).fetchone()
+
+    def _open_scan(self) -> sqlite3.Connection:
+        conn = self._connect()
+        with self._connections_lock:
+            self._connections.append(conn)
+        try:
+            self._begin_snapshot(conn)
+        except BaseException:
+            self._close_scan(conn)
+            raise
+        return conn
+
+    def _close_scan(self, conn: sqlite3.Connection) -> None:
+        with self._connections_lock:
+            if conn in self._connections:
+                self._connections.remove(conn)
+        # Ends the read transaction
+        conn.close()
+
+    @staticmethod
+    def _read_page(
+        conn: sqlite3.Connection,
+        limit: int,
+        after: str
+    ) -> List[Tuple[str, AddressEntry]]:
+        return [
+            (nickname, LazyAddressEntry.from_api_dm(json.loads(addr)))
+            for nickname, addr in conn.execute(SQL_READ_PAGE, (after, limit))
+        ]
+
+    @staticmethod
+    def _read_page_raw(
+        conn: sqlite3.Connection,
+        limit: int,
+        after: str
+    ) -> List[Tuple[str, bytes]]:
+        return [
+            (nickname, addr.encode('utf-8'))
+            for nickname, addr in conn.execute(SQL_READ_PAGE, (after, limit))
+        ]
+
+    @staticmethod
+    def _find(
+        conn: sqlite3.Connection,
+        keys: Sequence[Tuple[str, str]]
+    ) -> List[str]:
+        sql = ' INTERSECT '.join(SQL_FIND_KEY for _ in keys)
+        params = [part for key in keys for part in key]
+        return [
+            nickname for (nickname,) in
+            conn.execute(sql + ' ORDER BY nickname', params)
+        ]
+
+    @staticmethod
+    def _not_written(
+        conn: sqlite3.Connection,
+        nickname: str,
+        if_versions: Optional[Sequence[int]]
+    ) -> KeyError:
+        # Why an update or delete changed no row
+        if if_versions is not None and conn.execute(
+            SQL_READ_VERSION, (nickname,)
+        ).fetchone() is not None:
+            raise VersionMismatchError('{} has been modified'.format(nickname))
+        return KeyError('{} does not exist'.format(nickname))
+
+    @staticmethod
+    def _apply_write(
+        conn: sqlite3.Connection,
+        write: AddressWrite,
+        version: int,
+        if_versions: Sequence[int] = None
+    ) -> Optional[KeyError]:
+        # With if_versions, an update or delete only changes the row if it
+        # has one of those versions
+        nickname = write.nickname
+        if write.op == WRITE_DELETE:
+            if if_versions is None:
+                deleted = conn.execute(SQL_DELETE, (nickname,)).rowcount > 0
+            else:
+                deleted = any(
+                    conn.execute(SQL_DELETE_IF, (nickname, v)).rowcount > 0
+                    for v in if_versions
+                )
+            if not deleted:
+                return SqliteAddressBookDB._not_written(
+                    conn, nickname, if_versions
+                )
+            conn.execute(SQL_DELETE_KEYS, (nickname,))
+            return None
+
+        if write.addr is None:
+            raise ValueError('No address to {} {}'.format(
+                write.op, write.nickname
+            ))
+        text = encode_entry(write.addr).decode('utf-8')
+        if write.op == WRITE_CREATE:
+            cursor = conn.execute(SQL_CREATE, (write.nickname, text, version))
+            if cursor.rowcount == 0:
+                return KeyError('{} already exists'.format(write.nickname))
+        elif write.op == WRITE_UPDATE:
+            if if_versions is None:
+                updated = conn.execute(
+                    SQL_UPDATE, (text, version, nickname)
+                ).rowcount > 0
+            else:
+                updated = any(
+                    conn.execute(
+                        SQL_UPDATE_IF, (text, version, nickname, v)
+                    ).rowcount > 0
+                    for v in if_versions
+                )
+            if not updated:
+                return SqliteAddressBookDB._not_written(
+                    conn, nickname, if_versions
+                )
+            conn.execute(SQL_DELETE_KEYS, (nickname,))
+        else:
+            raise ValueError('Invalid write op {}'.format(write.op))
+
+        conn.executemany(SQL_ADD_KEY, [
+            (field, value, write.nickname)
+            for field, value in entry_index_keys(write.addr)
+        ])
+        return None
+
+    @classmethod
+    def _write_transaction(
+        cls,
+        conn: sqlite3.Connection,
+        writes: Sequence[AddressWrite],
+        if_versions: Sequence[int] = None
+    ) -> List[Optional[KeyError]]:
+        # IMMEDIATE takes the write lock now, rather than on the first
+        # write, which could fail after reads in another process's way
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(SQL_BUMP_BOOK)
+            version = cls._read_book_version(conn)
+            results = [
+                cls._apply_write(conn, write, version, if_versions)
+                for write in writes
+            ]
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return results
+
+    async def _write_one(
+        self,
+        write: AddressWrite,
+        if_match: Sequence[str] = None
+    ) -> None:
+        if_versions = None
+        if if_match is not None:
+            if_versions = self._if_versions(if_match)
+        (error,) = await self._write(
+            self._write_transaction, [write], if_versions
+        )
+        if error is not None:
+            raise error
+
+    def _if_versions(self, if_match: Sequence[str]) -> List[int]:
+        # The row versions of the tags of this DB among if_match, see
+        # read_address_version
+        prefix = self._uid + '-'
+        versions = []
+        for tag in if_match:
+            if tag.startswith(prefix):
+                try:
+                    versions.append(int(tag[len(prefix):], 16))
+                except ValueError:
+                    pass
+        return versions
+
+    # CRUD
+
+    async def create_address(
+        self,
+        addr: AddressEntry,
+        nickname: str = None
+    ) -> str:
+        if nickname is None:
+            nickname = uuid.uuid4().hex
+
+        await self._write_one(AddressWrite(WRITE_CREATE, nickname, addr))
+        return nickname
+
+    async def read_address(self, nickname: str) -> AddressEntry:
+        return await self._read(self._read_entry, nickname)
+
+    async def read_address_raw(self, nickname: str) -> bytes:
+        # Entries are stored as their API JSON
+        text = await self._read(self._read_text, nickname)
+        return text.encode('utf-8')
+
+    async def read_address_version(self, nickname: str) -> str:
+        version = await self._read(self._read_version, nickname)
+        return '{}-{:x}'.format(self._uid, version)
+
+    async def update_address(
+        self,
+        nickname: str,
+        addr: AddressEntry,
+        if_match: Sequence[str] = None
+    ) -> None:
+        await self._write_one(
+            AddressWrite(WRITE_UPDATE, nickname, addr), if_match
+        )
+
+    async def delete_address(
+        self,
+        nickname: str,
+        if_match: Sequence[str] = None
+    ) -> None:
+        await self._write_one(AddressWrite(WRITE_DELETE, nickname), if_match)
+
+    async def read_all_addresses(
+        self
+    ) -> AsyncIterator[Tuple[str, AddressEntry]]:
+        async for nickname, addr in self._scan(self._read_page):
+            yield nickname, addr
+
+    async def read_all_addresses_raw(
+        self
+    ) -> AsyncIterator[Tuple[str, bytes]]:
+        async for nickname, addr in self._scan(self._read_page_raw):
+            yield nickname, addr
+
+    async def _scan(
+        self,
+        read_page: Callable[..., List[Tuple[str, T]]]
+    ) -> AsyncIterator[Tuple[str, T]]:
+        # A page per query, all in one read transaction on a connection of
+        # the scan's own, so that the scan sees the database as it was when
+        # it began. In WAL mode that does not hold writers back, but the
+        # WAL is not checkpointed past the snapshot until the scan ends.
+        if self._reader_pool is None:
+            raise RuntimeError('SQLite DB {} is not open'.format(self._path))
+        job: asyncio.Future = asyncio.ensure_future(
+            asyncio.get_event_loop().run_in_executor(
+                self._reader_pool, self._open_scan
+            )
+        )
+        conn: Optional[sqlite3.Connection] = None
+        try:
+            # Shielded, so that a cancelled scan can wait for the reader
+            # thread to be done with the connection
+            conn = await asyncio.shield(job)
+            after = ''
+            while True:
+                job = asyncio.ensure_future(
+                    self._read(read_page, SCAN_PAGE_SIZE, after, conn=conn)
+                )
+                page = await asyncio.shield(job)
+                for nickname, addr in page:
+                    yield nickname, addr
+                if len(page) < SCAN_PAGE_SIZE:
+                    break
+                after = page[-1][0]
+        finally:
+            if not job.done():
+                await asyncio.wait([job])
+            if not job.cancelled() and job.exception() is None:
+                if conn is None:
+                    conn = job.result()
+            if conn is not None:
+                self._close_scan(conn)
+
+    async def read_addresses_version(self) -> str:
+        version = await self._read(self._read_book_version)
+        return '{}-{:x}'.format(self._uid, version)
+
+    async def read_addresses_page(
+        self,
+        limit: int,
+        after: str = None
+    ) -> List[Tuple[str, AddressEntry]]:
+        return await self._read(self._read_page, limit, after or '')
+
+    async def read_addresses_page_raw(
+        self,
+        limit: int,
+        after: str = None
+    ) -> List[Tuple[str, bytes]]:
+        return await self._read(self._read_page_raw, limit, after or '')
+
+    # Queries
+
+    async def find_nicknames(self, criteria: Mapping[str, Any]) -> List[str]:
+        check_criteria(criteria)
+        keys = [index_key(field, value) for field, value in criteria.items()]
+        return await self._read(self._find, keys)
+
+    # Batches
+
+    async def write_addresses(
+        self,
+        writes: Sequence[AddressWrite]
+    ) -> List[Optional[KeyError]]:
+        # One transaction, hence one commit (and fsync) for the batch
+        if not writes:
+            return []
+        return await self._write(self._write_transaction, writes)
@@ -0,0 +1,385 @@
+# Copyright (c) 2020. All rights reserved.
+
+from collections import OrderedDict
+from enum import Enum
+from sys import getsizeof
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple
+)
+
+from addrservice.database.addressbook_db import (
+    AbstractAddressBookDB, AddressWrite, encode_entry
+)
+from addrservice.datamodel import AddressEntry, LazyAddressEntry
+
+TIERED_MAX_BYTES = 64 * 1024 * 1024
+
+# Shares of the byte budget: the window that entries read from the cold
+# tier enter, and the protected segment of the rest (the main space)
+WINDOW_SHARE = 0.01
+PROTECTED_SHARE = 0.8
+
+# Bytes of budget per counter of a row of the frequency sketch, about the
+# size of the smallest entries
+SKETCH_ENTRY_BYTES = 1024
+# Counters are halved after this many additions per counter of a row
+SKETCH_SAMPLE_FACTOR = 10
+
+# Halves every counter of a row in one call of bytearray.translate
+_HALVED = bytes(i >> 1 for i in range(256))
+
+
+def entry_size(addr: AddressEntry) -> int:
+    '''
+    Estimated bytes that an AddressEntry takes in memory: its objects, lists
+    and values, but not the enums and None that all entries share. A
+    LazyAddressEntry is counted as its JSON, which is what it holds until
+    it is used.
+    '''
+    if isinstance(addr, LazyAddressEntry):
+        return getsizeof(addr) + getsizeof(addr.to_json())
+
+    size = getsizeof(addr) + getsizeof(addr.full_name)
+    lists: List[Sequence[Any]] = [
+        addr.addresses, addr.phone_numbers, addr.fax_numbers, addr.emails
+    ]
+    for items in lists:
+        size += getsizeof(items)
+        for item in items:
+            size += getsizeof(item)
+            for slot in item.__slots__:
+                value = getattr(item, slot)
+                if value is not None and not isinstance(value, Enum):
+                    size += getsizeof(value)
+    return size
+
+
+class FrequencySketch:
+    '''
+    How often each key was used lately, estimated in fixed memory (the
+    TinyLFU count-min sketch): a key adds one to a counter in each of four
+    rows, and its estimate is the smallest of them. Counters saturate at 15,
+    and are all halved once SKETCH_SAMPLE_FACTOR additions per counter of a
+    row were made, so that keys that were popular long ago fade.
+    '''
+
+    ROWS = 4
+    MAX_COUNT = 15
+
+    def __init__(self, width: int) -> None:
+        size = 16
+        while size < width:
+            size *= 2
+        self._mask = size - 1
+        self._rows = [bytearray(size) for _ in range(self.ROWS)]
+        self._sample_size = SKETCH_SAMPLE_FACTOR * size
+        self._additions = 0
+
+    def _indexes(self, key: str) -> List[int]:
+        # Double hashing of one hash of the key
+        h = hash(key) & 0xffffffffffffffff
+        step = (h >> 32) | 1
+        return [(h + i * step) & self._mask for i in range(self.ROWS)]
+
+    def add(self, key: str) -> None:
+        for row, i in zip(self._rows, self._indexes(key)):
+            if row[i] < self.MAX_COUNT:
+                row[i] += 1
+        self._additions += 1
+        if self._additions >= self._sample_size:
+            self._rows = [row.translate(_HALVED) for row in self._rows]
+            self._additions //= 2
+
+    def estimate(self, key: str) -> int:
+        return min(row[i] for row, i in zip(self._rows, self._indexes(key)))
+
+
+class LRUSegment:
+    '''Entries and their sizes, least recently used first.'''
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries: 'OrderedDict[str, Tuple[AddressEntry, int]]' = (
+            OrderedDict()
+        )
+
+    def lru(self) -> Optional[str]:
+        return next(iter(self.entries), None)
+
+    def put(self, nickname: str, addr: AddressEntry, size: int) -> None:
+        self.entries[nickname] = (addr, size)
+        self.bytes += size
+
+    def pop(self, nickname: str) -> Tuple[AddressEntry, int]:
+        addr, size = self.entries.pop(nickname)
+        self.bytes -= size
+        return addr, size
+
+
+class TieredAddressBookDB(AbstractAddressBookDB):
+    '''
+    Keeps the hot set of another DB, the cold tier (usually on disk), in
+    memory as decoded AddressEntry objects, in at most about max_bytes (see
+    entry_size).
+
+    W-TinyLFU decides what stays. Entries read from the cold tier, raw or
+    not, enter an LRU window, WINDOW_SHARE of the budget, as their stored
+    JSON (see LazyAddressEntry.from_json). An entry evicted from the window
+    is admitted to the main space only if it was used more often lately
+    (see FrequencySketch) than each entry that would be evicted for it, so
+    entries read once, as by a scan, do not flush the hot set. Entries are
+    decoded when they are admitted, so those read once never are. The main
+    space is a segmented LRU: an entry read again moves from the probation
+    segment to the protected one (PROTECTED_SHARE of the space), whose
+    least recently used entries move back to probation.
+
+    Writes go to the cold tier, and update_address, delete_address and
+    write_addresses drop the entries written from memory. The sketch keeps
+    their frequency, so hot entries win their place back when read again.
+    Scans, pages and queries are passed through.
+    '''
+
+    def __init__(
+        self,
+        db: AbstractAddressBookDB,
+        max_bytes: int = TIERED_MAX_BYTES
+    ):
+        if max_bytes <= 0:
+            raise ValueError('Invalid tiered max bytes {}'.format(max_bytes))
+
+        self.db = db
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        window_bytes = max(1, int(max_bytes * WINDOW_SHARE))
+        self._main_bytes = max_bytes - window_bytes
+        self._window = LRUSegment(window_bytes)
+        self._probation = LRUSegment(self._main_bytes)
+        self._protected = LRUSegment(int(self._main_bytes * PROTECTED_SHARE))
+        self._segments: Dict[str, LRUSegment] = {}
+        self._sketch = FrequencySketch(max_bytes // SKETCH_ENTRY_BYTES)
+        # Bumped on every invalidation. A read that raced a write does not
+        # put the value it read into memory.
+        self._generation = 0
+
+    def __len__(self) -> int:
+        return len(self._segments)
+
+    @property
+    def size(self) -> int:
+        return sum(
+            segment.bytes
+            for segment in (self._window, self._probation, self._protected)
+        )
+
+    def start(self):
+        self.db.start()
+
+    def stop(self):
+        self.db.stop()
+
+    # Hot tier
+
+    def _get(self, nickname: str) -> Optional[AddressEntry]:
+        self._sketch.add(nickname)
+        segment = self._segments.get(nickname)
+        if segment is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        if segment is self._probation:
+            addr, size = segment.pop(nickname)
+            self._protected.put(nickname, addr, size)
+            self._segments[nickname] = self._protected
+            while self._protected.bytes > self._protected.max_bytes:
+                demoted = self._protected.lru()
+                assert demoted is not None
+                self._probation.put(demoted, *self._protected.pop(demoted))
+                self._segments[demoted] = self._probation
+            return addr
+
+        segment.entries.move_to_end(nickname)
+        return segment.entries[nickname][0]
+
+    def _admit(self, nickname: str, addr: AddressEntry) -> None:
+        self._discard(nickname)
+        self._window.put(nickname, addr, entry_size(addr))
+        self._segments[nickname] = self._window
+        while self._window.bytes > self._window.max_bytes:
+            candidate = self._window.lru()
+            assert candidate is not None
+            del self._segments[candidate]
+            self._admit_main(candidate, *self._window.pop(candidate))
+
+    def _victim(self) -> Optional[str]:
+        # The entry of the main space to evict next, probation first
+        if self._probation.entries:
+            return self._probation.lru()
+        return self._protected.lru()
+
+    def _victims(self) -> Iterator[str]:
+        # The entries of the main space in the order they are evicted
+        yield from self._probation.entries
+        yield from self._protected.entries
+
+    def _admit_main(
+        self,
+        nickname: str,
+        addr: AddressEntry,
+        size: int
+    ) -> None:
+        # Evicts the entries the candidate needs room from, if it is used
+        # more often than each of them, and none otherwise
+        main_bytes = self._probation.bytes + self._protected.bytes
+        frequency = self._sketch.estimate(nickname)
+        victim = self._victim()
+        if main_bytes + size > self._main_bytes and victim is not None and (
+            frequency <= self._sketch.estimate(victim)
+        ):
+            # Most candidates are turned down here, before being decoded
+            self.evictions += 1
+            return
+
+        if isinstance(addr, LazyAddressEntry):
+            addr = AddressEntry.from_api_dm(addr.to_api_dm())
+            size = entry_size(addr)
+        if size > self._main_bytes:
+            self.evictions += 1
+            return
+        excess = self._probation.bytes + self._protected.bytes + size - (
+            self._main_bytes
+        )
+        victims: List[str] = []
+        for victim in self._victims():
+            if excess <= 0:
+                break
+            if frequency <= self._sketch.estimate(victim):
+                self.evictions += 1
+                return
+            victims.append(victim)
+            excess -= self._segments[victim].entries[victim][1]
+        for victim in victims:
+            self.evictions += 1
+            self._segments.pop(victim).pop(victim)
+        self._probation.put(nickname, addr, size)
+        self._segments[nickname] = self._probation
+
+    def _discard(self, nickname: str) -> None:
+        segment = self._segments.pop(nickname, None)
+        if segment is not None:
+            segment.pop(nickname)
+
+    def _invalidate(self, nickname: str) -> None:
+        self._generation += 1
+        self._discard(nickname)
+
+    # CRUD
+
+    async def create_address(
+        self,
+        addr: AddressEntry,
+        nickname: str = None
+    ) -> str:
+        return await self.db.create_address(addr, nickname)
+
+    async def _read(self, nickname: str) -> AddressEntry:
+        addr = self._get(nickname)
+        if addr is not None:
+            return addr
+
+        # The stored JSON, which is neither parsed nor decoded until used
+        generation = self._generation
+        addr = LazyAddressEntry.from_json(
+            await self.db.read_address_raw(nickname)
+        )
+        if generation == self._generation:
+            self._admit(nickname, addr)
+        return addr
+
+    async def read_address(self, nickname: str) -> AddressEntry:
+        return await self._read(nickname)
+
+    async def read_address_raw(self, nickname: str) -> bytes:
+        return encode_entry(await self._read(nickname))
+
+    async def read_address_version(self, nickname: str) -> str:
+        return await self.db.read_address_version(nickname)
+
+    async def update_address(
+        self,
+        nickname: str,
+        addr: AddressEntry,
+        if_match: Sequence[str] = None
+    ) -> None:
+        try:
+            await self.db.update_address(nickname, addr, if_match)
+        finally:
+            self._invalidate(nickname)
+
+    async def delete_address(
+        self,
+        nickname: str,
+        if_match: Sequence[str] = None
+    ) -> None:
+        try:
+            await self.db.delete_address(nickname, if_match)
+        finally:
+            self._invalidate(nickname)
+
+    async def read_all_addresses(
+        self
+    ) -> AsyncIterator[Tuple[str, AddressEntry]]:
+        async for nickname, addr in self.db.read_all_addresses():
+            yield nickname, addr
+
+    async def read_all_addresses_raw(
+        self
+    ) -> AsyncIterator[Tuple[str, bytes]]:
+        async for nickname, addr in self.db.read_all_addresses_raw():
+            yield nickname, addr
+
+    async def read_addresses_version(self) -> str:
+        return await self.db.read_addresses_version()
+
+    async def read_addresses_page(
+        self,
+        limit: int,
+        after: str = None
+    ) -> List[Tuple[str, AddressEntry]]:
+        return await self.db.read_addresses_page(limit, after)
+
+    async def read_addresses_page_raw(
+        self,
+        limit: int,
+        after: str = None
+    ) -> List[Tuple[str, bytes]]:
+        return await self.db.read_addresses_page_raw(limit, after)
+
+    async def find_nicknames(self, criteria: Mapping[str, Any]) -> List[str]:
+        return await self.db.find_nicknames(criteria)
+
+    async def search_nicknames(self, query: str, limit: int) -> List[str]:
+        return await self.db.search_nicknames(query, limit)
+
+    # Batches
+
+    async def write_addresses(
+        self,
+        writes: Sequence[AddressWrite]
+    ) -> List[Optional[KeyError]]:
+        try:
+            return await self.db.write_addresses(writes)
+        finally:
+            for write in writes:
+                self._invalidate(write.nickname)
@@ -0,0 +1,151 @@
+# Copyright (c) 2020. All rights reserved.
+
+import asyncio
+import fcntl
+import os
+from typing import List, Optional, Set, Tuple
+
+from addrservice.database.records import encode_record, read_records
+
+# Durability of the writes of an engine with a write-ahead log
+DURABILITY_NONE = 'none'    # no log, nothing is fsynced
+DURABILITY_BATCH = 'batch'  # concurrent writes share an fsync of the log
+DURABILITY_WRITE = 'write'  # every write fsyncs the log on its own
+DURABILITY_MODES = [DURABILITY_NONE, DURABILITY_BATCH, DURABILITY_WRITE]
+
+
+class WriteAheadLog:
+    '''
+    Append-only log of records (see records.encode_record) of changes
+    that must survive a crash before, or while, they are applied elsewhere.
+
+    append() writes a record at once, and sync() waits until it is on disk.
+    With group commit, a sync() called while an fsync is running waits for
+    the next one, which covers every record appended in the meantime: N
+    concurrent writers cost two fsyncs rather than N.
+
+    open() returns the records left by the last run, and locks the log so
+    that no other process can open it. Once the changes have been applied
+    durably, truncate() or, on the event loop, empty() empties the log.
+    '''
+
+    def __init__(self, path: str, group_commit: bool = True):
+        self.path = path
+        self.group_commit = group_commit
+        self.syncs = 0
+        self._fd: Optional[int] = None
+        self._size = 0
+        # Waited on by the sync() calls made since the running fsync began
+        self._next_sync: Optional[asyncio.Future] = None
+        self._syncing: Optional[asyncio.Future] = None
+        # fsyncs running without group commit
+        self._fsyncs: Set[asyncio.Future] = set()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def _log_fd(self) -> int:
+        if self._fd is None:
+            raise RuntimeError('Log {} is not open'.format(self.path))
+        return self._fd
+
+    def open(self) -> List[Tuple[int, str, bytes]]:
+        '''(op, key, value) of the records in the log.'''
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            raise RuntimeError(
+                'Log {} is in use by another process'.format(self.path)
+            )
+
+        records = []
+        size = 0
+        with open(self.path, mode='rb') as f:
+            for op, key, value, _, size in read_records(f):
+                records.append((op, key.decode('utf-8'), value))
+        # Drop a torn record left at the tail by a crash
+        os.ftruncate(fd, size)
+
+        self._fd = fd
+        self._size = size
+        return records
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def append(self, op: int, key: str, value: bytes = b'') -> None:
+        fd = self._log_fd()
+        view = memoryview(encode_record(op, key.encode('utf-8'), value))
+        self._size += len(view)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+
+    def _fsync(self) -> None:
+        os.fsync(self._log_fd())
+        self.syncs += 1
+
+    async def sync(self) -> None:
+        '''Waits until the records appended so far are on disk.'''
+        loop = asyncio.get_event_loop()
+        if not self.group_commit:
+            fsync = asyncio.ensure_future(
+                loop.run_in_executor(None, self._fsync)
+            )
+            self._fsyncs.add(fsync)
+            fsync.add_done_callback(self._fsyncs.discard)
+            await fsync
+            return
+
+        if self._next_sync is None:
+            self._next_sync = loop.create_future()
+        waiter = self._next_sync
+        if self._syncing is None or self._syncing.done():
+            self._syncing = asyncio.ensure_future(self._sync_groups())
+        await asyncio.shield(waiter)
+
+    async def _sync_groups(self) -> None:
+        loop = asyncio.get_event_loop()
+        while self._next_sync is not None:
+            group, self._next_sync = self._next_sync, None
+            try:
+                await loop.run_in_executor(None, self._fsync)
+            except Exception as e:
+                group.set_exception(e)
+            else:
+                group.set_result(None)
+
+    async def drain(self) -> None:
+        '''
+        Waits until the fsyncs running or waited for are done, so that a log
+        no longer appended to can be closed.
+        '''
+        running = set(self._fsyncs)
+        if self._syncing is not None:
+            running.add(self._syncing)
+        if running:
+            await asyncio.wait(running)
+
+    def truncate(self) -> None:
+        truncate_file(self._log_fd())
+        self._size = 0
+
+    async def empty(self) -> None:
+        '''
+        truncate() in the default executor, as fsyncs of the log run, so that
+        the event loop serves requests meanwhile. Nothing may be appended
+        until it is done.
+        '''
+        fd = self._log_fd()
+        await asyncio.get_event_loop().run_in_executor(None, truncate_file, fd)
+        self._size = 0
+
+
+def truncate_file(fd: int) -> None:
+    os.ftruncate(fd, 0)
+    os.fsync(fd)
@@ -1,8 +1,10 @@
 # Copyright (c) 2020. All rights reserved.
 
 from enum import Enum, unique
+import json
 from typing import (
     Any,
+    Dict,
     Mapping,
     Optional,
     Sequence,
@@ -12,6 +14,9 @@ from typing import (
 
 VALUE_ERR_MSG = '{} has invalid value {}'
 
+# Lists of sub-objects of an AddressEntry, as named in its API data model
+LIST_FIELDS = ('addresses', 'phone_numbers', 'fax_numbers', 'emails')
+
 
 @unique
 class AddressType(Enum):
@@ -20,6 +25,20 @@ class AddressType(Enum):
 
 
 class Address:
+    # No per-instance __dict__: an address book holds millions of these
+    __slots__ = (
+        '_kind',
+        '_building_name',
+        '_unit_number',
+        '_street_number',
+        '_street_name',
+        '_locality',
+        '_city',
+        '_province',
+        '_pincode',
+        '_country',
+    )
+
     def __init__(
         self,
         kind: AddressType,
@@ -55,17 +74,18 @@ class Address:
 
     @classmethod
     def from_api_dm(cls, vars: Mapping[str, Any]) -> 'Address':
-        return Address(
-            kind=AddressType[vars['kind']],
-            street_name=vars['street_name'],
-            pincode=vars['pincode'],
-            country=vars['country'],
-            building_name=vars.get('building_name'),
-            unit_number=vars.get('unit_number'),
-            street_number=vars.get('street_number'),
-            locality=vars.get('locality'),
-            city=vars.get('city'),
-            province=vars.get('province'),
+        get = vars.get
+        return cls(
+            AddressType[vars['kind']],
+            vars['street_name'],
+            vars['pincode'],
+            vars['country'],
+            get('building_name'),
+            get('unit_number'),
+            get('street_number'),
+            get('locality'),
+            get('city'),
+            get('province'),
         )
 
     @property
@@ -128,7 +148,7 @@ class Address:
 
     @city.setter
     def city(self, value: str) -> None:
-        self._ = value
+        self._city = value
 
     @property
     def province(self) -> Optional[str]:
@@ -161,23 +181,29 @@ class Address:
         self._country = value
 
     def to_api_dm(self) -> Mapping[str, Any]:
-        d = {
-            'kind': self.kind.name,
-            'building_name': self.building_name,
-            'unit_number': self.unit_number,
-            'street_number': self.street_number,
-            'street_name': self.street_name,
-            'locality': self.locality,
-            'city': self.city,
-            'province': self.province,
-            'pincode': self.pincode,
-            'country': self.country,
-        }
-
-        return {k: v for k, v in d.items() if v is not None}
+        # Optional fields are added only when set, in one pass
+        d: Dict[str, Any] = {'kind': self._kind.name}
+        if self._building_name is not None:
+            d['building_name'] = self._building_name
+        if self._unit_number is not None:
+            d['unit_number'] = self._unit_number
+        if self._street_number is not None:
+            d['street_number'] = self._street_number
+        d['street_name'] = self._street_name
+        if self._locality is not None:
+            d['locality'] = self._locality
+        if self._city is not None:
+            d['city'] = self._city
+        if self._province is not None:
+            d['province'] = self._province
+        d['pincode'] = self._pincode
+        d['country'] = self._country
+        return d
 
 
 class Phone:
+    __slots__ = ('_kind', '_country_code', '_area_code', '_local_number')
+
     def __init__(
         self,
         kind: AddressType,
@@ -205,11 +231,11 @@ class Phone:
 
     @classmethod
     def from_api_dm(cls, vars: Mapping[str, Any]) -> 'Phone':
-        return Phone(
-            kind=AddressType[vars['kind']],
-            country_code=vars['country_code'],
-            local_number=vars['local_number'],
-            area_code=vars.get('area_code'),
+        return cls(
+            AddressType[vars['kind']],
+            vars['country_code'],
+            vars['local_number'],
+            vars.get('area_code'),
         )
 
     @property
@@ -240,7 +266,7 @@ class Phone:
 
     @area_code.setter
     def area_code(self, value: int) -> None:
-        self._ = value
+        self._area_code = value
 
     @property
     def local_number(self) -> int:
@@ -254,17 +280,19 @@ class Phone:
         self._local_number = value
 
     def to_api_dm(self) -> Mapping[str, Any]:
-        d = {
-            'kind': self.kind.name,
-            'country_code': self.country_code,
-            'area_code': self.area_code,
-            'local_number': self.local_number,
+        d: Dict[str, Any] = {
+            'kind': self._kind.name,
+            'country_code': self._country_code,
         }
-
-        return {k: v for k, v in d.items() if v is not None}
+        if self._area_code is not None:
+            d['area_code'] = self._area_code
+        d['local_number'] = self._local_number
+        return d
 
 
 class Email:
+    __slots__ = ('_kind', '_email')
+
     def __init__(
         self,
         kind: AddressType,
@@ -280,10 +308,7 @@ class Email:
 
     @classmethod
     def from_api_dm(cls, vars: Mapping[str, Any]) -> 'Email':
-        return Email(
-            kind=AddressType[vars['kind']],
-            email=vars['email'],
-        )
+        return cls(AddressType[vars['kind']], vars['email'])
 
     @property
     def kind(self) -> AddressType:
@@ -308,15 +333,18 @@ class Email:
         self._email = value
 
     def to_api_dm(self) -> Mapping[str, Any]:
-        d = {
-            'kind': self.kind.name,
-            'email': self.email,
-        }
-
-        return {k: v for k, v in d.items() if v is not None}
+        return {'kind': self._kind.name, 'email': self._email}
 
 
 class AddressEntry:
+    __slots__ = (
+        '_full_name',
+        '_addresses',
+        '_phone_numbers',
+        '_fax_numbers',
+        '_emails',
+    )
+
     def __init__(
         self,
         full_name: str,
@@ -336,20 +364,13 @@ class AddressEntry:
 
     @classmethod
     def from_api_dm(cls, vars: Mapping[str, Any]) -> 'AddressEntry':
-        return AddressEntry(
-            full_name=vars['full_name'],
-            addresses=[
-                Address.from_api_dm(x) for x in vars.get('addresses', [])
-            ],
-            phone_numbers=[
-                Phone.from_api_dm(x) for x in vars.get('phone_numbers', [])
-            ],
-            fax_numbers=[
-                Phone.from_api_dm(x) for x in vars.get('fax_numbers', [])
-            ],
-            emails=[
-                Email.from_api_dm(x) for x in vars.get('emails', [])
-            ],
+        get = vars.get
+        return cls(
+            vars['full_name'],
+            [Address.from_api_dm(x) for x in get('addresses', ())],
+            [Phone.from_api_dm(x) for x in get('phone_numbers', ())],
+            [Phone.from_api_dm(x) for x in get('fax_numbers', ())],
+            [Email.from_api_dm(x) for x in get('emails', ())],
         )
 
     @property
@@ -396,12 +417,173 @@ class AddressEntry:
         self._emails = list(value)
 
     def to_api_dm(self) -> Mapping[str, Any]:
-        d = {
-            'full_name': self.full_name,
-            'addresses': [x.to_api_dm() for x in self.addresses],
-            'phone_numbers': [x.to_api_dm() for x in self.phone_numbers],
-            'fax_numbers': [x.to_api_dm() for x in self.fax_numbers],
-            'emails': [x.to_api_dm() for x in self.emails],
+        return {
+            'full_name': self._full_name,
+            'addresses': [x.to_api_dm() for x in self._addresses],
+            'phone_numbers': [x.to_api_dm() for x in self._phone_numbers],
+            'fax_numbers': [x.to_api_dm() for x in self._fax_numbers],
+            'emails': [x.to_api_dm() for x in self._emails],
         }
 
-        return {k: v for k, v in d.items() if v is not None}
+
+class LazyAddressEntry(AddressEntry):
+    '''
+    An AddressEntry read from storage, which keeps the API data model it
+    was made from. Its addresses, phone and fax numbers and emails are only
+    decoded on first access, so scans that need the full name alone do not
+    build them.
+
+    The mapping must be the API data model of a valid entry, as stored
+    entries are: it is checked when written, not here. to_api_dm() returns
+    it as is until a field is set, or a list is decoded (its objects may
+    have been modified since).
+
+    An entry made by from_json() keeps the JSON of that mapping, and does
+    not even parse it until a field is accessed; to_json() returns it as is
+    on the same terms.
+    '''
+
+    # Slots of the lists stay unset until they are decoded or set, and
+    # those of the mapping and full name until the JSON is parsed
+    __slots__ = ('_vars', '_json', '_decoded')
+
+    def __init__(self, vars: Mapping[str, Any]):
+        full_name = vars['full_name']
+        if not full_name:
+            raise ValueError(VALUE_ERR_MSG.format('full_name', full_name))
+
+        self._vars = vars
+        self._json: Optional[bytes] = None
+        self._full_name = full_name
+        self._decoded = False
+
+    @classmethod
+    def from_api_dm(cls, vars: Mapping[str, Any]) -> 'LazyAddressEntry':
+        return cls(vars)
+
+    @classmethod
+    def from_json(cls, data: bytes) -> 'LazyAddressEntry':
+        entry = cls.__new__(cls)
+        entry._json = data
+        entry._decoded = False
+        return entry
+
+    def _api_dm(self) -> Mapping[str, Any]:
+        try:
+            return self._vars
+        except AttributeError:
+            assert self._json is not None
+            self._vars = json.loads(self._json)
+            return self._vars
+
+    @property
+    def full_name(self) -> str:
+        try:
+            return self._full_name
+        except AttributeError:
+            self._full_name = self._api_dm()['full_name']
+            return self._full_name
+
+    @full_name.setter
+    def full_name(self, value: str) -> None:
+        if not value:
+            raise ValueError(VALUE_ERR_MSG.format('full_name', value))
+
+        self._decoded = True
+        self._full_name = value
+
+    @property
+    def addresses(self) -> Sequence[Address]:
+        try:
+            return self._addresses
+        except AttributeError:
+            self._decoded = True
+            self._addresses = [
+                Address.from_api_dm(x)
+                for x in self._api_dm().get('addresses', ())
+            ]
+            return self._addresses
+
+    @addresses.setter
+    def addresses(self, value: Sequence[Address]) -> None:
+        self._decoded = True
+        self._addresses = list(value)
+
+    @property
+    def phone_numbers(self) -> Sequence[Phone]:
+        try:
+            return self._phone_numbers
+        except AttributeError:
+            self._decoded = True
+            self._phone_numbers = [
+                Phone.from_api_dm(x)
+                for x in self._api_dm().get('phone_numbers', ())
+            ]
+            return self._phone_numbers
+
+    @phone_numbers.setter
+    def phone_numbers(self, value: Sequence[Phone]) -> None:
+        self._decoded = True
+        self._phone_numbers = list(value)
+
+    @property
+    def fax_numbers(self) -> Sequence[Phone]:
+        try:
+            return self._fax_numbers
+        except AttributeError:
+            self._decoded = True
+            self._fax_numbers = [
+                Phone.from_api_dm(x)
+                for x in self._api_dm().get('fax_numbers', ())
+            ]
+            return self._fax_numbers
+
+    @fax_numbers.setter
+    def fax_numbers(self, value: Sequence[Phone]) -> None:
+        self._decoded = True
+        self._fax_numbers = list(value)
+
+    @property
+    def emails(self) -> Sequence[Email]:
+        try:
+            return self._emails
+        except AttributeError:
+            self._decoded = True
+            self._emails = [
+                Email.from_api_dm(x)
+                for x in self._api_dm().get('emails', ())
+            ]
+            return self._emails
+
+    @emails.setter
+    def emails(self, value: Sequence[Email]) -> None:
+        self._decoded = True
+        self._emails = list(value)
+
+    def to_api_dm(self) -> Mapping[str, Any]:
+        vars = self._api_dm()
+        if not self._decoded and all(name in vars for name in LIST_FIELDS):
+            return vars
+
+        d: Dict[str, Any] = {'full_name': self.full_name}
+        for name in LIST_FIELDS:
+            try:
+                items = getattr(self, '_' + name)
+            except AttributeError:
+                d[name] = vars.get(name, [])
+            else:
+                d[name] = [x.to_api_dm() for x in items]
+        return d
+
+    @property
+    def raw_json(self) -> Optional[bytes]:
+        # The JSON it was made from, while to_json() returns it as is
+        if self._json is not None and not self._decoded:
+            return self._json
+        return None
+
+    def to_json(self) -> bytes:
+        raw = self.raw_json
+        if raw is not None:
+            return raw
+        return json.dumps(self.to_api_dm()).encode('utf-8')
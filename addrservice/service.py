@@ -1,12 +1,80 @@
 # Copyright (c) 2020. All rights reserved.
 
+import base64
+import binascii
+from bisect import bisect_right
+import json
 import jsonschema  # type: ignore
 import logging
-from typing import AsyncIterator, Mapping, Tuple
+import re
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple
+)
+import uuid
 
 from addrservice import ADDRESS_BOOK_SCHEMA
+from addrservice.database.addressbook_db import (
+    AddressWrite,
+    WRITE_CREATE,
+    WRITE_DELETE,
+    WRITE_UPDATE,
+)
 from addrservice.database.db_engines import create_addressbook_db
+from addrservice.database.indexes import search_words
 from addrservice.datamodel import AddressEntry
+from addrservice.utils.response_cache import CachedResponse, ResponseCache
+
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+
+DEFAULT_SEARCH_LIMIT = 10
+MAX_SEARCH_LIMIT = 100
+
+MAX_BATCH_SIZE = 1000
+# Same as the ids in the entry URIs
+NICKNAME_REGEX = re.compile(r'[a-zA-Z0-9-]+')
+# Ids whose entry URIs are taken by other endpoints
+RESERVED_NICKNAMES = ['search']
+
+
+def make_address_validator(schema: Mapping = ADDRESS_BOOK_SCHEMA) -> Any:
+    # jsonschema.validate() checks the schema against its meta-schema and
+    # builds a new validator (and ref resolver) on every call. Do it once.
+    validator_cls = jsonschema.validators.validator_for(schema)
+    validator_cls.check_schema(schema)
+    return validator_cls(schema)
+
+
+def encode_cursor(nickname: str) -> str:
+    cursor = base64.urlsafe_b64encode(nickname.encode('utf-8'))
+    return cursor.decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> str:
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        nickname = base64.b64decode(padded, altchars=b'-_', validate=True)
+        return nickname.decode('utf-8')
+    except (binascii.Error, UnicodeError):
+        raise ValueError('Invalid cursor')
+
+
+def decode_page(page: List[Tuple[str, bytes]]) -> List[Tuple[str, Mapping]]:
+    return [(nickname, json.loads(addr)) for nickname, addr in page]
+
+
+def check_page_limit(limit: int) -> None:
+    if not 0 < limit <= MAX_PAGE_LIMIT:
+        raise ValueError(
+            'limit must be between 1 and {}'.format(MAX_PAGE_LIMIT)
+        )
 
 
 class AddressBookService:
@@ -16,6 +84,12 @@ class AddressBookService:
         logger: logging.Logger
     ) -> None:
         self.addr_db = create_addressbook_db(config['addr-db'])
+        self.addr_validator = make_address_validator()
+        response_cache_config = config.get('response-cache') or {}
+        self.response_cache = ResponseCache(
+            max_entries=response_cache_config.get('max-entries', 0),
+            compress=response_cache_config.get('gzip', False),
+        )
         self.logger = logger
 
     def start(self):
@@ -25,9 +99,7 @@ class AddressBookService:
         self.addr_db.stop()
 
     def validate_address(self, addr: Mapping) -> None:
-        try:
-            jsonschema.validate(addr, ADDRESS_BOOK_SCHEMA)
-        except jsonschema.exceptions.ValidationError:
+        if not self.addr_validator.is_valid(addr):
             raise ValueError('JSON Schema validation failed')
 
     async def create_address(self, value: Mapping) -> str:
@@ -40,14 +112,275 @@ class AddressBookService:
         addr = await self.addr_db.read_address(key)
         return addr.to_api_dm()
 
-    async def update_address(self, key: str, value: Mapping) -> None:
+    async def get_address_version(self, key: str) -> str:
+        return await self.addr_db.read_address_version(key)
+
+    async def get_addresses_version(self) -> str:
+        return await self.addr_db.read_addresses_version()
+
+    async def get_address_response(
+        self,
+        key: str,
+        version: str = None
+    ) -> CachedResponse:
+        # Without a cache, the version is only needed if the caller has it
+        # already, for its ETag
+        if not self.response_cache.max_entries:
+            body = await self.addr_db.read_address_raw(key)
+            return self.response_cache.make(version, body)
+
+        if version is None:
+            version = await self.addr_db.read_address_version(key)
+        response = self.response_cache.get(key, version)
+        if response is not None:
+            return response
+
+        # The stored JSON, not decoded; it was validated when written
+        body = await self.addr_db.read_address_raw(key)
+        response = self.response_cache.make(version, body)
+
+        # Do not cache the body under this version if a write got in
+        if await self.addr_db.read_address_version(key) == version:
+            self.response_cache.put(key, response)
+
+        return response
+
+    async def update_address(
+        self,
+        key: str,
+        value: Mapping,
+        if_match: Sequence[str] = None
+    ) -> None:
         self.validate_address(value)
         addr = AddressEntry.from_api_dm(value)
-        await self.addr_db.update_address(key, addr)
+        # With if_match, the DB checks the version of the entry as it
+        # writes it
+        try:
+            await self.addr_db.update_address(key, addr, if_match)
+        finally:
+            self.response_cache.invalidate(key)
 
-    async def delete_address(self, key: str) -> None:
-        await self.addr_db.delete_address(key)
+    async def delete_address(
+        self,
+        key: str,
+        if_match: Sequence[str] = None
+    ) -> None:
+        try:
+            await self.addr_db.delete_address(key, if_match)
+        finally:
+            self.response_cache.invalidate(key)
 
     async def get_all_addresses(self) -> AsyncIterator[Tuple[str, Mapping]]:
         async for nickname, addr in self.addr_db.read_all_addresses():
             yield nickname, addr.to_api_dm()
+
+    async def get_all_addresses_raw(self) -> AsyncIterator[Tuple[str, bytes]]:
+        # As get_all_addresses(), with the JSON of each entry as stored
+        async for nickname, addr in self.addr_db.read_all_addresses_raw():
+            yield nickname, addr
+
+    async def get_addresses_page(
+        self,
+        limit: int = DEFAULT_PAGE_LIMIT,
+        cursor: str = None
+    ) -> Tuple[List[Tuple[str, Mapping]], Optional[str]]:
+        page, next_cursor = await self.get_addresses_page_raw(limit, cursor)
+        return decode_page(page), next_cursor
+
+    async def get_addresses_page_raw(
+        self,
+        limit: int = DEFAULT_PAGE_LIMIT,
+        cursor: str = None
+    ) -> Tuple[List[Tuple[str, bytes]], Optional[str]]:
+        check_page_limit(limit)
+        after = None if cursor is None else decode_cursor(cursor)
+
+        # One extra entry tells whether there is a next page
+        page = await self.addr_db.read_addresses_page_raw(limit + 1, after)
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = encode_cursor(page[-1][0])
+
+        return page, next_cursor
+
+    async def find_addresses(
+        self,
+        criteria: Mapping[str, Any],
+        limit: int = DEFAULT_PAGE_LIMIT,
+        cursor: str = None
+    ) -> Tuple[List[Tuple[str, Mapping]], Optional[str]]:
+        '''
+        A page of the entries that match all criteria, such as
+        {'email': ..., 'city': ...}, in nickname order. Paged the same way
+        as get_addresses_page().
+        '''
+        page, next_cursor = await self.find_addresses_raw(
+            criteria, limit, cursor
+        )
+        return decode_page(page), next_cursor
+
+    async def find_addresses_raw(
+        self,
+        criteria: Mapping[str, Any],
+        limit: int = DEFAULT_PAGE_LIMIT,
+        cursor: str = None
+    ) -> Tuple[List[Tuple[str, bytes]], Optional[str]]:
+        check_page_limit(limit)
+        after = None if cursor is None else decode_cursor(cursor)
+
+        nicknames = await self.addr_db.find_nicknames(criteria)
+        start = 0 if after is None else bisect_right(nicknames, after)
+        page_nicknames = nicknames[start:start + limit]
+        next_cursor = None
+        if start + limit < len(nicknames):
+            next_cursor = encode_cursor(page_nicknames[-1])
+
+        page = []
+        for nickname in page_nicknames:
+            try:
+                addr = await self.addr_db.read_address_raw(nickname)
+            except KeyError:
+                # Deleted since it was found
+                continue
+            page.append((nickname, addr))
+
+        return page, next_cursor
+
+    async def search_addresses(
+        self,
+        query: str,
+        limit: int = DEFAULT_SEARCH_LIMIT
+    ) -> List[Tuple[str, Mapping]]:
+        '''
+        The limit entries that best match the words of query, best first.
+        Each word matches the words of full names, street names and
+        localities that start with it.
+        '''
+        if not 0 < limit <= MAX_SEARCH_LIMIT:
+            raise ValueError(
+                'limit must be between 1 and {}'.format(MAX_SEARCH_LIMIT)
+            )
+        if not search_words(query):
+            raise ValueError('Search query has no words')
+
+        results = []
+        for nickname in await self.addr_db.search_nicknames(query, limit):
+            try:
+                addr = await self.addr_db.read_address(nickname)
+            except KeyError:
+                # Deleted since it was found
+                continue
+            results.append((nickname, addr.to_api_dm()))
+        return results
+
+    def make_address_write(self, op: Any) -> AddressWrite:
+        if not isinstance(op, Mapping):
+            raise ValueError('Operation must be an object')
+
+        write_op = op.get('op')
+        if write_op not in (WRITE_CREATE, WRITE_UPDATE, WRITE_DELETE):
+            raise ValueError('Invalid op {}'.format(write_op))
+
+        nickname = op.get('id')
+        if nickname is None and write_op == WRITE_CREATE:
+            nickname = uuid.uuid4().hex
+        if not (
+            isinstance(nickname, str) and NICKNAME_REGEX.fullmatch(nickname)
+        ):
+            raise ValueError('Invalid id {}'.format(nickname))
+        if write_op == WRITE_CREATE and nickname in RESERVED_NICKNAMES:
+            raise ValueError('Reserved id {}'.format(nickname))
+
+        if write_op == WRITE_DELETE:
+            return AddressWrite(write_op, nickname)
+
+        value = op.get('address')
+        if not isinstance(value, Mapping):
+            raise ValueError('Invalid address')
+        self.validate_address(value)
+        return AddressWrite(
+            write_op, nickname, AddressEntry.from_api_dm(value)
+        )
+
+    async def write_addresses(self, ops: Sequence[Any]) -> List[Dict]:
+        '''
+        Applies a batch of operations, each one of:
+            {"op": "create", "address": {...}}, with an optional "id"
+            {"op": "update", "id": ..., "address": {...}}
+            {"op": "delete", "id": ...}
+
+        All operations are validated first, then the valid ones are sent
+        to the DB as one batch. Returns a result for each operation, in
+        order, with the HTTP status it would have had on its own.
+        '''
+        if not 0 < len(ops) <= MAX_BATCH_SIZE:
+            raise ValueError(
+                'Batch must have between 1 and {} operations'.format(
+                    MAX_BATCH_SIZE
+                )
+            )
+
+        results, writes = self.make_address_writes(ops)
+        await self.apply_address_writes(results, writes)
+        return results
+
+    async def import_addresses(self, entries: Sequence[Any]) -> List[Dict]:
+        '''
+        Imports a batch of {"id": ..., "address": {...}} entries, as made by
+        export. An entry is created, or replaces the entry with the same id.
+        Returns a result for each entry, as write_addresses() does.
+        '''
+        results, writes = self.make_address_writes([
+            dict(entry, op=WRITE_CREATE)
+            if isinstance(entry, Mapping) else entry
+            for entry in entries
+        ])
+        await self.apply_address_writes(results, writes)
+
+        # Entries that already exist are replaced
+        conflicts = [
+            (i, write._replace(op=WRITE_UPDATE))
+            for i, write in writes if results[i]['status'] == 409
+        ]
+        if conflicts:
+            await self.apply_address_writes(results, conflicts)
+
+        return results
+
+    def make_address_writes(
+        self,
+        ops: Sequence[Any]
+    ) -> Tuple[List[Dict], List[Tuple[int, AddressWrite]]]:
+        # Results with the errors of invalid ops filled in, and the writes
+        # for valid ones along with their positions in results
+        results: List[Dict] = []
+        writes: List[Tuple[int, AddressWrite]] = []
+        for op in ops:
+            try:
+                writes.append((len(results), self.make_address_write(op)))
+                results.append({})
+            except ValueError as e:
+                results.append({'status': 400, 'message': str(e)})
+        return results, writes
+
+    async def apply_address_writes(
+        self,
+        results: List[Dict],
+        writes: Sequence[Tuple[int, AddressWrite]]
+    ) -> None:
+        try:
+            errors = await self.addr_db.write_addresses(
+                [write for _, write in writes]
+            )
+        finally:
+            for _, write in writes:
+                self.response_cache.invalidate(write.nickname)
+
+        for (i, write), error in zip(writes, errors):
+            results[i] = {'id': write.nickname}
+            if error is None:
+                results[i]['status'] = 201 if write.op == WRITE_CREATE else 204
+            else:
+                results[i]['status'] = 409 if write.op == WRITE_CREATE else 404
+                results[i]['message'] = str(error)
@@ -5,27 +5,72 @@ import logging
 from types import TracebackType
 from typing import (
     Any,
+    AsyncIterator,
     Awaitable,
     Dict,
+    List,
     Optional,
     Tuple,
     Type,
 )
 import traceback
+from urllib.parse import urlencode
 import uuid
 
 import tornado.web
 
 from addrservice import LOGGER_NAME
-from addrservice.service import AddressBookService
+from addrservice.database.addressbook_db import VersionMismatchError
+from addrservice.database.indexes import INDEXED_FIELDS
+from addrservice.service import (
+    AddressBookService,
+    DEFAULT_PAGE_LIMIT,
+    DEFAULT_SEARCH_LIMIT
+)
 import addrservice.utils.logutils as logutils
 
 ADDRESSBOOK_REGEX = r'/addresses/?'
+ADDRESSBOOK_BATCH_REGEX = r'/addresses:batch/?'
+ADDRESSBOOK_EXPORT_REGEX = r'/addresses:export/?'
+ADDRESSBOOK_IMPORT_REGEX = r'/addresses:import/?'
+# Also matches the entry regex, so it must come before it
+ADDRESSBOOK_SEARCH_REGEX = r'/addresses/search/?'
 ADDRESSBOOK_ENTRY_REGEX = r'/addresses/(?P<id>[a-zA-Z0-9-]+)/?'
 ADDRESSBOOK_ENTRY_URI_FORMAT_STR = r'/addresses/{id}'
 
+# Streamed responses are flushed to the client whenever this many bytes have
+# been buffered, so memory held per response does not grow with book size.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+JSON_CONTENT_TYPE = 'application/json; charset=UTF-8'
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+# Imports are written in batches of this many entries. Only the current
+# batch and a partial line are held in memory, whatever the body size.
+IMPORT_BATCH_SIZE = 500
+IMPORT_MAX_BODY_SIZE = 64 * 1024 ** 3
+IMPORT_MAX_LINE_SIZE = 1024 * 1024
+# Errors listed in an import response; all of them are counted
+IMPORT_MAX_ERRORS = 100
+
+
+def json_member(name: str, value: bytes) -> bytes:
+    # "name": value, for a JSON object made of values already encoded, as
+    # json.dumps() would write it
+    return json.dumps(name).encode('utf-8') + b': ' + value
+
+
+def json_object(members: List[Tuple[str, bytes]]) -> bytes:
+    return b'{' + b', '.join(
+        json_member(name, value) for name, value in members
+    ) + b'}'
+
 
 class BaseRequestHandler(tornado.web.RequestHandler):
+    # Requests being handled by this process. The server waits for it to
+    # drop to zero before shutting down.
+    in_flight = 0
+
     def initialize(
         self,
         service: AddressBookService,
@@ -37,6 +82,9 @@ class BaseRequestHandler(tornado.web.RequestHandler):
         self.logger = logger
 
     def prepare(self) -> Optional[Awaitable[None]]:
+        BaseRequestHandler.in_flight += 1
+        self._in_flight = True
+
         req_id = uuid.uuid4().hex
         logutils.set_log_context(
             req_id=req_id,
@@ -55,8 +103,42 @@ class BaseRequestHandler(tornado.web.RequestHandler):
         return super().prepare()
 
     def on_finish(self) -> None:
+        if getattr(self, '_in_flight', False):
+            BaseRequestHandler.in_flight -= 1
+            self._in_flight = False
         super().on_finish()
 
+    def set_version_etag(self, version: str) -> bool:
+        # Returns whether the client's If-None-Match matches the new ETag.
+        # Tornado only hashes the body for an ETag when none has been set.
+        self.set_header('Etag', '"{}"'.format(version))
+        return self.check_etag_header()
+
+    def not_modified(self) -> None:
+        self.set_status(304)
+        self.finish()
+
+    def if_match_versions(self) -> Optional[List[str]]:
+        # Versions in the If-Match header; None if absent or '*'. If-Match
+        # uses strong comparison, so weak ETags never match.
+        if_match = self.request.headers.get('If-Match')
+        if if_match is None or if_match.strip() == '*':
+            return None
+
+        etags = [etag.strip() for etag in if_match.split(',')]
+        return [etag[1:-1] for etag in etags if etag.startswith('"')]
+
+    async def write_stream(self, chunks: AsyncIterator[bytes]) -> None:
+        # Awaiting flush() holds the producer back until the client has
+        # taken the previous chunk.
+        buffered = 0
+        async for chunk in chunks:
+            self.write(chunk)
+            buffered += len(chunk)
+            if buffered >= STREAM_CHUNK_SIZE:
+                buffered = 0
+                await self.flush()
+
     def write_error(self, status_code: int, **kwargs: Any) -> None:
         self.set_header('Content-Type', 'application/json; charset=UTF-8')
         body = {
@@ -127,12 +209,67 @@ class DefaultRequestHandler(BaseRequestHandler):
 
 class AddressBookRequestHandler(BaseRequestHandler):
     async def get(self):
-        all_addrs = {}
-        async for nickname, addr in self.service.get_all_addresses():
-            all_addrs[nickname] = addr
+        version = await self.service.get_addresses_version()
+        if self.set_version_etag(version):
+            self.not_modified()
+            return
+
+        args = self.request.query_arguments
+        criteria = {
+            field: self.get_query_argument(field)
+            for field in INDEXED_FIELDS if field in args
+        }
+        if criteria or 'limit' in args or 'cursor' in args:
+            await self.get_page(criteria)
+            return
+
+        self.set_status(200)
+        self.set_header('Content-Type', JSON_CONTENT_TYPE)
+
+        # Write the JSON object one entry at a time as the service yields,
+        # with the stored JSON of entries as is
+        async def chunks() -> AsyncIterator[bytes]:
+            separator = b'{'
+            async for nickname, addr in self.service.get_all_addresses_raw():
+                yield separator + json_member(nickname, addr)
+                separator = b', '
+            yield b'{}' if separator == b'{' else b'}'
+
+        await self.write_stream(chunks())
+        self.finish()
+
+    async def get_page(self, criteria):
+        try:
+            limit = int(self.get_query_argument('limit', DEFAULT_PAGE_LIMIT))
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason='Invalid limit')
+
+        try:
+            cursor = self.get_query_argument('cursor', None)
+            if criteria:
+                page, next_cursor = await self.service.find_addresses_raw(
+                    criteria, limit, cursor
+                )
+            else:
+                page, next_cursor = (
+                    await self.service.get_addresses_page_raw(limit, cursor)
+                )
+        except KeyError as e:
+            # An entry of the page was deleted while it was read
+            raise tornado.web.HTTPError(409, reason=str(e))
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, reason=str(e))
+
+        if next_cursor is not None:
+            next_uri = '{}?{}'.format(
+                self.request.path,
+                urlencode(dict(criteria, limit=limit, cursor=next_cursor))
+            )
+            self.set_header('Link', '<{}>; rel="next"'.format(next_uri))
 
         self.set_status(200)
-        self.finish(all_addrs)
+        self.set_header('Content-Type', JSON_CONTENT_TYPE)
+        self.finish(json_object(page))
 
     async def post(self):
         try:
@@ -153,16 +290,38 @@ class AddressBookRequestHandler(BaseRequestHandler):
 class AddressBookEntryRequestHandler(BaseRequestHandler):
     async def get(self, id):
         try:
-            addr = await self.service.get_address(id)
-            self.set_status(200)
-            self.finish(addr)
+            version = await self.service.get_address_version(id)
+            if self.set_version_etag(version):
+                self.not_modified()
+                return
+            response = await self.service.get_address_response(id, version)
         except KeyError as e:
             raise tornado.web.HTTPError(404, reason=str(e))
 
+        self.set_status(200)
+        self.set_header('Content-Type', JSON_CONTENT_TYPE)
+
+        # With Content-Encoding already set, compress_response leaves the
+        # pre-gzipped body alone
+        accept_encoding = self.request.headers.get('Accept-Encoding', '')
+        if (
+            response.gzip_body is not None and
+            self.settings.get('compress_response') and
+            'gzip' in accept_encoding
+        ):
+            self.set_header('Content-Encoding', 'gzip')
+            self.finish(response.gzip_body)
+        else:
+            self.finish(response.body)
+
     async def put(self, id):
         try:
             addr = json.loads(self.request.body.decode('utf-8'))
-            await self.service.update_address(id, addr)
+            await self.service.update_address(
+                id, addr, self.if_match_versions()
+            )
+            version = await self.service.get_address_version(id)
+            self.set_header('Etag', '"{}"'.format(version))
             self.set_status(204)
             self.finish()
         except (json.decoder.JSONDecodeError, TypeError):
@@ -173,14 +332,176 @@ class AddressBookEntryRequestHandler(BaseRequestHandler):
             raise tornado.web.HTTPError(404, reason=str(e))
         except ValueError as e:
             raise tornado.web.HTTPError(400, reason=str(e))
+        except VersionMismatchError as e:
+            raise tornado.web.HTTPError(412, reason=str(e))
 
     async def delete(self, id):
         try:
-            await self.service.delete_address(id)
+            await self.service.delete_address(id, self.if_match_versions())
             self.set_status(204)
             self.finish()
         except KeyError as e:
             raise tornado.web.HTTPError(404, reason=str(e))
+        except VersionMismatchError as e:
+            raise tornado.web.HTTPError(412, reason=str(e))
+
+
+class AddressBookSearchRequestHandler(BaseRequestHandler):
+    async def get(self):
+        try:
+            limit = int(
+                self.get_query_argument('limit', str(DEFAULT_SEARCH_LIMIT))
+            )
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason='Invalid limit')
+
+        try:
+            results = await self.service.search_addresses(
+                self.get_query_argument('q'), limit
+            )
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, reason=str(e))
+
+        # A list, as the order is the ranking
+        self.set_status(200)
+        self.finish({
+            'results': [
+                {'id': nickname, 'address': addr}
+                for nickname, addr in results
+            ]
+        })
+
+
+class AddressBookBatchRequestHandler(BaseRequestHandler):
+    async def post(self):
+        # A JSON array of operations, or one operation per line (NDJSON)
+        content_type = self.request.headers.get('Content-Type', '')
+        try:
+            body = self.request.body.decode('utf-8')
+            if content_type.startswith(NDJSON_CONTENT_TYPE):
+                ops = [
+                    json.loads(line) for line in body.splitlines()
+                    if line.strip()
+                ]
+            else:
+                ops = json.loads(body)
+        except (json.decoder.JSONDecodeError, UnicodeError):
+            raise tornado.web.HTTPError(
+                400, reason='Invalid JSON body'
+            )
+        if not isinstance(ops, list):
+            raise tornado.web.HTTPError(
+                400, reason='Batch must be a list of operations'
+            )
+
+        try:
+            results = await self.service.write_addresses(ops)
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, reason=str(e))
+
+        self.set_status(200)
+        self.finish({'results': results})
+
+
+class AddressBookExportRequestHandler(BaseRequestHandler):
+    async def get(self):
+        self.set_status(200)
+        self.set_header('Content-Type', NDJSON_CONTENT_TYPE)
+
+        async def chunks() -> AsyncIterator[bytes]:
+            async for nickname, addr in self.service.get_all_addresses_raw():
+                yield json_object([
+                    ('id', json.dumps(nickname).encode('utf-8')),
+                    ('address', addr)
+                ]) + b'\n'
+
+        await self.write_stream(chunks())
+        self.finish()
+
+
+@tornado.web.stream_request_body
+class AddressBookImportRequestHandler(BaseRequestHandler):
+    '''
+    Imports NDJSON, as made by export, from a streamed request body.
+
+    Lines are parsed as they arrive and imported IMPORT_BATCH_SIZE at a time.
+    While a batch is being written, no more of the body is read.
+    '''
+
+    def prepare(self) -> Optional[Awaitable[None]]:
+        self.request.connection.set_max_body_size(  # type: ignore
+            IMPORT_MAX_BODY_SIZE
+        )
+        self.partial_line = b''
+        self.lines = 0
+        self.batch: List[Any] = []
+        self.batch_lines: List[int] = []
+        self.summary: Dict[str, Any] = {
+            'created': 0, 'replaced': 0, 'failed': 0, 'errors': []
+        }
+        self.abort_reason: Optional[str] = None
+        return super().prepare()
+
+    async def data_received(self, chunk: bytes) -> None:
+        if self.abort_reason is not None:
+            return
+
+        lines = (self.partial_line + chunk).split(b'\n')
+        self.partial_line = lines.pop()
+        if len(self.partial_line) > IMPORT_MAX_LINE_SIZE:
+            self.abort_reason = 'Line {} is too long'.format(self.lines + 1)
+            return
+
+        for line in lines:
+            await self.add_line(line)
+
+    async def add_line(self, line: bytes) -> None:
+        self.lines += 1
+        if not line.strip():
+            return
+
+        try:
+            self.batch.append(json.loads(line.decode('utf-8')))
+            self.batch_lines.append(self.lines)
+        except (json.decoder.JSONDecodeError, UnicodeError):
+            self.add_error(self.lines, {
+                'status': 400, 'message': 'Invalid JSON'
+            })
+
+        if len(self.batch) >= IMPORT_BATCH_SIZE:
+            await self.import_batch()
+
+    async def import_batch(self) -> None:
+        if not self.batch:
+            return
+
+        results = await self.service.import_addresses(self.batch)
+        for line, result in zip(self.batch_lines, results):
+            if result['status'] == 201:
+                self.summary['created'] += 1
+            elif result['status'] == 204:
+                self.summary['replaced'] += 1
+            else:
+                self.add_error(line, result)
+        self.batch = []
+        self.batch_lines = []
+
+    def add_error(self, line: int, result: Dict) -> None:
+        self.summary['failed'] += 1
+        if len(self.summary['errors']) < IMPORT_MAX_ERRORS:
+            self.summary['errors'].append(dict(result, line=line))
+
+    async def post(self):
+        if self.abort_reason is not None:
+            raise tornado.web.HTTPError(400, reason=self.abort_reason)
+
+        if self.partial_line:
+            await self.add_line(self.partial_line)
+            self.partial_line = b''
+        await self.import_batch()
+
+        self.set_status(200)
+        self.finish(self.summary)
 
 
 def log_function(handler: tornado.web.RequestHandler) -> None:
@@ -217,8 +538,16 @@ def make_addrservice_app(
     app = tornado.web.Application(
         [
             # Address Book endpoints
+            (ADDRESSBOOK_BATCH_REGEX, AddressBookBatchRequestHandler,
+                dict(service=service, config=config, logger=logger)),
+            (ADDRESSBOOK_EXPORT_REGEX, AddressBookExportRequestHandler,
+                dict(service=service, config=config, logger=logger)),
+            (ADDRESSBOOK_IMPORT_REGEX, AddressBookImportRequestHandler,
+                dict(service=service, config=config, logger=logger)),
             (ADDRESSBOOK_REGEX, AddressBookRequestHandler,
                 dict(service=service, config=config, logger=logger)),
+            (ADDRESSBOOK_SEARCH_REGEX, AddressBookSearchRequestHandler,
+                dict(service=service, config=config, logger=logger)),
             (ADDRESSBOOK_ENTRY_REGEX, AddressBookEntryRequestHandler,
                 dict(service=service, config=config, logger=logger))
         ],
@@ -5,16 +5,42 @@ import argparse
 import asyncio
 import logging
 import logging.config
-from typing import Dict
+import os
+import signal
+import socket
+import sys
+import time
+from typing import Dict, List
 import yaml
 
+import tornado.httpserver
+import tornado.netutil
+import tornado.process
 import tornado.web
 
 from addrservice import LOGGER_NAME
+from addrservice.database.wal import DURABILITY_NONE
 from addrservice.service import AddressBookService
-from addrservice.tornado.app import make_addrservice_app
+from addrservice.tornado.app import BaseRequestHandler, make_addrservice_app
 import addrservice.utils.logutils as logutils
 
+# On shutdown, requests in progress get this many seconds to complete
+SHUTDOWN_TIMEOUT_SECS = 10
+
+# DB engines that must not be shared by several worker processes
+SINGLE_PROCESS_DB_ENGINES = ['segment']
+
+# DB layers that keep entries or indexes in the memory of each worker, which
+# would never see the writes of other workers
+SINGLE_PROCESS_DB_LAYERS = ['search', 'tiered']
+
+# A worker that dies within WORKER_MIN_UPTIME_SECS of starting is restarted
+# after a delay, which doubles with every such death, up to the maximum
+WORKER_MIN_UPTIME_SECS = 10
+WORKER_RESTART_DELAY_SECS = 0.5
+WORKER_MAX_RESTART_DELAY_SECS = 30
+WORKER_POLL_SECS = 0.1
+
 
 def parse_args(args=None):
     parser = argparse.ArgumentParser(
@@ -30,6 +56,15 @@ def parse_args(args=None):
         'default: %(default)s'
     )
 
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        default=1,
+        help='number of server processes sharing the port, 0 for one per '
+        'CPU; default: %(default)s'
+    )
+
     parser.add_argument(
         '-d',
         '--debug',
@@ -55,7 +90,8 @@ def run_server(
     config: Dict,
     port: int,
     debug: bool,
-    logger: logging.Logger
+    logger: logging.Logger,
+    sockets: List[socket.socket] = None
 ):
     name = config['service']['name']
     loop = asyncio.get_event_loop()
@@ -64,35 +100,53 @@ def run_server(
     # Start AddressBook service
     service.start()
 
-    # Bind http server to port
+    # Bind http server to port, or to sockets bound before forking
     http_server_args = {
         'decompress_request': True
     }
-    http_server = app.listen(port, '', **http_server_args)
+    if sockets is None:
+        http_server = app.listen(port, '', **http_server_args)
+    else:
+        http_server = tornado.httpserver.HTTPServer(app, **http_server_args)
+        http_server.add_sockets(sockets)
     logutils.log(
         logger,
         logging.INFO,
         message='STARTING',
         service_name=name,
-        port=port
+        port=port,
+        pid=os.getpid()
     )
 
+    # SIGINT and SIGTERM stop the loop; shutdown then proceeds below
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, loop.stop)
+
     try:
         # Start asyncio IO event loop
         loop.run_forever()
-    except KeyboardInterrupt:
-        # signal.SIGINT
-        pass
     finally:
-        loop.stop()
         logutils.log(
             logger,
             logging.INFO,
             message='SHUTTING DOWN',
-            service_name=name
+            service_name=name,
+            pid=os.getpid()
         )
+        # Stop accepting connections, then let requests in progress finish.
+        # A second signal skips the wait.
         http_server.stop()
-        # loop.run_until_complete(asyncio.gather(*asyncio.Task.all_tasks()))
+        drain = loop.create_task(wait_for_requests(SHUTDOWN_TIMEOUT_SECS))
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, drain.cancel)
+        try:
+            loop.run_until_complete(drain)
+        except asyncio.CancelledError:
+            pass
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(sig)
+
+        loop.run_until_complete(http_server.close_all_connections())
         loop.run_until_complete(loop.shutdown_asyncgens())
         service.stop()
         loop.close()
@@ -100,9 +154,144 @@ def run_server(
             logger,
             logging.INFO,
             message='STOPPED',
-            service_name=name
+            service_name=name,
+            pid=os.getpid()
+        )
+
+
+async def wait_for_requests(timeout: float) -> None:
+    deadline = asyncio.get_event_loop().time() + timeout
+    while BaseRequestHandler.in_flight > 0:
+        if asyncio.get_event_loop().time() >= deadline:
+            break
+        await asyncio.sleep(0.1)
+
+
+def fork_workers(
+    num_workers: int,
+    config: Dict,
+    logger: logging.Logger
+) -> int:
+    '''
+    Forks num_workers worker processes, and returns the worker id (from 0
+    to num_workers - 1) in each of them.
+
+    The parent process never returns. It restarts workers that die with an
+    error, with a growing delay if they keep dying soon after they start.
+    On SIGINT or SIGTERM, it sends SIGTERM to all workers, waits for them to
+    shut down, and exits.
+    '''
+    name = config['service']['name']
+    workers: Dict[int, int] = {}  # pid -> worker id
+    started: Dict[int, float] = {}  # worker id -> when it last started
+    delays: Dict[int, float] = {}  # worker id -> delay of its last restart
+    restarts: Dict[int, float] = {}  # worker id -> when to restart it
+    stopping = False
+
+    def start_worker(worker_id: int) -> bool:
+        # Returns True in the worker, False in the parent
+        pid = os.fork()
+        if pid == 0:
+            # run_server installs its own handlers
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            return True
+        workers[pid] = worker_id
+        started[worker_id] = time.monotonic()
+        return False
+
+    def sleep_until_restart() -> None:
+        # In short steps, so that workers that die and signals that clear
+        # the restarts are not held up
+        if restarts:
+            delay = min(restarts.values()) - time.monotonic()
+            time.sleep(min(max(delay, 0), WORKER_POLL_SECS))
+
+    def stop_workers(signum, frame):
+        nonlocal stopping
+        stopping = True
+        restarts.clear()
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    # Installed before forking so that no signal is missed in between
+    signal.signal(signal.SIGINT, stop_workers)
+    signal.signal(signal.SIGTERM, stop_workers)
+
+    for worker_id in range(num_workers):
+        if start_worker(worker_id):
+            return worker_id
+
+    logutils.log(
+        logger,
+        logging.INFO,
+        message='WORKERS STARTED',
+        service_name=name,
+        workers=num_workers,
+        pid=os.getpid()
+    )
+
+    while workers or restarts:
+        now = time.monotonic()
+        for worker_id, restart_at in list(restarts.items()):
+            if restart_at <= now:
+                del restarts[worker_id]
+                if start_worker(worker_id):
+                    return worker_id
+
+        try:
+            if restarts:
+                # Without blocking, so that restarts are not held up
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            else:
+                pid, status = os.wait()
+        except ChildProcessError:
+            pid = 0
+        if pid == 0:
+            if restarts:
+                sleep_until_restart()
+                continue
+            break
+
+        worker_id = workers.pop(pid, -1)
+        if worker_id < 0:
+            continue
+
+        if stopping or (os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0):
+            continue
+
+        # Restarted at once, unless it died soon after it started
+        delay = 0.0
+        if time.monotonic() - started[worker_id] < WORKER_MIN_UPTIME_SECS:
+            delay = min(
+                2 * delays.get(worker_id, 0) or WORKER_RESTART_DELAY_SECS,
+                WORKER_MAX_RESTART_DELAY_SECS
+            )
+        delays[worker_id] = delay
+        restarts[worker_id] = time.monotonic() + delay
+        logutils.log(
+            logger,
+            logging.WARNING,
+            message='RESTARTING WORKER',
+            service_name=name,
+            worker=worker_id,
+            pid=pid,
+            status=status,
+            delay=delay
         )
 
+    logutils.log(
+        logger,
+        logging.INFO,
+        message='WORKERS STOPPED',
+        service_name=name,
+        pid=os.getpid()
+    )
+    sys.exit(0)
+
 
 def main(args=parse_args()):
     '''
@@ -115,6 +304,52 @@ def main(args=parse_args()):
     logging.config.dictConfig(config['logging'])
     logger = logging.getLogger(LOGGER_NAME)
 
+    num_workers = args.workers or tornado.process.cpu_count()
+    sockets = None
+    if num_workers > 1:
+        db_engines = set(config['addr-db']) & set(SINGLE_PROCESS_DB_ENGINES)
+        if db_engines:
+            sys.exit('{} DB engine can not be shared by workers'.format(
+                db_engines.pop()
+            ))
+        fs_config = config['addr-db'].get('fs')
+        if (
+            isinstance(fs_config, dict) and
+            fs_config.get('durability', DURABILITY_NONE) != DURABILITY_NONE
+        ):
+            sys.exit('fs DB engine with a log can not be shared by workers')
+        db_layers = set(config['addr-db']) & set(SINGLE_PROCESS_DB_LAYERS)
+        if db_layers:
+            sys.exit('{} DB layer can not be shared by workers'.format(
+                db_layers.pop()
+            ))
+        if 'cache' in config['addr-db'] and not (
+            config['addr-db']['cache'] or {}
+        ).get('ttl'):
+            # Entries expire after the ttl, and are then read again
+            sys.exit('cache DB layer shared by workers needs a ttl')
+        for db_engine in ('memory', 'columnar'):
+            memory_config = config['addr-db'].get(db_engine)
+            if isinstance(memory_config, dict) and memory_config.get(
+                'snapshot'
+            ):
+                sys.exit(
+                    '{} DB engine with a snapshot can not be shared by '
+                    'workers'.format(db_engine)
+                )
+        if 'memory' in config['addr-db']:
+            logutils.log(
+                logger,
+                logging.WARNING,
+                message='Each worker has its own in-memory address book',
+                service_name=config['service']['name']
+            )
+
+        # Workers share the listening sockets bound here, and each creates
+        # its own service and event loop after the fork.
+        sockets = tornado.netutil.bind_sockets(args.port, '')
+        fork_workers(num_workers, config, logger)
+
     addr_service, addr_app = make_addrservice_app(config, args.debug, logger)
 
     run_server(
@@ -123,7 +358,8 @@ def main(args=parse_args()):
         config=config,
         port=args.port,
         debug=args.debug,
-        logger=logger
+        logger=logger,
+        sockets=sockets
     )
 
 
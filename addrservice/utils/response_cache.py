@@ -0,0 +1,69 @@
+# Copyright (c) 2020. All rights reserved.
+
+from collections import OrderedDict
+import gzip
+from typing import NamedTuple, Optional
+
+# Same as tornado.web.GZipContentEncoding: shorter bodies are not worth it
+GZIP_MIN_LENGTH = 1024
+GZIP_LEVEL = 6
+
+
+class CachedResponse(NamedTuple):
+    # None if not read, which is only done without a cache
+    version: Optional[str]
+    body: bytes
+    gzip_body: Optional[bytes]
+
+
+class ResponseCache:
+    '''
+    LRU cache of ready-to-send response bodies, keyed by entry nickname.
+
+    Each body is stored with the version of the entry it was made from, and
+    a lookup for any other version is a miss. With compress on, a gzipped
+    copy of each body is kept too. A max_entries of 0 turns caching off.
+    '''
+
+    def __init__(self, max_entries: int = 0, compress: bool = False) -> None:
+        if max_entries < 0:
+            raise ValueError(
+                'Invalid response cache max entries {}'.format(max_entries)
+            )
+
+        self.max_entries = max_entries
+        self.compress = compress
+        self.hits = 0
+        self.misses = 0
+        self._cache: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def get(self, key: str, version: str) -> Optional[CachedResponse]:
+        response = self._cache.get(key)
+        if response is None or response.version != version:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._cache.move_to_end(key)
+        return response
+
+    def make(self, version: Optional[str], body: bytes) -> CachedResponse:
+        gzip_body = None
+        if self.compress and self.max_entries and len(body) >= GZIP_MIN_LENGTH:
+            gzip_body = gzip.compress(body, GZIP_LEVEL)
+        return CachedResponse(version, body, gzip_body)
+
+    def put(self, key: str, response: CachedResponse) -> None:
+        if self.max_entries == 0:
+            return
+
+        self._cache[key] = response
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    def invalidate(self, key: str) -> None:
+        self._cache.pop(key, None)
@@ -0,0 +1,40 @@
+# Copyright (c) 2020. All rights reserved.
+
+import asyncio
+import timeit
+from typing import Any, Awaitable, Callable
+
+
+def report(label: str, secs_per_op: float) -> None:
+    print('{:<48} {:>12.2f} us/op'.format(label, secs_per_op * 1e6))
+
+
+def bench(
+    label: str,
+    func: Callable[[], Any],
+    number: int,
+    repeat: int = 5
+) -> float:
+    secs_per_op = min(timeit.repeat(func, number=number, repeat=repeat))
+    secs_per_op /= number
+    report(label, secs_per_op)
+    return secs_per_op
+
+
+def async_bench(
+    label: str,
+    func: Callable[[], Awaitable[Any]],
+    number: int,
+    repeat: int = 5
+) -> float:
+    async def run() -> None:
+        for _ in range(number):
+            await func()
+
+    loop = asyncio.get_event_loop()
+    secs_per_op = min(timeit.repeat(
+        lambda: loop.run_until_complete(run()), number=1, repeat=repeat
+    ))
+    secs_per_op /= number
+    report(label, secs_per_op)
+    return secs_per_op
@@ -0,0 +1,73 @@
+# Copyright (c) 2020. All rights reserved.
+
+import argparse
+import logging
+import os
+import tempfile
+
+from addrservice.service import AddressBookService
+from benchmarks import async_bench
+from data import address_data_suite
+
+
+def main(args=None) -> None:
+    parser = argparse.ArgumentParser(
+        description='Benchmark creating entries one by one and in a batch'
+    )
+    parser.add_argument(
+        '-b', '--batch-size',
+        type=int,
+        default=100,
+        help='entries per batch, default: %(default)s'
+    )
+    parser.add_argument(
+        '-n', '--number',
+        type=int,
+        default=20,
+        help='batches per timing run, default: %(default)s'
+    )
+    args = parser.parse_args(args)
+
+    addresses = list(address_data_suite().values())
+    values = [
+        addresses[i % len(addresses)] for i in range(args.batch_size)
+    ]
+    ops = [{'op': 'create', 'address': value} for value in values]
+
+    async def create_one_by_one(service: AddressBookService) -> None:
+        for value in values:
+            await service.create_address(value)
+
+    with tempfile.TemporaryDirectory(prefix='addrbook-bench') as tmp_dir:
+        engines = {
+            'memory': {'memory': None},
+            'fs': {'fs': os.path.join(tmp_dir, 'fs')},
+            'segment (sync)': {
+                'segment': {
+                    'path': os.path.join(tmp_dir, 'addresses.seg'),
+                    'sync': True,
+                }
+            },
+        }
+
+        for label, db_config in engines.items():
+            service = AddressBookService(
+                config={'addr-db': db_config},
+                logger=logging.getLogger('benchmarks')
+            )
+            service.start()
+            async_bench(
+                'create x{} one by one, {}'.format(args.batch_size, label),
+                lambda: create_one_by_one(service),
+                args.number
+            )
+            async_bench(
+                'create x{} in a batch, {}'.format(args.batch_size, label),
+                lambda: service.write_addresses(ops),
+                args.number
+            )
+            service.stop()
+
+
+if __name__ == '__main__':
+    main()
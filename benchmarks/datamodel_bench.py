@@ -0,0 +1,108 @@
+# Copyright (c) 2020. All rights reserved.
+
+import argparse
+import asyncio
+import gc
+import itertools
+import json
+import random
+import resource
+import sys
+import time
+
+from addrservice.database.addressbook_db import InMemoryAddressBookDB
+from addrservice.database.columnar_db import ColumnarAddressBookDB
+from addrservice.datamodel import AddressEntry
+from benchmarks import async_bench, bench, report
+from data import address_data_suite
+
+
+def max_rss_bytes() -> int:
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def main(args=None) -> None:
+    parser = argparse.ArgumentParser(
+        description='Benchmark the datamodel, and memory of in-memory DBs'
+    )
+    parser.add_argument(
+        '-e', '--entries',
+        type=int,
+        default=1000000,
+        help='entries in the in-memory address book, default: %(default)s'
+    )
+    parser.add_argument(
+        '-d', '--db',
+        choices=['memory', 'columnar'],
+        default='memory',
+        help='in-memory DB engine to load, default: %(default)s'
+    )
+    parser.add_argument(
+        '-n', '--number',
+        type=int,
+        default=10000,
+        help='conversions per timing run, default: %(default)s'
+    )
+    args = parser.parse_args(args)
+
+    addresses = list(address_data_suite().values())
+    entries = [AddressEntry.from_api_dm(addr) for addr in addresses]
+
+    values = itertools.cycle(addresses)
+    bench(
+        'AddressEntry.from_api_dm',
+        lambda: AddressEntry.from_api_dm(next(values)),
+        args.number
+    )
+    addrs = itertools.cycle(entries)
+    bench(
+        'AddressEntry.to_api_dm',
+        lambda: next(addrs).to_api_dm(),
+        args.number
+    )
+
+    # Every entry is parsed from its own JSON text, as the service does, so
+    # that entries do not share strings.
+    texts = [json.dumps(addr) for addr in addresses]
+    db = (
+        ColumnarAddressBookDB() if args.db == 'columnar'
+        else InMemoryAddressBookDB()
+    )
+    loop = asyncio.get_event_loop()
+
+    async def load() -> None:
+        for i, text in zip(range(args.entries), itertools.cycle(texts)):
+            await db.create_address(
+                AddressEntry.from_api_dm(json.loads(text)),
+                'nick-{}'.format(i)
+            )
+
+    gc.collect()
+    rss_before = max_rss_bytes()
+    start = time.perf_counter()
+    loop.run_until_complete(load())
+    report(
+        'load {} entries, per entry'.format(args.entries),
+        (time.perf_counter() - start) / args.entries
+    )
+    gc.collect()
+    print('{:<48} {:>12.0f} bytes/entry'.format(
+        '{} DB max RSS growth, per entry'.format(args.db),
+        (max_rss_bytes() - rss_before) / args.entries
+    ))
+
+    nicknames = itertools.cycle(
+        'nick-{}'.format(i)
+        for i in random.sample(range(args.entries), min(args.entries, 10000))
+    )
+    async_bench(
+        '{} DB read_address'.format(args.db),
+        lambda: db.read_address(next(nicknames)),
+        args.number
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+# Copyright (c) 2020. All rights reserved.
+
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import tempfile
+import time
+from typing import Iterator
+
+from addrservice.database.addressbook_db import FilesystemAddressBookDB
+from addrservice.database.file_io import FILE_IO_BACKENDS
+from addrservice.datamodel import AddressEntry
+from benchmarks import async_bench, report
+from data import address_data_suite
+
+
+def main(args=None) -> None:
+    parser = argparse.ArgumentParser(
+        description='Benchmark the file I/O backends of the fs engine'
+    )
+    parser.add_argument(
+        '-e', '--entries',
+        type=int,
+        default=10000,
+        help='entries in the address book, default: %(default)s'
+    )
+    parser.add_argument(
+        '-n', '--number',
+        type=int,
+        default=1000,
+        help='reads and writes per timing run, default: %(default)s'
+    )
+    args = parser.parse_args(args)
+
+    entries = [
+        AddressEntry.from_api_dm(addr)
+        for addr in address_data_suite().values()
+    ]
+    nicknames = ['nick-{}'.format(i) for i in range(args.entries)]
+    loop = asyncio.get_event_loop()
+
+    async def load(db: FilesystemAddressBookDB) -> None:
+        for nickname, addr in zip(nicknames, itertools.cycle(entries)):
+            await db.create_address(addr, nickname)
+
+    async def scan(db: FilesystemAddressBookDB) -> None:
+        async for _ in db.read_all_addresses():
+            pass
+
+    async def read_while_busy(
+        db: FilesystemAddressBookDB,
+        keys: Iterator[str]
+    ) -> float:
+        # Seconds to read 8 entries, while other work in the process keeps
+        # the default executor busy
+        busy = [
+            loop.run_in_executor(None, time.sleep, 0.005)
+            for _ in range(64)
+        ]
+        start = time.perf_counter()
+        await asyncio.gather(*(db.read_address(next(keys)) for _ in range(8)))
+        secs = time.perf_counter() - start
+        await asyncio.gather(*busy)
+        return secs
+
+    with tempfile.TemporaryDirectory(prefix='addrbook-bench') as tmp_dir:
+        store_dir = os.path.join(tmp_dir, 'fs')
+        for backend in FILE_IO_BACKENDS:
+            db = FilesystemAddressBookDB(store_dir, io=backend)
+            db.start()
+            if len(db.nicknames) == 0:
+                loop.run_until_complete(load(db))
+
+            keys = itertools.cycle(random.sample(nicknames, len(nicknames)))
+            async_bench(
+                'read_address, {}'.format(backend),
+                lambda: db.read_address(next(keys)),
+                args.number
+            )
+            async_bench(
+                'update_address, {}'.format(backend),
+                lambda: db.update_address(next(keys), entries[0]),
+                args.number
+            )
+            report(
+                'read_address x8, default executor busy, {}'.format(
+                    backend
+                ),
+                min(
+                    loop.run_until_complete(read_while_busy(db, keys))
+                    for _ in range(5)
+                )
+            )
+            async_bench(
+                'read_addresses_page of 100, {}'.format(backend),
+                lambda: db.read_addresses_page(100, next(keys)),
+                max(1, args.number // 10)
+            )
+            async_bench(
+                'scan {} entries, {}'.format(args.entries, backend),
+                lambda: scan(db),
+                1
+            )
+            db.stop()
+
+
+if __name__ == '__main__':
+    main()
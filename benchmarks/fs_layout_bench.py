@@ -0,0 +1,100 @@
+# Copyright (c) 2020. All rights reserved.
+
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import tempfile
+import time
+
+from addrservice.database import fs_layout
+from addrservice.database.addressbook_db import FilesystemAddressBookDB
+from addrservice.datamodel import AddressEntry
+from benchmarks import async_bench, report
+from data import address_data_suite
+
+
+def main(args=None) -> None:
+    parser = argparse.ArgumentParser(
+        description='Benchmark the flat and sharded layouts of the fs engine'
+    )
+    parser.add_argument(
+        '-e', '--entries',
+        type=int,
+        default=200000,
+        help='entries in the address book, default: %(default)s'
+    )
+    parser.add_argument(
+        '-s', '--shards',
+        type=int,
+        default=256,
+        help='shards of the sharded layout, default: %(default)s'
+    )
+    parser.add_argument(
+        '-n', '--number',
+        type=int,
+        default=1000,
+        help='reads and writes per timing run, default: %(default)s'
+    )
+    args = parser.parse_args(args)
+
+    entries = [
+        AddressEntry.from_api_dm(addr)
+        for addr in address_data_suite().values()
+    ]
+    nicknames = ['nick-{}'.format(i) for i in range(args.entries)]
+    counter = itertools.count()
+    loop = asyncio.get_event_loop()
+
+    async def load(db: FilesystemAddressBookDB) -> None:
+        for nickname, addr in zip(nicknames, itertools.cycle(entries)):
+            await db.create_address(addr, nickname)
+
+    with tempfile.TemporaryDirectory(prefix='addrbook-bench') as tmp_dir:
+        store_dir = os.path.join(tmp_dir, 'fs')
+        db = FilesystemAddressBookDB(store_dir)
+        loop.run_until_complete(load(db))
+        db.stop()
+
+        for shards in (0, args.shards):
+            label = 'sharded' if shards else 'flat'
+            if shards:
+                start = time.perf_counter()
+                fs_layout.migrate(store_dir, shards)
+                report(
+                    'migrate {} entries, per entry'.format(args.entries),
+                    (time.perf_counter() - start) / args.entries
+                )
+
+            db = FilesystemAddressBookDB(store_dir, shards=shards)
+            start = time.perf_counter()
+            len(db.nicknames)
+            report(
+                'list {} entries, {}'.format(args.entries, label),
+                time.perf_counter() - start
+            )
+
+            keys = itertools.cycle(random.sample(nicknames, len(nicknames)))
+            async_bench(
+                'read_address, {}'.format(label),
+                lambda: db.read_address(next(keys)),
+                args.number
+            )
+            async_bench(
+                'read_address_version, {}'.format(label),
+                lambda: db.read_address_version(next(keys)),
+                args.number
+            )
+            async_bench(
+                'create_address, {}'.format(label),
+                lambda: db.create_address(
+                    entries[0], 'new-{}'.format(next(counter))
+                ),
+                args.number
+            )
+            db.stop()
+
+
+if __name__ == '__main__':
+    main()
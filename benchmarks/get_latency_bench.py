@@ -0,0 +1,78 @@
+# Copyright (c) 2020. All rights reserved.
+
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import random
+import tempfile
+
+from addrservice.datamodel import AddressEntry
+from addrservice.service import AddressBookService
+from benchmarks import async_bench
+from data import address_data_suite
+
+
+def main(args=None) -> None:
+    parser = argparse.ArgumentParser(
+        description='Benchmark GET /addresses/{id} latency per DB engine'
+    )
+    parser.add_argument(
+        '-e', '--entries',
+        type=int,
+        default=2000,
+        help='entries in the address book, default: %(default)s'
+    )
+    parser.add_argument(
+        '-n', '--number',
+        type=int,
+        default=2000,
+        help='reads per timing run, default: %(default)s'
+    )
+    args = parser.parse_args(args)
+
+    addresses = list(address_data_suite().values())
+    loop = asyncio.get_event_loop()
+
+    with tempfile.TemporaryDirectory(prefix='addrbook-bench') as tmp_dir:
+        seg_path = os.path.join(tmp_dir, 'addresses.seg')
+        engines = {
+            'fs (threads)': {'fs': os.path.join(tmp_dir, 'fs')},
+            'fs (aiofiles)': {
+                'fs': {'path': os.path.join(tmp_dir, 'fs'), 'io': 'aiofiles'}
+            },
+            'segment (pread)': {'segment': {'path': seg_path}},
+            'segment (mmap)': {
+                'segment': {'path': seg_path, 'read-mode': 'mmap'}
+            },
+        }
+
+        for label, db_config in engines.items():
+            service = AddressBookService(
+                config={'addr-db': db_config},
+                logger=logging.getLogger('benchmarks')
+            )
+            service.start()
+
+            # Both fs backends share one directory, and both segment read
+            # modes share one segment file
+            nicknames = ['nick-{}'.format(i) for i in range(args.entries)]
+            if len(service.addr_db.nicknames) == 0:  # type: ignore
+                entries = zip(nicknames, itertools.cycle(addresses))
+                for nickname, addr in entries:
+                    loop.run_until_complete(service.addr_db.create_address(
+                        AddressEntry.from_api_dm(addr), nickname
+                    ))
+
+            keys = itertools.cycle(random.sample(nicknames, len(nicknames)))
+            async_bench(
+                'GET {}'.format(label),
+                lambda: service.get_address(next(keys)),
+                args.number
+            )
+            service.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# Copyright (c) 2020. All rights reserved.
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import tempfile
+from typing import Any, Callable, Dict, Mapping, Type
+
+from addrservice.database.addressbook_db import AbstractAddressBookDB
+from addrservice.database.db_engines import create_addressbook_db
+from addrservice.datamodel import AddressEntry, LazyAddressEntry
+from benchmarks import async_bench, bench
+from data import address_data_suite
+
+
+def main(args=None) -> None:
+    parser = argparse.ArgumentParser(
+        description='Benchmark eager and lazy decoding of entries in scans'
+    )
+    parser.add_argument(
+        '-e', '--entries',
+        type=int,
+        default=100000,
+        help='entries in the address book, default: %(default)s'
+    )
+    parser.add_argument(
+        '-n', '--number',
+        type=int,
+        default=10000,
+        help='conversions per timing run, default: %(default)s'
+    )
+    args = parser.parse_args(args)
+
+    addresses = list(address_data_suite().values())
+    entries = [AddressEntry.from_api_dm(addr) for addr in addresses]
+    loop = asyncio.get_event_loop()
+    decoders: Dict[str, Type[AddressEntry]] = {
+        'eager': AddressEntry,
+        'lazy': LazyAddressEntry,
+    }
+
+    for decoding, cls in decoders.items():
+        values = itertools.cycle(addresses)
+        bench(
+            'from_api_dm, {}'.format(decoding),
+            lambda: cls.from_api_dm(next(values)),
+            args.number
+        )
+        bench(
+            'from_api_dm + to_api_dm, {}'.format(decoding),
+            lambda: cls.from_api_dm(next(values)).to_api_dm(),
+            args.number
+        )
+
+    async def load(db: AbstractAddressBookDB) -> None:
+        nicknames = ('nick-{}'.format(i) for i in range(args.entries))
+        for nickname, addr in zip(nicknames, itertools.cycle(entries)):
+            await db.create_address(addr, nickname)
+
+    # The same scan of the stored JSON, decoded either way
+    async def scan(
+        db: AbstractAddressBookDB,
+        decode: Callable[[Mapping[str, Any]], AddressEntry],
+        use: Callable[[AddressEntry], Any]
+    ) -> None:
+        async for _, raw in db.read_all_addresses_raw():
+            use(decode(json.loads(raw)))
+
+    uses: Dict[str, Callable[[AddressEntry], Any]] = {
+        'full_name': lambda addr: addr.full_name,
+        'to_api_dm': lambda addr: addr.to_api_dm(),
+        'every field': lambda addr: (
+            addr.addresses, addr.phone_numbers, addr.fax_numbers,
+            addr.emails
+        ),
+    }
+
+    with tempfile.TemporaryDirectory(prefix='addrbook-bench') as tmp_dir:
+        engines: Dict[str, Dict] = {
+            'fs': {'fs': os.path.join(tmp_dir, 'fs')},
+            'segment': {
+                'segment': {'path': os.path.join(tmp_dir, 'addresses.seg')}
+            },
+        }
+
+        for label, db_config in engines.items():
+            db = create_addressbook_db(db_config)
+            db.start()
+            loop.run_until_complete(load(db))
+
+            for (use, func), (decoding, cls) in itertools.product(
+                uses.items(), decoders.items()
+            ):
+                async_bench(
+                    'scan {}, {}, {}, {}'.format(
+                        args.entries, label, use, decoding
+                    ),
+                    lambda: scan(db, cls.from_api_dm, func),
+                    1,
+                    repeat=3
+                )
+            db.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# Copyright (c) 2020. All rights reserved.
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import tempfile
+from typing import Dict, List, Type
+
+from addrservice.database.addressbook_db import InMemoryAddressBookDB
+from addrservice.database.columnar_db import ColumnarAddressBookDB
+from addrservice.database.snapshot_file import read_snapshot
+from addrservice.datamodel import AddressEntry
+from benchmarks import async_bench, bench
+from data import address_data_suite
+
+
+def main(args=None) -> None:
+    db_classes: Dict[str, Type[InMemoryAddressBookDB]] = {
+        'memory': InMemoryAddressBookDB,
+        'columnar': ColumnarAddressBookDB,
+    }
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark saving and restoring in-memory snapshots'
+    )
+    parser.add_argument(
+        '-e', '--entries',
+        type=int,
+        default=1000000,
+        help='entries in the address book, default: %(default)s'
+    )
+    parser.add_argument(
+        '--db',
+        choices=sorted(db_classes),
+        default='memory',
+        help='in-memory engine, default: %(default)s'
+    )
+    args = parser.parse_args(args)
+    db_class = db_classes[args.db]
+
+    entries = [
+        AddressEntry.from_api_dm(addr)
+        for addr in address_data_suite().values()
+    ]
+    nicknames = ['nick-{}'.format(i) for i in range(args.entries)]
+    loop = asyncio.get_event_loop()
+
+    async def load(db: InMemoryAddressBookDB) -> None:
+        for nickname, addr in zip(nicknames, itertools.cycle(entries)):
+            await db.create_address(addr, nickname)
+
+    with tempfile.TemporaryDirectory(prefix='addrbook-bench') as tmp_dir:
+        path = os.path.join(tmp_dir, 'addresses.snap')
+        db = db_class(path)
+        db.start()
+        loop.run_until_complete(load(db))
+        bench('stop: save {} entries'.format(args.entries), db.stop, 1, 1)
+        print('{:<48} {:>12.2f} MB'.format(
+            'snapshot size', os.path.getsize(path) / 1e6
+        ))
+
+        # What a start that decodes and validates every entry would take
+        bench(
+            'read + from_api_dm of every entry',
+            lambda: [
+                AddressEntry.from_api_dm(json.loads(value))
+                for _, value in read_snapshot(path)[1]
+            ],
+            1,
+            1
+        )
+
+        # Only the last DB started is kept
+        started: List[InMemoryAddressBookDB] = []
+
+        def restore() -> None:
+            started.clear()
+            restored = db_class(path)
+            restored.start()
+            started.append(restored)
+
+        bench('start: load {} entries'.format(args.entries), restore, 1, 3)
+        db = started[0]
+
+        keys = itertools.cycle(random.sample(nicknames, len(nicknames)))
+        async_bench(
+            'read_address after start',
+            lambda: db.read_address(next(keys)),
+            1000,
+            1
+        )
+        async_bench(
+            'read_address_raw after start',
+            lambda: db.read_address_raw(next(keys)),
+            1000,
+            1
+        )
+        city = entries[0].addresses[0].city
+        async_bench(
+            'first find_nicknames, builds the index',
+            lambda: db.find_nicknames({'city': city}),
+            1,
+            1
+        )
+        async_bench('snapshot() while serving', db.snapshot, 1, 1)
+        db.stop()
+
+
+if __name__ == '__main__':
+    main()
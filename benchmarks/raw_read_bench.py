@@ -0,0 +1,117 @@
+# Copyright (c) 2020. All rights reserved.
+
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import tempfile
+from typing import Dict
+
+from addrservice.database.addressbook_db import (
+    AbstractAddressBookDB,
+    encode_entry
+)
+from addrservice.database.db_engines import create_addressbook_db
+from addrservice.datamodel import AddressEntry
+from benchmarks import async_bench
+from data import address_data_suite
+
+
+def main(args=None) -> None:
+    parser = argparse.ArgumentParser(
+        description='Benchmark decoded and raw reads of entries per engine'
+    )
+    parser.add_argument(
+        '-e', '--entries',
+        type=int,
+        default=10000,
+        help='entries in the address book, default: %(default)s'
+    )
+    parser.add_argument(
+        '-n', '--number',
+        type=int,
+        default=2000,
+        help='reads per timing run, default: %(default)s'
+    )
+    args = parser.parse_args(args)
+
+    entries = [
+        AddressEntry.from_api_dm(addr)
+        for addr in address_data_suite().values()
+    ]
+    nicknames = ['nick-{}'.format(i) for i in range(args.entries)]
+    loop = asyncio.get_event_loop()
+
+    async def load(db: AbstractAddressBookDB) -> None:
+        for nickname, addr in zip(nicknames, itertools.cycle(entries)):
+            await db.create_address(addr, nickname)
+
+    # What a response body needs: the API JSON of the entries
+    async def read_encoded(db: AbstractAddressBookDB, nickname: str) -> bytes:
+        return encode_entry(await db.read_address(nickname))
+
+    async def page_encoded(db: AbstractAddressBookDB, after: str) -> None:
+        for _, addr in await db.read_addresses_page(100, after):
+            encode_entry(addr)
+
+    async def scan_encoded(db: AbstractAddressBookDB) -> None:
+        async for _, addr in db.read_all_addresses():
+            encode_entry(addr)
+
+    async def scan_raw(db: AbstractAddressBookDB) -> None:
+        async for _ in db.read_all_addresses_raw():
+            pass
+
+    with tempfile.TemporaryDirectory(prefix='addrbook-bench') as tmp_dir:
+        engines: Dict[str, Dict] = {
+            'fs': {'fs': os.path.join(tmp_dir, 'fs')},
+            'segment': {
+                'segment': {'path': os.path.join(tmp_dir, 'addresses.seg')}
+            },
+            'sqlite': {
+                'sqlite': {'path': os.path.join(tmp_dir, 'addresses.db')}
+            },
+        }
+
+        for label, db_config in engines.items():
+            db = create_addressbook_db(db_config)
+            db.start()
+            loop.run_until_complete(load(db))
+
+            keys = itertools.cycle(random.sample(nicknames, len(nicknames)))
+            async_bench(
+                'read_address + encode, {}'.format(label),
+                lambda: read_encoded(db, next(keys)),
+                args.number
+            )
+            async_bench(
+                'read_address_raw, {}'.format(label),
+                lambda: db.read_address_raw(next(keys)),
+                args.number
+            )
+            async_bench(
+                'read_addresses_page of 100 + encode, {}'.format(label),
+                lambda: page_encoded(db, next(keys)),
+                max(1, args.number // 20)
+            )
+            async_bench(
+                'read_addresses_page_raw of 100, {}'.format(label),
+                lambda: db.read_addresses_page_raw(100, next(keys)),
+                max(1, args.number // 20)
+            )
+            async_bench(
+                'scan {} entries + encode, {}'.format(args.entries, label),
+                lambda: scan_encoded(db),
+                1
+            )
+            async_bench(
+                'scan {} entries raw, {}'.format(args.entries, label),
+                lambda: scan_raw(db),
+                1
+            )
+            db.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# Copyright (c) 2020. All rights reserved.
+
+import argparse
+import asyncio
+import itertools
+import os
+import tempfile
+import time
+
+from addrservice.database.addressbook_db import FilesystemAddressBookDB
+from addrservice.datamodel import AddressEntry
+from benchmarks import report
+from data import address_data_suite
+
+
+def main(args=None) -> None:
+    parser = argparse.ArgumentParser(
+        description='Benchmark full scans of the fs engine'
+    )
+    parser.add_argument(
+        '-e', '--entries',
+        type=int,
+        nargs='+',
+        default=[10000, 100000],
+        help='entries in each address book, default: %(default)s'
+    )
+    parser.add_argument(
+        '-c', '--concurrency',
+        type=int,
+        nargs='+',
+        default=[1, 2, 4, 8],
+        help='batches of files read at once, default: %(default)s'
+    )
+    parser.add_argument(
+        '--cold',
+        action='store_true',
+        help='drop the page cache before each scan (Linux, as root)'
+    )
+    args = parser.parse_args(args)
+
+    entries = [
+        AddressEntry.from_api_dm(addr)
+        for addr in address_data_suite().values()
+    ]
+    loop = asyncio.get_event_loop()
+
+    async def load(db: FilesystemAddressBookDB, count: int) -> None:
+        nicknames = ('nick-{}'.format(i) for i in range(count))
+        for nickname, addr in zip(nicknames, itertools.cycle(entries)):
+            await db.create_address(addr, nickname)
+
+    async def scan(db: FilesystemAddressBookDB) -> None:
+        async for _ in db.read_all_addresses():
+            pass
+
+    def time_scan(db: FilesystemAddressBookDB) -> float:
+        if args.cold:
+            os.sync()
+            with open('/proc/sys/vm/drop_caches', 'w') as f:
+                f.write('3\n')
+        start = time.perf_counter()
+        loop.run_until_complete(scan(db))
+        return time.perf_counter() - start
+
+    for count in args.entries:
+        with tempfile.TemporaryDirectory(prefix='addrbook-bench') as tmp_dir:
+            store_dir = os.path.join(tmp_dir, 'fs')
+            db = FilesystemAddressBookDB(store_dir)
+            loop.run_until_complete(load(db, count))
+            db.stop()
+
+            for concurrency, ordered in itertools.product(
+                args.concurrency, [True, False]
+            ):
+                db = FilesystemAddressBookDB(
+                    store_dir,
+                    scan_concurrency=concurrency,
+                    scan_ordered=ordered
+                )
+                report(
+                    'scan {} entries, concurrency {}, {}'.format(
+                        count,
+                        concurrency,
+                        'ordered' if ordered else 'unordered'
+                    ),
+                    min(time_scan(db) for _ in range(3))
+                )
+                db.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+# Copyright (c) 2020. All rights reserved.
+
+import argparse
+import asyncio
+import gc
+import itertools
+import random
+import time
+from typing import Iterator, List, Tuple
+
+from addrservice.database.addressbook_db import InMemoryAddressBookDB
+from addrservice.database.indexes import SearchIndex
+from addrservice.datamodel import Address, AddressEntry, AddressType
+from benchmarks import async_bench, bench, report
+from benchmarks.datamodel_bench import max_rss_bytes
+
+SYLLABLES = [
+    'ra', 'ma', 'na', 'sha', 'vi', 'ja', 'ku', 'de', 'pri', 'an', 'su',
+    'ka', 'la', 'ti', 'ro', 'han', 'dra', 'ya', 'mo', 'ni', 'pa', 'ga',
+    'ri', 'san', 'esh', 'it', 'ar', 'jun', 'deep', 'preet',
+]
+STREET_SUFFIXES = ['Road', 'Street', 'Lane', 'Marg', 'Path', 'Avenue']
+LOCALITY_SUFFIXES = ['Nagar', 'Colony', 'Vihar', 'Enclave', 'Puram', '']
+
+
+def make_word(rng: random.Random, syllables: int) -> str:
+    return ''.join(
+        rng.choice(SYLLABLES) for _ in range(syllables)
+    ).capitalize()
+
+
+def generate_book(
+    entries: int,
+    seed: int = 1
+) -> Iterator[Tuple[str, AddressEntry]]:
+    '''
+    Entries with names and addresses made of random syllables: a few
+    thousand distinct first names, and tens of thousands of distinct last
+    names, street names and localities, with skewed frequencies.
+    '''
+    rng = random.Random(seed)
+    first_names = [make_word(rng, rng.randint(2, 3)) for _ in range(3000)]
+    last_names = [make_word(rng, rng.randint(2, 4)) for _ in range(30000)]
+    places = [make_word(rng, rng.randint(2, 3)) for _ in range(20000)]
+
+    def pick(words: List[str]) -> str:
+        # Zipf-like: low indexes are picked far more often
+        return words[int(len(words) * rng.random() ** 3)]
+
+    for i in range(entries):
+        addr = Address(
+            AddressType.home,
+            '{} {}'.format(pick(places), rng.choice(STREET_SUFFIXES)),
+            str(100000 + rng.randrange(900000)),
+            'India',
+            street_number=rng.randrange(1, 500),
+            locality='{} {}'.format(
+                pick(places), rng.choice(LOCALITY_SUFFIXES)
+            ).strip(),
+            city=pick(places),
+        )
+        yield 'nick-{}'.format(i), AddressEntry(
+            '{} {}'.format(pick(first_names), pick(last_names)),
+            [addr],
+        )
+
+
+def main(args=None) -> None:
+    parser = argparse.ArgumentParser(
+        description='Benchmark search on a generated address book'
+    )
+    parser.add_argument(
+        '-e', '--entries',
+        type=int,
+        default=1000000,
+        help='entries in the search index, default: %(default)s'
+    )
+    parser.add_argument(
+        '-s', '--scan-entries',
+        type=int,
+        default=100000,
+        help='entries in the book searched by a scan, default: %(default)s'
+    )
+    parser.add_argument(
+        '-n', '--number',
+        type=int,
+        default=200,
+        help='searches per timing run, default: %(default)s'
+    )
+    args = parser.parse_args(args)
+
+    index = SearchIndex()
+    samples: List[AddressEntry] = []
+    gc.collect()
+    rss_before = max_rss_bytes()
+    start = time.perf_counter()
+    for i, (nickname, entry) in enumerate(generate_book(args.entries)):
+        index.put(nickname, entry)
+        if i % 1000 == 0:
+            samples.append(entry)
+    report(
+        'index {} entries, per entry'.format(args.entries),
+        (time.perf_counter() - start) / args.entries
+    )
+    gc.collect()
+    print('{:<48} {:>12.0f} bytes/entry'.format(
+        'search index max RSS growth, per entry',
+        (max_rss_bytes() - rss_before) / args.entries
+    ))
+
+    # Typeahead queries of growing length, from the names of sample entries
+    rng = random.Random(2)
+    queries = {
+        '2 letters': lambda e: e.full_name[:2],
+        '4 letters': lambda e: e.full_name[:4],
+        'first name': lambda e: e.full_name.split()[0],
+        'full name': lambda e: e.full_name,
+        'first name, street prefix': lambda e: '{} {}'.format(
+            e.full_name.split()[0], e.addresses[0].street_name[:3]
+        ),
+    }
+    for label, make_query in queries.items():
+        texts = [make_query(rng.choice(samples)) for _ in range(100)]
+        cycle = itertools.cycle(texts)
+        bench(
+            'index search, {}'.format(label),
+            lambda: index.search(next(cycle), 10),
+            args.number
+        )
+
+    db = InMemoryAddressBookDB()
+    loop = asyncio.get_event_loop()
+
+    async def load() -> None:
+        for nickname, entry in generate_book(args.scan_entries):
+            await db.create_address(entry, nickname)
+
+    loop.run_until_complete(load())
+    texts = [rng.choice(samples).full_name for _ in range(10)]
+    cycle = itertools.cycle(texts)
+    async_bench(
+        'scan search of {} entries, full name'.format(args.scan_entries),
+        lambda: db.search_nicknames(next(cycle), 10),
+        1
+    )
+
+
+if __name__ == '__main__':
+    main()
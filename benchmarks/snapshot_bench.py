@@ -0,0 +1,92 @@
+# Copyright (c) 2020. All rights reserved.
+
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import tempfile
+from typing import Dict
+
+from addrservice.database.addressbook_db import AbstractAddressBookDB
+from addrservice.database.db_engines import create_addressbook_db
+from addrservice.datamodel import AddressEntry
+from benchmarks import async_bench
+from data import address_data_suite
+
+
+def main(args=None) -> None:
+    parser = argparse.ArgumentParser(
+        description='Benchmark scans per engine, alone and under writes'
+    )
+    parser.add_argument(
+        '-e', '--entries',
+        type=int,
+        default=10000,
+        help='entries in the address book, default: %(default)s'
+    )
+    parser.add_argument(
+        '-w', '--write-every',
+        type=int,
+        default=10,
+        help='entries scanned per concurrent write, default: %(default)s'
+    )
+    args = parser.parse_args(args)
+
+    entries = [
+        AddressEntry.from_api_dm(addr)
+        for addr in address_data_suite().values()
+    ]
+    nicknames = ['nick-{}'.format(i) for i in range(args.entries)]
+    loop = asyncio.get_event_loop()
+
+    async def load(db: AbstractAddressBookDB) -> None:
+        for nickname, addr in zip(nicknames, itertools.cycle(entries)):
+            await db.create_address(addr, nickname)
+
+    # Updates an entry every write_every entries scanned, if any
+    async def scan(db: AbstractAddressBookDB, write_every: int = 0) -> None:
+        i = 0
+        async for _ in db.read_all_addresses_raw():
+            i += 1
+            if write_every and i % write_every == 0:
+                await db.update_address(
+                    random.choice(nicknames), random.choice(entries)
+                )
+
+    with tempfile.TemporaryDirectory(prefix='addrbook-bench') as tmp_dir:
+        engines: Dict[str, Dict] = {
+            'memory': {'memory': None},
+            'fs': {'fs': os.path.join(tmp_dir, 'fs')},
+            'segment': {
+                'segment': {'path': os.path.join(tmp_dir, 'addresses.seg')}
+            },
+            'sqlite': {
+                'sqlite': {'path': os.path.join(tmp_dir, 'addresses.db')}
+            },
+        }
+
+        for label, db_config in engines.items():
+            db = create_addressbook_db(db_config)
+            db.start()
+            loop.run_until_complete(load(db))
+
+            async_bench(
+                'scan {} entries, {}'.format(args.entries, label),
+                lambda: scan(db),
+                1,
+                repeat=3
+            )
+            async_bench(
+                'scan {} entries, a write per {}, {}'.format(
+                    args.entries, args.write_every, label
+                ),
+                lambda: scan(db, args.write_every),
+                1,
+                repeat=3
+            )
+            db.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# Copyright (c) 2020. All rights reserved.
+
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import tempfile
+
+from addrservice.database.addressbook_db import (
+    AbstractAddressBookDB,
+    AddressWrite,
+    FilesystemAddressBookDB,
+    WRITE_UPDATE,
+)
+from addrservice.database.sqlite_db import SqliteAddressBookDB
+from addrservice.datamodel import AddressEntry
+from benchmarks import async_bench
+from data import address_data_suite
+
+
+def main(args=None) -> None:
+    parser = argparse.ArgumentParser(
+        description='Benchmark the sqlite engine against the fs engine'
+    )
+    parser.add_argument(
+        '-e', '--entries',
+        type=int,
+        default=10000,
+        help='entries in each address book, default: %(default)s'
+    )
+    parser.add_argument(
+        '-n', '--number',
+        type=int,
+        default=1000,
+        help='reads and writes per timing run, default: %(default)s'
+    )
+    args = parser.parse_args(args)
+
+    entries = [
+        AddressEntry.from_api_dm(addr)
+        for addr in address_data_suite().values()
+    ]
+    nicknames = ['nick-{}'.format(i) for i in range(args.entries)]
+    counter = itertools.count()
+    loop = asyncio.get_event_loop()
+
+    async def load(db: AbstractAddressBookDB) -> None:
+        for nickname, addr in zip(nicknames, itertools.cycle(entries)):
+            await db.create_address(addr, nickname)
+
+    async def scan(db: AbstractAddressBookDB) -> None:
+        async for _ in db.read_all_addresses():
+            pass
+
+    with tempfile.TemporaryDirectory(prefix='addrbook-bench') as tmp_dir:
+        engines = {
+            'fs': FilesystemAddressBookDB(os.path.join(tmp_dir, 'fs')),
+            'sqlite': SqliteAddressBookDB(
+                os.path.join(tmp_dir, 'addresses.sqlite')
+            ),
+            'sqlite (sync)': SqliteAddressBookDB(
+                os.path.join(tmp_dir, 'addresses-sync.sqlite'), sync=True
+            ),
+        }
+
+        for label, db in engines.items():
+            db.start()
+            loop.run_until_complete(load(db))
+
+            keys = itertools.cycle(random.sample(nicknames, len(nicknames)))
+            async_bench(
+                'read_address, {}'.format(label),
+                lambda: db.read_address(next(keys)),
+                args.number
+            )
+            async_bench(
+                'update_address, {}'.format(label),
+                lambda: db.update_address(next(keys), entries[0]),
+                args.number
+            )
+            async_bench(
+                'create_address, {}'.format(label),
+                lambda: db.create_address(
+                    entries[0], 'new-{}'.format(next(counter))
+                ),
+                args.number
+            )
+            batch = [
+                AddressWrite(WRITE_UPDATE, nickname, entries[1])
+                for nickname in nicknames[:100]
+            ]
+            async_bench(
+                'update x100 in a batch, {}'.format(label),
+                lambda: db.write_addresses(batch),
+                max(1, args.number // 100)
+            )
+            async_bench(
+                'read_addresses_page of 100, {}'.format(label),
+                lambda: db.read_addresses_page(100, next(keys)),
+                max(1, args.number // 10)
+            )
+            async_bench(
+                'scan {} entries, {}'.format(args.entries, label),
+                lambda: scan(db),
+                1
+            )
+            db.stop()
+
+
+if __name__ == '__main__':
+    main()
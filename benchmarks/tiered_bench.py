@@ -0,0 +1,131 @@
+# Copyright (c) 2020. All rights reserved.
+
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import tempfile
+from typing import Dict, Iterator
+
+from addrservice.database.addressbook_db import AbstractAddressBookDB
+from addrservice.database.cache_db import CachedAddressBookDB
+from addrservice.database.db_engines import create_addressbook_db
+from addrservice.database.tiered_db import TieredAddressBookDB, entry_size
+from addrservice.datamodel import AddressEntry
+from benchmarks import async_bench
+from data import address_data_suite
+
+
+def main(args=None) -> None:
+    parser = argparse.ArgumentParser(
+        description='Benchmark skewed reads through the entry cache and tiers'
+    )
+    parser.add_argument(
+        '-e', '--entries',
+        type=int,
+        default=20000,
+        help='entries in the address book, default: %(default)s'
+    )
+    parser.add_argument(
+        '-r', '--reads',
+        type=int,
+        default=20000,
+        help='reads per run, default: %(default)s'
+    )
+    parser.add_argument(
+        '-f', '--fraction',
+        type=float,
+        default=0.05,
+        help='share of the entries that fit in memory, default: %(default)s'
+    )
+    parser.add_argument(
+        '-s', '--skew',
+        type=float,
+        default=1.0,
+        help='Zipf exponent of the reads, default: %(default)s'
+    )
+    parser.add_argument(
+        '--scan-every',
+        type=int,
+        default=4,
+        help='reads per one-off read of the next entry in order, in the '
+             'runs with scans, default: %(default)s'
+    )
+    args = parser.parse_args(args)
+
+    entries = [
+        AddressEntry.from_api_dm(addr)
+        for addr in address_data_suite().values()
+    ]
+    nicknames = ['nick-{}'.format(i) for i in range(args.entries)]
+    # The cache holds as many entries as the tiers hold bytes
+    max_size = int(args.entries * args.fraction)
+    max_bytes = sum(
+        entry_size(addr)
+        for addr, _ in zip(itertools.cycle(entries), range(max_size))
+    )
+
+    # Nicknames ranked by popularity, read with Zipf's law
+    ranked = random.sample(nicknames, len(nicknames))
+    weights = [1 / (rank + 1) ** args.skew for rank in range(len(ranked))]
+    skewed = random.choices(ranked, weights, k=args.reads)
+    scans = itertools.cycle(nicknames)
+    with_scans = [
+        next(scans) if i % args.scan_every == 0 else nickname
+        for i, nickname in enumerate(skewed)
+    ]
+    loop = asyncio.get_event_loop()
+
+    async def load(db: AbstractAddressBookDB) -> None:
+        for nickname, addr in zip(nicknames, itertools.cycle(entries)):
+            await db.create_address(addr, nickname)
+
+    async def read(db: AbstractAddressBookDB, keys: Iterator[str]) -> None:
+        await db.read_address(next(keys))
+
+    async def read_raw(
+        db: AbstractAddressBookDB,
+        keys: Iterator[str]
+    ) -> None:
+        await db.read_address_raw(next(keys))
+
+    with tempfile.TemporaryDirectory(prefix='addrbook-bench') as tmp_dir:
+        db_config: Dict = {'fs': os.path.join(tmp_dir, 'fs')}
+        db = create_addressbook_db(db_config)
+        db.start()
+        loop.run_until_complete(load(db))
+        db.stop()
+
+        layers: Dict[str, Dict] = {
+            'fs': {},
+            'fs + cache': {'cache': {'max-size': max_size}},
+            'fs + tiered': {'tiered': {'max-bytes': max_bytes}},
+        }
+        print('{} of {} entries, {:.2f} MB, fit in memory'.format(
+            max_size, args.entries, max_bytes / 1e6
+        ))
+        runs = itertools.product(
+            layers.items(),
+            (('read_address', read), ('read_address_raw', read_raw)),
+            (('skewed', skewed), ('skewed + scan', with_scans))
+        )
+        for (label, layer_config), (op, func), (workload, keys) in runs:
+            db = create_addressbook_db({**db_config, **layer_config})
+            db.start()
+            key_cycle = itertools.cycle(keys)
+            async_bench(
+                '{} {}, {}'.format(op, workload, label),
+                lambda: func(db, key_cycle),
+                len(keys),
+                repeat=3
+            )
+            if isinstance(db, (CachedAddressBookDB, TieredAddressBookDB)):
+                print('{:<48} {:>12.1f} %'.format(
+                    'hit ratio', 100 * db.hits / (db.hits + db.misses)
+                ))
+            db.stop()
+
+
+if __name__ == '__main__':
+    main()
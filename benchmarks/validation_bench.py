@@ -0,0 +1,46 @@
+# Copyright (c) 2020. All rights reserved.
+
+import argparse
+import jsonschema  # type: ignore
+import logging
+
+from addrservice import ADDRESS_BOOK_SCHEMA
+from addrservice.service import AddressBookService
+from benchmarks import bench
+from data import address_data_suite
+
+
+def main(args=None) -> None:
+    parser = argparse.ArgumentParser(
+        description='Benchmark JSON Schema validation of address entries'
+    )
+    parser.add_argument(
+        '-n', '--number',
+        type=int,
+        default=2000,
+        help='validations per timing run, default: %(default)s'
+    )
+    args = parser.parse_args(args)
+
+    service = AddressBookService(
+        config={'addr-db': {'memory': None}},
+        logger=logging.getLogger('benchmarks')
+    )
+    addresses = list(address_data_suite().values())
+
+    def per_request_validate():
+        for addr in addresses:
+            jsonschema.validate(addr, ADDRESS_BOOK_SCHEMA)
+
+    def precompiled_validate():
+        for addr in addresses:
+            service.validate_address(addr)
+
+    n = args.number
+    base = bench('jsonschema.validate', per_request_validate, n)
+    fast = bench('service.validate_address', precompiled_validate, n)
+    print('speedup: {:.1f}x'.format(base / fast))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# Copyright (c) 2020. All rights reserved.
+
+import argparse
+import asyncio
+import os
+import tempfile
+
+from addrservice.database.addressbook_db import FilesystemAddressBookDB
+from addrservice.database.wal import DURABILITY_MODES
+from addrservice.datamodel import AddressEntry
+from benchmarks import async_bench
+from data import address_data_suite
+
+
+def main(args=None) -> None:
+    parser = argparse.ArgumentParser(
+        description='Benchmark fs engine writes in each durability mode'
+    )
+    parser.add_argument(
+        '-c', '--concurrency',
+        type=int,
+        default=16,
+        help='concurrent writers, default: %(default)s'
+    )
+    parser.add_argument(
+        '-n', '--number',
+        type=int,
+        default=20,
+        help='rounds of writes per timing run, default: %(default)s'
+    )
+    args = parser.parse_args(args)
+
+    addr = AddressEntry.from_api_dm(next(iter(address_data_suite().values())))
+    nicknames = ['nick-{}'.format(i) for i in range(args.concurrency)]
+
+    async def write_one(db: FilesystemAddressBookDB) -> None:
+        await db.update_address(nicknames[0], addr)
+
+    async def write_concurrently(db: FilesystemAddressBookDB) -> None:
+        await asyncio.gather(*(
+            db.update_address(nickname, addr) for nickname in nicknames
+        ))
+
+    loop = asyncio.get_event_loop()
+    for durability in DURABILITY_MODES:
+        with tempfile.TemporaryDirectory(prefix='addrbook-bench') as tmp_dir:
+            db = FilesystemAddressBookDB(
+                os.path.join(tmp_dir, 'fs'), durability=durability
+            )
+            db.start()
+            for nickname in nicknames:
+                loop.run_until_complete(db.create_address(addr, nickname))
+
+            syncs_before = db.wal.syncs if db.wal is not None else 0
+            async_bench(
+                'update x1, durability {}'.format(durability),
+                lambda: write_one(db),
+                args.number
+            )
+            async_bench(
+                'update x{} concurrently, durability {}'.format(
+                    args.concurrency, durability
+                ),
+                lambda: write_concurrently(db),
+                args.number
+            )
+            if db.wal is not None:
+                print('{:<48} {:>12}'.format(
+                    'fsyncs of the log, durability {}'.format(durability),
+                    db.wal.syncs - syncs_before
+                ))
+            db.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,18 @@
 #!/usr/bin/env python
 
 import argparse
+import glob
+import importlib
 import os
 import subprocess
-from typing import List
+from typing import Any, List
 import unittest
 
 SOURCE_CODE = ['addrservice']
 TEST_CODE = ['tests']
-ALL_CODE = SOURCE_CODE + TEST_CODE
+BENCH_CODE = ['benchmarks']
+TOOL_CODE = ['run.py']
+ALL_CODE = SOURCE_CODE + TEST_CODE + BENCH_CODE + TOOL_CODE
 
 
 def arg_parser() -> argparse.ArgumentParser:
@@ -58,6 +62,14 @@ def arg_parser() -> argparse.ArgumentParser:
         help='turn on verbose output'
     )
 
+    bench_cmd_parser = subparsers.add_parser('bench')
+    bench_cmd_parser.add_argument(
+        'names',
+        nargs='*',
+        default=[],
+        help='benchmarks to run, e.g. validation; default: all'
+    )
+
     return parser
 
 
@@ -80,6 +92,22 @@ def run_tests(suite_name: str, verbose: bool) -> None:
     unittest.TextTestRunner(verbosity=verbosity).run(test_suite)
 
 
+def run_benchmarks(names: List[str]) -> None:
+    if len(names) == 0:
+        names = sorted(
+            os.path.basename(f)[:-len('_bench.py')]
+            for f in glob.glob('benchmarks/*_bench.py')
+        )
+
+    for name in names:
+        print('== {}'.format(name))
+        # Any benchmark module has a main(args)
+        module: Any = importlib.import_module(
+            'benchmarks.{}_bench'.format(name)
+        )
+        module.main([])
+
+
 def main(args=None) -> None:
     os.chdir(os.path.abspath(os.path.dirname(__file__)))
 
@@ -91,6 +119,7 @@ def main(args=None) -> None:
         'typecheck': lambda: run_checker(args.checker, args.paths),
         'lint': lambda: run_checker(args.linter, args.paths),
         'test': lambda: run_tests(args.suite, args.verbose),
+        'bench': lambda: run_benchmarks(args.names),
     }
 
     actions.get(args.func, parser.print_help)()
@@ -2,9 +2,11 @@
 
 import asynctest  # type: ignore
 from io import StringIO
+import json
 import logging
 import logging.config
 import unittest
+import unittest.mock
 import yaml
 
 from addrservice import LOGGER_NAME
@@ -61,6 +63,51 @@ class AddressBookServiceWithInMemoryDBTest(asynctest.TestCase):
             all_addr[nickname] = addr
         self.assertEqual(len(all_addr), 2)
 
+    @asynctest.fail_on(active_handles=True)
+    async def test_get_addresses_raw(self) -> None:
+        all_raw = {}
+        async for nickname, raw in self.service.get_all_addresses_raw():
+            all_raw[nickname] = json.loads(raw)
+        self.assertEqual(all_raw, self.address_data)
+
+        page, cursor = await self.service.get_addresses_page_raw(1)
+        self.assertIsNotNone(cursor)
+        self.assertEqual(
+            [(nickname, json.loads(raw)) for nickname, raw in page],
+            (await self.service.get_addresses_page(1))[0]
+        )
+
+        nickname = page[0][0]
+        response = await self.service.get_address_response(nickname)
+        self.assertEqual(response.body, page[0][1])
+
+    async def test_get_address_response_uncached(self) -> None:
+        # Without a response cache, the version is not read at all
+        nickname = list(self.address_data.keys())[0]
+        addr_db = self.service.addr_db
+        version = await addr_db.read_address_version(nickname)
+        with unittest.mock.patch.object(
+            addr_db, 'read_address_version',
+            side_effect=AssertionError('version read')
+        ):
+            for response_version in (None, version):
+                response = await self.service.get_address_response(
+                    nickname, response_version
+                )
+                self.assertEqual(response.version, response_version)
+                self.assertEqual(
+                    json.loads(response.body), self.address_data[nickname]
+                )
+
+    def test_validate_address(self) -> None:
+        for addr in self.address_data.values():
+            self.service.validate_address(addr)
+
+        with self.assertRaises(ValueError):
+            self.service.validate_address({})
+        with self.assertRaises(ValueError):
+            self.service.validate_address({'full_name': 'X', 'age': 42})
+
     @asynctest.fail_on(active_handles=True)
     async def test_crud_address(self) -> None:
         nicknames = list(self.address_data.keys())
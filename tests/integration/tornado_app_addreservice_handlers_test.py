@@ -1,11 +1,18 @@
 # Copyright (c) 2020. All rights reserved.
 
+import asyncio
+import gzip
 import json
+from urllib.parse import urlencode
 
 import tornado.testing
 
 from addrservice.tornado.app import (
-    ADDRESSBOOK_ENTRY_URI_FORMAT_STR
+    ADDRESSBOOK_ENTRY_URI_FORMAT_STR,
+    IMPORT_BATCH_SIZE,
+    IMPORT_MAX_LINE_SIZE,
+    NDJSON_CONTENT_TYPE,
+    STREAM_CHUNK_SIZE
 )
 
 from tests.unit.tornado_app_handlers_test import (
@@ -153,6 +160,503 @@ class TestAddressServiceApp(AddressServiceTornadoAppTestSetup):
         self.assertEqual(r.code, 200, all_addrs)
         self.assertEqual(len(all_addrs), 0, all_addrs)
 
+    def test_get_all_addresses_streaming(self):
+        # Enough entries for the response to be flushed in several chunks
+        count = 3 * STREAM_CHUNK_SIZE // len(json.dumps(self.addr0)) + 1
+        for _ in range(count):
+            r = self.fetch(
+                ADDRESSBOOK_ENTRY_URI_FORMAT_STR.format(id=''),
+                method='POST',
+                headers=self.headers,
+                body=json.dumps(self.addr0),
+            )
+            self.assertEqual(r.code, 201)
+
+        r = self.fetch(
+            ADDRESSBOOK_ENTRY_URI_FORMAT_STR.format(id=''),
+            method='GET',
+            headers=None,
+        )
+        self.assertEqual(r.code, 200)
+        self.assertEqual(r.headers['Transfer-Encoding'], 'chunked')
+        all_addrs = json.loads(r.body.decode('utf-8'))
+        self.assertEqual(len(all_addrs), count)
+        for addr in all_addrs.values():
+            self.assertEqual(addr, self.addr0)
+
+        # Compressed stream
+        r = self.fetch(
+            ADDRESSBOOK_ENTRY_URI_FORMAT_STR.format(id=''),
+            method='GET',
+            headers={'Accept-Encoding': 'gzip'},
+            decompress_response=False,
+        )
+        self.assertEqual(r.code, 200)
+        self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+        all_addrs = json.loads(gzip.decompress(r.body).decode('utf-8'))
+        self.assertEqual(len(all_addrs), count)
+
+    def test_get_addresses_page(self):
+        for _ in range(5):
+            r = self.fetch(
+                ADDRESSBOOK_ENTRY_URI_FORMAT_STR.format(id=''),
+                method='POST',
+                headers=self.headers,
+                body=json.dumps(self.addr0),
+            )
+            self.assertEqual(r.code, 201)
+
+        uri = ADDRESSBOOK_ENTRY_URI_FORMAT_STR.format(id='') + '?limit=2'
+        pages = []
+        while uri:
+            r = self.fetch(uri, method='GET', headers=None)
+            self.assertEqual(r.code, 200)
+            pages.append(json.loads(r.body.decode('utf-8')))
+            link = r.headers.get('Link')
+            uri = link[1:link.index('>')] if link else None
+
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        nicknames = [nickname for page in pages for nickname in page]
+        self.assertEqual(nicknames, sorted(nicknames))
+
+        # GET page: error cases
+        for query in ['limit=0', 'limit=abc', 'limit=100000', 'cursor=%25']:
+            r = self.fetch(
+                ADDRESSBOOK_ENTRY_URI_FORMAT_STR.format(id='') + '?' + query,
+                method='GET',
+                headers=None,
+            )
+            self.assertEqual(r.code, 400, query)
+
+    def test_find_addresses(self):
+        book_uri = ADDRESSBOOK_ENTRY_URI_FORMAT_STR.format(id='')
+        ids = {}
+        for name, addr in [('a0', self.addr0), ('a1', self.addr1)] * 3:
+            r = self.fetch(
+                book_uri,
+                method='POST',
+                headers=self.headers,
+                body=json.dumps(addr),
+            )
+            self.assertEqual(r.code, 201)
+            nickname = r.headers['Location'].split('/')[-1]
+            ids.setdefault(name, []).append(nickname)
+
+        email = self.addr0['emails'][0]['email']
+        city = self.addr0['addresses'][0]['city']
+        uri = book_uri + '?' + urlencode(
+            {'email': email.upper(), 'city': city, 'limit': 2}
+        )
+        pages = []
+        while uri:
+            r = self.fetch(uri, method='GET', headers=None)
+            self.assertEqual(r.code, 200)
+            pages.append(json.loads(r.body.decode('utf-8')))
+            link = r.headers.get('Link')
+            uri = link[1:link.index('>')] if link else None
+
+        self.assertEqual([len(page) for page in pages], [2, 1])
+        nicknames = [nickname for page in pages for nickname in page]
+        self.assertEqual(nicknames, sorted(ids['a0']))
+        for page in pages:
+            for addr in page.values():
+                self.assertEqual(addr, self.addr0)
+
+        r = self.fetch(
+            book_uri + '?' + urlencode({'email': 'nobody@example.com'}),
+            method='GET',
+            headers=None,
+        )
+        self.assertEqual(r.code, 200)
+        self.assertEqual(json.loads(r.body.decode('utf-8')), {})
+
+        r = self.fetch(
+            book_uri + '?' + urlencode({'email': email, 'limit': 0}),
+            method='GET',
+            headers=None,
+        )
+        self.assertEqual(r.code, 400)
+
+    def test_search_addresses(self):
+        book_uri = ADDRESSBOOK_ENTRY_URI_FORMAT_STR.format(id='')
+        search_uri = ADDRESSBOOK_ENTRY_URI_FORMAT_STR.format(id='search')
+        ids = {}
+        for addr in [self.addr0, self.addr1, self.addr0]:
+            r = self.fetch(
+                book_uri,
+                method='POST',
+                headers=self.headers,
+                body=json.dumps(addr),
+            )
+            self.assertEqual(r.code, 201)
+            nickname = r.headers['Location'].split('/')[-1]
+            ids.setdefault(addr['full_name'], []).append(nickname)
+
+        def search(**args):
+            r = self.fetch(
+                search_uri + '?' + urlencode(args),
+                method='GET',
+                headers=None,
+            )
+            self.assertEqual(r.code, 200)
+            return json.loads(r.body.decode('utf-8'))['results']
+
+        # Full names rank above streets and localities
+        results = search(q='ra')
+        self.assertEqual(
+            [result['id'] for result in results],
+            ids['Rahul Gandhi'] + sorted(ids['Narendra Modi'])
+        )
+        addrs = {self.addr0['full_name']: self.addr0,
+                 self.addr1['full_name']: self.addr1}
+        for result in results:
+            self.assertEqual(
+                result['address'], addrs[result['address']['full_name']]
+            )
+
+        results = search(q='modi race', limit=1)
+        self.assertEqual(
+            [result['id'] for result in results],
+            sorted(ids['Narendra Modi'])[:1]
+        )
+        self.assertEqual(search(q='modi tughlak'), [])
+
+        for args in [{}, {'q': '--'}, {'q': 'ra', 'limit': 0},
+                     {'q': 'ra', 'limit': 'ten'}]:
+            r = self.fetch(
+                search_uri + '?' + urlencode(args),
+                method='GET',
+                headers=None,
+            )
+            self.assertEqual(r.code, 400, args)
+
+        # The search URI is not an entry's
+        r = self.fetch(
+            '/addresses:batch',
+            method='POST',
+            headers=self.headers,
+            body=json.dumps(
+                [{'op': 'create', 'id': 'search', 'address': self.addr0}]
+            ),
+        )
+        self.assertEqual(r.code, 200)
+        results = json.loads(r.body.decode('utf-8'))['results']
+        self.assertEqual(results[0]['status'], 400)
+
+    def test_get_address_response_cache(self):
+        # Big enough to be gzipped
+        addr = dict(self.addr0, addresses=self.addr0['addresses'] * 3)
+        r = self.fetch(
+            ADDRESSBOOK_ENTRY_URI_FORMAT_STR.format(id=''),
+            method='POST',
+            headers=self.headers,
+            body=json.dumps(addr),
+        )
+        self.assertEqual(r.code, 201)
+        addr_uri = r.headers['Location']
+
+        response_cache = self.addr_service.response_cache
+        for i in range(2):
+            r = self.fetch(
+                addr_uri,
+                method='GET',
+                headers={'Accept-Encoding': 'gzip'},
+                decompress_response=False,
+            )
+            self.assertEqual(r.code, 200)
+            self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(
+                addr, json.loads(gzip.decompress(r.body).decode('utf-8'))
+            )
+            self.assertEqual(response_cache.hits, i)
+
+        # Plain body from the same cache entry
+        r = self.fetch(
+            addr_uri,
+            method='GET',
+            headers=None,
+            decompress_response=False,
+        )
+        self.assertEqual(r.code, 200)
+        self.assertNotIn('Content-Encoding', r.headers)
+        self.assertEqual(addr, json.loads(r.body.decode('utf-8')))
+        self.assertEqual(response_cache.hits, 2)
+
+        # PUT invalidates
+        r = self.fetch(
+            addr_uri,
+            method='PUT',
+            headers=self.headers,
+            body=json.dumps(self.addr1),
+        )
+        self.assertEqual(r.code, 204)
+        r = self.fetch(addr_uri, method='GET', headers=None)
+        self.assertEqual(self.addr1, json.loads(r.body.decode('utf-8')))
+        self.assertEqual(response_cache.hits, 2)
+
+    def test_conditional_requests(self):
+        book_uri = ADDRESSBOOK_ENTRY_URI_FORMAT_STR.format(id='')
+        r = self.fetch(book_uri, method='GET', headers=None)
+        self.assertEqual(r.code, 200)
+        book_etag = r.headers['Etag']
+
+        r = self.fetch(
+            book_uri,
+            method='POST',
+            headers=self.headers,
+            body=json.dumps(self.addr0),
+        )
+        self.assertEqual(r.code, 201)
+        addr_uri = r.headers['Location']
+
+        # Address book has changed
+        r = self.fetch(
+            book_uri,
+            method='GET',
+            headers={'If-None-Match': book_etag},
+        )
+        self.assertEqual(r.code, 200)
+        book_etag = r.headers['Etag']
+        r = self.fetch(
+            book_uri + '?limit=10',
+            method='GET',
+            headers={'If-None-Match': book_etag},
+        )
+        self.assertEqual(r.code, 304)
+
+        # Entry
+        r = self.fetch(addr_uri, method='GET', headers=None)
+        self.assertEqual(r.code, 200)
+        etag = r.headers['Etag']
+        r = self.fetch(
+            addr_uri,
+            method='GET',
+            headers={'If-None-Match': etag},
+        )
+        self.assertEqual(r.code, 304)
+        self.assertEqual(r.body, b'')
+        r = self.fetch(
+            addr_uri,
+            method='GET',
+            headers={'If-None-Match': '"other", ' + etag},
+        )
+        self.assertEqual(r.code, 304)
+
+        # Update with a stale or weak ETag fails
+        for if_match in ['"stale"', 'W/' + etag]:
+            r = self.fetch(
+                addr_uri,
+                method='PUT',
+                headers=dict(self.headers, **{'If-Match': if_match}),
+                body=json.dumps(self.addr1),
+            )
+            self.assertEqual(r.code, 412, if_match)
+
+        r = self.fetch(
+            addr_uri,
+            method='PUT',
+            headers=dict(self.headers, **{'If-Match': etag}),
+            body=json.dumps(self.addr1),
+        )
+        self.assertEqual(r.code, 204)
+        new_etag = r.headers['Etag']
+        self.assertNotEqual(new_etag, etag)
+
+        r = self.fetch(
+            addr_uri,
+            method='GET',
+            headers={'If-None-Match': etag},
+        )
+        self.assertEqual(r.code, 200)
+        self.assertEqual(r.headers['Etag'], new_etag)
+        self.assertEqual(self.addr1, json.loads(r.body.decode('utf-8')))
+
+        r = self.fetch(
+            book_uri,
+            method='GET',
+            headers={'If-None-Match': book_etag},
+        )
+        self.assertEqual(r.code, 200)
+
+        # Delete
+        r = self.fetch(
+            addr_uri,
+            method='DELETE',
+            headers={'If-Match': etag},
+        )
+        self.assertEqual(r.code, 412)
+        r = self.fetch(
+            addr_uri,
+            method='DELETE',
+            headers={'If-Match': '*'},
+        )
+        self.assertEqual(r.code, 204)
+        r = self.fetch(
+            addr_uri,
+            method='DELETE',
+            headers={'If-Match': new_etag},
+        )
+        self.assertEqual(r.code, 404)
+
+    def test_concurrent_conditional_updates(self):
+        r = self.fetch(
+            ADDRESSBOOK_ENTRY_URI_FORMAT_STR.format(id=''),
+            method='POST',
+            headers=self.headers,
+            body=json.dumps(self.addr0),
+        )
+        self.assertEqual(r.code, 201)
+        addr_uri = r.headers['Location']
+        etag = self.fetch(addr_uri, method='GET').headers['Etag']
+
+        def put(addr):
+            return self.http_client.fetch(
+                self.get_url(addr_uri),
+                method='PUT',
+                headers=dict(self.headers, **{'If-Match': etag}),
+                body=json.dumps(addr),
+                raise_error=False,
+            )
+
+        # Only one of two updates of the same version is made
+        responses = self.io_loop.run_sync(
+            lambda: asyncio.gather(put(self.addr1), put(self.addr0))
+        )
+        self.assertEqual(sorted(r.code for r in responses), [204, 412])
+
+    def test_batch(self):
+        batch_uri = '/addresses:batch'
+        ops = [
+            {'op': 'create', 'address': self.addr0},
+            {'op': 'create', 'id': 'nick-a', 'address': self.addr0},
+            {'op': 'update', 'id': 'nick-a', 'address': self.addr1},
+            {'op': 'create', 'id': 'nick-a', 'address': self.addr0},
+            {'op': 'delete', 'id': 'nick-b'},
+            {'op': 'update', 'id': 'nick-a', 'address': {'bad': 1}},
+            {'op': 'create', 'id': '../etc', 'address': self.addr0},
+            {'op': 'upsert', 'id': 'nick-a'},
+        ]
+        r = self.fetch(
+            batch_uri,
+            method='POST',
+            headers=self.headers,
+            body=json.dumps(ops),
+        )
+        self.assertEqual(r.code, 200)
+        results = json.loads(r.body.decode('utf-8'))['results']
+        self.assertEqual(
+            [result['status'] for result in results],
+            [201, 201, 204, 409, 404, 400, 400, 400]
+        )
+        self.assertEqual(results[1]['id'], 'nick-a')
+
+        r = self.fetch(
+            ADDRESSBOOK_ENTRY_URI_FORMAT_STR.format(id=results[0]['id']),
+            method='GET',
+            headers=None,
+        )
+        self.assertEqual(r.code, 200)
+        self.assertEqual(self.addr0, json.loads(r.body.decode('utf-8')))
+        r = self.fetch(
+            ADDRESSBOOK_ENTRY_URI_FORMAT_STR.format(id='nick-a'),
+            method='GET',
+            headers=None,
+        )
+        self.assertEqual(r.code, 200)
+        self.assertEqual(self.addr1, json.loads(r.body.decode('utf-8')))
+
+        # NDJSON
+        body = '\n'.join(json.dumps(op) for op in [
+            {'op': 'delete', 'id': 'nick-a'},
+            {'op': 'delete', 'id': results[0]['id']},
+        ])
+        r = self.fetch(
+            batch_uri,
+            method='POST',
+            headers={'Content-Type': NDJSON_CONTENT_TYPE},
+            body=body + '\n',
+        )
+        self.assertEqual(r.code, 200)
+        results = json.loads(r.body.decode('utf-8'))['results']
+        self.assertEqual([result['status'] for result in results], [204, 204])
+
+        r = self.fetch(
+            ADDRESSBOOK_ENTRY_URI_FORMAT_STR.format(id=''),
+            method='GET',
+            headers=None,
+        )
+        self.assertEqual(json.loads(r.body.decode('utf-8')), {})
+
+        for body in ['{"op": "delete"}', '[]', 'not json']:
+            r = self.fetch(
+                batch_uri,
+                method='POST',
+                headers=self.headers,
+                body=body,
+            )
+            self.assertEqual(r.code, 400, body)
+
+    def test_export_import(self):
+        entries = [
+            {'id': 'nick-{:04d}'.format(i), 'address': self.addr0}
+            for i in range(IMPORT_BATCH_SIZE + 10)
+        ]
+        lines = [json.dumps(entry) for entry in entries]
+        lines.insert(3, '')
+        lines.insert(5, '{not json')
+        lines.insert(7, json.dumps({'id': 'nick-x', 'address': {}}))
+        r = self.fetch(
+            '/addresses:import',
+            method='POST',
+            headers={'Content-Type': NDJSON_CONTENT_TYPE},
+            body='\n'.join(lines),
+        )
+        self.assertEqual(r.code, 200)
+        summary = json.loads(r.body.decode('utf-8'))
+        self.assertEqual(summary['created'], len(entries))
+        self.assertEqual(summary['replaced'], 0)
+        self.assertEqual(summary['failed'], 2)
+        self.assertEqual(
+            [(e['line'], e['status']) for e in summary['errors']],
+            [(6, 400), (8, 400)]
+        )
+
+        # Export
+        r = self.fetch('/addresses:export', method='GET', headers=None)
+        self.assertEqual(r.code, 200)
+        self.assertEqual(r.headers['Content-Type'], NDJSON_CONTENT_TYPE)
+        exported = [
+            json.loads(line) for line in r.body.decode('utf-8').splitlines()
+        ]
+        self.assertEqual(
+            sorted(exported, key=lambda entry: entry['id']), entries
+        )
+
+        # Import again: existing entries are replaced
+        exported[0]['address'] = self.addr1
+        r = self.fetch(
+            '/addresses:import',
+            method='POST',
+            headers={'Content-Type': NDJSON_CONTENT_TYPE},
+            body=''.join(json.dumps(entry) + '\n' for entry in exported[:3]),
+        )
+        summary = json.loads(r.body.decode('utf-8'))
+        self.assertEqual((summary['created'], summary['replaced']), (0, 3))
+        r = self.fetch(
+            ADDRESSBOOK_ENTRY_URI_FORMAT_STR.format(id=exported[0]['id']),
+            method='GET',
+            headers=None,
+        )
+        self.assertEqual(self.addr1, json.loads(r.body.decode('utf-8')))
+
+        r = self.fetch(
+            '/addresses:import',
+            method='POST',
+            headers={'Content-Type': NDJSON_CONTENT_TYPE},
+            body='x' * (IMPORT_MAX_LINE_SIZE + 1),
+        )
+        self.assertEqual(r.code, 400)
+
 
 if __name__ == '__main__':
     tornado.testing.main()
@@ -1,19 +1,52 @@
 # Copyright (c) 2020. All rights reserved.
 
 from abc import ABCMeta, abstractmethod
+import asyncio
 import asynctest  # type: ignore
 from io import StringIO
+import json
 import os
+import random
+import sqlite3
 import tempfile
-from typing import Dict
+import threading
+from typing import Any, Dict, List, Tuple
 import unittest
+import unittest.mock
 import yaml
 
+import addrservice.database.addressbook_db as addressbook_db
 from addrservice.database.addressbook_db import (
-    AbstractAddressBookDB, InMemoryAddressBookDB, FilesystemAddressBookDB
+    AbstractAddressBookDB,
+    AddressWrite,
+    FilesystemAddressBookDB,
+    InMemoryAddressBookDB,
+    VersionMismatchError,
+    WRITE_CREATE,
+    WRITE_DELETE,
+    WRITE_UPDATE,
+    encode_entry,
 )
+from addrservice.database.cache_db import CachedAddressBookDB
+import addrservice.database.columnar_db as columnar_db
+from addrservice.database.columnar_db import ColumnarAddressBookDB
 from addrservice.database.db_engines import create_addressbook_db
-from addrservice.datamodel import AddressEntry
+import addrservice.database.file_io as file_io
+from addrservice.database import fs_layout, snapshot_file
+from addrservice.database.records import OP_PUT, RECORD_PREFIX_SIZE
+from addrservice.database.search_db import SearchIndexedAddressBookDB
+import addrservice.database.segment_db as segment_db
+from addrservice.database.segment_db import SegmentAddressBookDB
+import addrservice.database.sqlite_db as sqlite_db
+from addrservice.database.sqlite_db import SqliteAddressBookDB
+import addrservice.database.tiered_db as tiered_db
+from addrservice.database.tiered_db import (
+    FrequencySketch, TieredAddressBookDB, entry_size
+)
+import addrservice.database.wal as wal_log
+from addrservice.datamodel import (
+    Address, AddressEntry, AddressType, Email, LazyAddressEntry, Phone
+)
 
 from data import address_data_suite
 
@@ -33,6 +66,38 @@ addr-db:
         self.assertIn('memory', cfg['addr-db'])
         db = create_addressbook_db(cfg['addr-db'])
         self.assertEqual(type(db), InMemoryAddressBookDB)
+        self.assertIsNone(db.snapshot_path)
+
+        cfg = self.read_config('''
+addr-db:
+  memory:
+    snapshot: /tmp/addresses.snap
+    snapshot-interval: 300
+    durability: batch
+        ''')
+
+        db = create_addressbook_db(cfg['addr-db'])
+        self.assertEqual(type(db), InMemoryAddressBookDB)
+        self.assertEqual(db.snapshot_path, '/tmp/addresses.snap')
+        self.assertEqual(db.snapshot_interval, 300)
+        self.assertEqual(db.durability, 'batch')
+
+        cfg['addr-db']['memory']['durability'] = 'always'
+        with self.assertRaises(ValueError):
+            create_addressbook_db(cfg['addr-db'])
+        del cfg['addr-db']['memory']['snapshot']
+        cfg['addr-db']['memory']['durability'] = 'batch'
+        with self.assertRaises(ValueError):
+            create_addressbook_db(cfg['addr-db'])
+
+    def test_columnar_db_config(self):
+        cfg = self.read_config('''
+addr-db:
+  columnar: null
+        ''')
+
+        db = create_addressbook_db(cfg['addr-db'])
+        self.assertEqual(type(db), ColumnarAddressBookDB)
 
     def test_file_system_db_config(self):
         cfg = self.read_config('''
@@ -45,6 +110,172 @@ addr-db:
         self.assertEqual(type(db), FilesystemAddressBookDB)
         self.assertEqual(db.store, '/tmp')
 
+    def test_file_system_wal_db_config(self):
+        cfg = self.read_config('''
+addr-db:
+  fs:
+    path: /tmp
+    durability: batch
+        ''')
+
+        db = create_addressbook_db(cfg['addr-db'])
+        self.assertEqual(type(db), FilesystemAddressBookDB)
+        self.assertEqual(db.store, '/tmp')
+        self.assertEqual(db.durability, 'batch')
+
+        cfg['addr-db']['fs']['durability'] = 'always'
+        with self.assertRaises(ValueError):
+            create_addressbook_db(cfg['addr-db'])
+
+    def test_file_system_io_db_config(self):
+        cfg = self.read_config('''
+addr-db:
+  fs:
+    path: /tmp
+    io: threads
+    io-threads: 2
+    scan-concurrency: 8
+    scan-ordered: true
+        ''')
+
+        db = create_addressbook_db(cfg['addr-db'])
+        self.assertEqual(type(db.io), file_io.ThreadPoolFileIO)
+        self.assertEqual(db.io.threads, 2)
+        self.assertEqual(db.scan_concurrency, 8)
+        self.assertTrue(db.scan_ordered)
+        db.stop()
+
+        cfg['addr-db']['fs']['io'] = 'aiofiles'
+        db = create_addressbook_db(cfg['addr-db'])
+        self.assertEqual(type(db.io), file_io.AiofilesFileIO)
+
+        cfg['addr-db']['fs']['io'] = 'uring'
+        with self.assertRaises(ValueError):
+            create_addressbook_db(cfg['addr-db'])
+
+        cfg['addr-db']['fs']['io'] = 'threads'
+        cfg['addr-db']['fs']['io-threads'] = 0
+        with self.assertRaises(ValueError):
+            create_addressbook_db(cfg['addr-db'])
+
+        cfg['addr-db']['fs']['io-threads'] = 2
+        cfg['addr-db']['fs']['scan-concurrency'] = 0
+        with self.assertRaises(ValueError):
+            create_addressbook_db(cfg['addr-db'])
+
+    def test_file_system_sharded_db_config(self):
+        with tempfile.TemporaryDirectory(prefix='addrbook-fsdb') as tempdir:
+            cfg = self.read_config('''
+addr-db:
+  fs:
+    path: {}
+    shards: 16
+            '''.format(tempdir))
+
+            db = create_addressbook_db(cfg['addr-db'])
+            self.assertEqual(db.shards, 16)
+            self.assertEqual(len(os.listdir(tempdir)), 17)
+
+            # The store has 16 shards
+            del cfg['addr-db']['fs']['shards']
+            with self.assertRaises(ValueError):
+                create_addressbook_db(cfg['addr-db'])
+
+    def test_segment_db_config(self):
+        cfg = self.read_config('''
+addr-db:
+  segment:
+    path: /tmp/addrservice-db.seg
+    compaction-ratio: 0.25
+        ''')
+
+        self.assertIn('segment', cfg['addr-db'])
+        db = create_addressbook_db(cfg['addr-db'])
+        self.assertEqual(type(db), SegmentAddressBookDB)
+        self.assertEqual(db.path, '/tmp/addrservice-db.seg')
+        self.assertEqual(db.compaction_ratio, 0.25)
+
+    def test_sqlite_db_config(self):
+        cfg = self.read_config('''
+addr-db:
+  sqlite:
+    path: /tmp/addrservice-db.sqlite
+    readers: 2
+    sync: true
+        ''')
+
+        db = create_addressbook_db(cfg['addr-db'])
+        self.assertEqual(type(db), SqliteAddressBookDB)
+        self.assertEqual(db.path, '/tmp/addrservice-db.sqlite')
+        self.assertEqual(db.readers, 2)
+        self.assertTrue(db.sync)
+
+    def test_cached_db_config(self):
+        cfg = self.read_config('''
+addr-db:
+  fs: /tmp
+  cache:
+    max-size: 10
+    ttl: 2.5
+        ''')
+
+        db = create_addressbook_db(cfg['addr-db'])
+        self.assertEqual(type(db), CachedAddressBookDB)
+        self.assertEqual(type(db.db), FilesystemAddressBookDB)
+        self.assertEqual(db.max_size, 10)
+        self.assertEqual(db.ttl, 2.5)
+
+        cfg = self.read_config('''
+addr-db:
+  cache: null
+  memory: null
+        ''')
+
+        db = create_addressbook_db(cfg['addr-db'])
+        self.assertEqual(type(db), CachedAddressBookDB)
+        self.assertEqual(type(db.db), InMemoryAddressBookDB)
+        self.assertIsNone(db.ttl)
+
+    def test_search_db_config(self):
+        cfg = self.read_config('''
+addr-db:
+  cache: null
+  search: null
+  memory: null
+        ''')
+
+        db = create_addressbook_db(cfg['addr-db'])
+        self.assertEqual(type(db), CachedAddressBookDB)
+        self.assertEqual(type(db.db), SearchIndexedAddressBookDB)
+        self.assertEqual(type(db.db.db), InMemoryAddressBookDB)
+
+    def test_tiered_db_config(self):
+        cfg = self.read_config('''
+addr-db:
+  cache: null
+  tiered:
+    max-bytes: 1048576
+  fs: /tmp
+        ''')
+
+        db = create_addressbook_db(cfg['addr-db'])
+        self.assertEqual(type(db), CachedAddressBookDB)
+        self.assertEqual(type(db.db), TieredAddressBookDB)
+        self.assertEqual(type(db.db.db), FilesystemAddressBookDB)
+        self.assertEqual(db.db.max_bytes, 1048576)
+
+        cfg = self.read_config('''
+addr-db:
+  tiered: null
+  sqlite:
+    path: /tmp/addrservice-db.sqlite
+        ''')
+
+        db = create_addressbook_db(cfg['addr-db'])
+        self.assertEqual(type(db), TieredAddressBookDB)
+        self.assertEqual(type(db.db), SqliteAddressBookDB)
+        self.assertEqual(db.max_bytes, tiered_db.TIERED_MAX_BYTES)
+
 
 class AbstractAddressBookDBTestCase(metaclass=ABCMeta):
     def setUp(self) -> None:
@@ -112,6 +343,325 @@ class AbstractAddressBookDBTestCase(metaclass=ABCMeta):
         await self.addr_db.delete_address(new_nickname)
         self.assertEqual(self.addr_count(), 0)  # type: ignore
 
+    @asynctest.fail_on(active_handles=True)
+    async def test_read_address_version(self) -> None:
+        addrs = list(self.address_data.values())
+        nickname = await self.addr_db.create_address(addrs[0])
+        version = await self.addr_db.read_address_version(nickname)
+        self.assertEqual(  # type: ignore
+            version,
+            await self.addr_db.read_address_version(nickname)
+        )
+
+        await self.addr_db.update_address(nickname, addrs[1])
+        self.assertNotEqual(  # type: ignore
+            version,
+            await self.addr_db.read_address_version(nickname)
+        )
+
+        await self.addr_db.delete_address(nickname)
+        with self.assertRaises(KeyError):  # type: ignore
+            await self.addr_db.read_address_version(nickname)
+
+    @asynctest.fail_on(active_handles=True)
+    async def test_conditional_write(self) -> None:
+        addrs = list(self.address_data.values())
+        nickname = await self.addr_db.create_address(addrs[0])
+        version = await self.addr_db.read_address_version(nickname)
+
+        # Of concurrent updates of the same version, only one is made
+        results = await asyncio.gather(
+            self.addr_db.update_address(nickname, addrs[1], [version]),
+            self.addr_db.update_address(nickname, addrs[0], [version]),
+            return_exceptions=True
+        )
+        errors = [result for result in results if result is not None]
+        self.assertEqual(len(errors), 1)  # type: ignore
+        self.assertIsInstance(  # type: ignore
+            errors[0], VersionMismatchError
+        )
+        new_version = await self.addr_db.read_address_version(nickname)
+        self.assertNotEqual(new_version, version)  # type: ignore
+
+        with self.assertRaises(VersionMismatchError):  # type: ignore
+            await self.addr_db.delete_address(nickname, [version, 'other'])
+        await self.addr_db.read_address(nickname)
+        await self.addr_db.delete_address(nickname, ['other', new_version])
+        with self.assertRaises(KeyError):  # type: ignore
+            await self.addr_db.update_address(nickname, addrs[0], [version])
+        with self.assertRaises(KeyError):  # type: ignore
+            await self.addr_db.delete_address(nickname, [new_version])
+
+    @asynctest.fail_on(active_handles=True)
+    async def test_read_addresses_version(self) -> None:
+        addrs = list(self.address_data.values())
+        versions = [await self.addr_db.read_addresses_version()]
+
+        nickname = await self.addr_db.create_address(addrs[0])
+        versions.append(await self.addr_db.read_addresses_version())
+        await self.addr_db.update_address(nickname, addrs[1])
+        versions.append(await self.addr_db.read_addresses_version())
+        await self.addr_db.read_address(nickname)
+        self.assertEqual(  # type: ignore
+            versions[-1],
+            await self.addr_db.read_addresses_version()
+        )
+        await self.addr_db.delete_address(nickname)
+        versions.append(await self.addr_db.read_addresses_version())
+
+        self.assertEqual(len(set(versions)), 4)  # type: ignore
+
+    @asynctest.fail_on(active_handles=True)
+    async def test_read_addresses_page(self) -> None:
+        addr = list(self.address_data.values())[0]
+        nicknames = ['nick-{:02d}'.format(i) for i in range(25)]
+        for nickname in reversed(nicknames):
+            await self.addr_db.create_address(addr, nickname)
+
+        pages = []
+        after = None
+        while True:
+            page = await self.addr_db.read_addresses_page(10, after)
+            if not page:
+                break
+            pages.append([nickname for nickname, _ in page])
+            after = page[-1][0]
+
+        self.assertEqual(  # type: ignore
+            pages,
+            [nicknames[:10], nicknames[10:20], nicknames[20:]]
+        )
+
+        await self.addr_db.delete_address('nick-10')
+        page = await self.addr_db.read_addresses_page(2, 'nick-09')
+        self.assertEqual(  # type: ignore
+            [nickname for nickname, _ in page],
+            ['nick-11', 'nick-12']
+        )
+
+    @asynctest.fail_on(active_handles=True)
+    async def test_read_raw(self) -> None:
+        # Raw reads are the same bytes as encoding what the others read
+        for nickname, addr in self.address_data.items():
+            await self.addr_db.create_address(addr, nickname)
+        nicknames = sorted(self.address_data)
+
+        for nickname in nicknames:
+            raw = await self.addr_db.read_address_raw(nickname)
+            self.assertIsInstance(raw, bytes)  # type: ignore
+            self.assertEqual(  # type: ignore
+                raw,
+                encode_entry(await self.addr_db.read_address(nickname))
+            )
+
+        page = await self.addr_db.read_addresses_page(10)
+        self.assertEqual(  # type: ignore
+            await self.addr_db.read_addresses_page_raw(10),
+            [(nickname, encode_entry(addr)) for nickname, addr in page]
+        )
+
+        scanned = {}
+        async for nickname, raw in self.addr_db.read_all_addresses_raw():
+            scanned[nickname] = raw
+        self.assertEqual(  # type: ignore
+            scanned,
+            {
+                nickname: encode_entry(addr)
+                for nickname, addr in self.address_data.items()
+            }
+        )
+
+        with self.assertRaises(KeyError):  # type: ignore
+            await self.addr_db.read_address_raw('does-not-exist')
+
+    @asynctest.fail_on(active_handles=True)
+    async def test_read_all_addresses_while_writing(self) -> None:
+        addr = list(self.address_data.values())[0]
+        nicknames = ['nick-{}'.format(i) for i in range(5)]
+        for nickname in nicknames:
+            await self.addr_db.create_address(addr, nickname)
+
+        scanned: List[str] = []
+        async for nickname, _ in self.addr_db.read_all_addresses():
+            if not scanned:
+                await self.addr_db.create_address(addr, 'nick-new')
+                await self.addr_db.delete_address(nicknames[-1])
+            scanned.append(nickname)
+
+        self.assertLessEqual(  # type: ignore
+            set(scanned), set(nicknames) | {'nick-new'}
+        )
+        self.assertEqual(len(scanned), len(set(scanned)))  # type: ignore
+
+    @asynctest.fail_on(active_handles=True)
+    @unittest.mock.patch.object(addressbook_db, 'SCAN_PAGE_SIZE', 16)
+    @unittest.mock.patch.object(sqlite_db, 'SCAN_PAGE_SIZE', 16)
+    @unittest.mock.patch.object(file_io, 'FILE_READ_BATCH', 4)
+    async def test_read_all_addresses_snapshot(self) -> None:
+        # Two overlapping scans, with random writes between every step of
+        # either: each sees the entries as they were when it began. Scans
+        # read few entries at a time, so that writes land between reads.
+        rand = random.Random(42)
+        addrs = list(self.address_data.values())
+        book: Dict[str, bytes] = {}
+        for i in range(200):
+            nickname = 'nick-{:03d}'.format(i)
+            await self.addr_db.create_address(addrs[0], nickname)
+            book[nickname] = encode_entry(addrs[0])
+
+        async def write() -> None:
+            nickname = 'nick-{:03d}'.format(rand.randrange(250))
+            addr = rand.choice(addrs)
+            if nickname not in book:
+                await self.addr_db.create_address(addr, nickname)
+                book[nickname] = encode_entry(addr)
+            elif rand.random() < 0.5:
+                await self.addr_db.update_address(nickname, addr)
+                book[nickname] = encode_entry(addr)
+            else:
+                await self.addr_db.delete_address(nickname)
+                del book[nickname]
+
+        async def begin_scan() -> Tuple[Any, Dict[str, bytes], List]:
+            # A scan begins on its first step, not when it is made
+            scan = self.addr_db.read_all_addresses()
+            nickname, addr = await scan.__anext__()
+            return scan, dict(book), [(nickname, encode_entry(addr))]
+
+        # Each scan, the book when it began, and what it has yielded
+        scans = [await begin_scan()]
+        done = 0
+        while scans:
+            running = []
+            for scan, expected, scanned in scans:
+                try:
+                    nickname, addr = await scan.__anext__()
+                except StopAsyncIteration:
+                    self.assertEqual(  # type: ignore
+                        dict(scanned), expected
+                    )
+                    self.assertEqual(  # type: ignore
+                        len(scanned), len(expected)
+                    )
+                    done += 1
+                    continue
+                scanned.append((nickname, encode_entry(addr)))
+                running.append((scan, expected, scanned))
+                for _ in range(rand.randrange(3)):
+                    await write()
+            scans = running
+            if done == 0 and len(scans[0][2]) == 50 and len(scans) == 1:
+                scans.append(await begin_scan())
+
+        self.assertEqual(done, 2)  # type: ignore
+        # Scans that are done keep nothing
+        scanned_now = {}
+        async for nickname, addr in self.addr_db.read_all_addresses():
+            scanned_now[nickname] = encode_entry(addr)
+        self.assertEqual(scanned_now, book)  # type: ignore
+
+    @asynctest.fail_on(active_handles=True)
+    async def test_find_nicknames(self) -> None:
+        namo = self.address_data['namo']
+        raga = self.address_data['raga']
+        await self.addr_db.create_address(namo, 'namo')
+        self.assertEqual(  # type: ignore
+            await self.addr_db.find_nicknames({'city': 'New Delhi'}),
+            ['namo']
+        )
+
+        await self.addr_db.create_address(raga, 'raga')
+        await self.addr_db.create_address(namo, 'namo-2')
+        self.assertEqual(  # type: ignore
+            await self.addr_db.find_nicknames({'city': 'New Delhi'}),
+            ['namo', 'namo-2', 'raga']
+        )
+        self.assertEqual(  # type: ignore
+            await self.addr_db.find_nicknames({
+                'city': 'New Delhi', 'email': 'office@rahulgandhi.in'
+            }),
+            ['raga']
+        )
+
+        await self.addr_db.update_address('namo-2', raga)
+        await self.addr_db.delete_address('namo')
+        self.assertEqual(  # type: ignore
+            await self.addr_db.find_nicknames({'city': 'Varanasi'}), []
+        )
+        self.assertEqual(  # type: ignore
+            await self.addr_db.find_nicknames({'phone': '911123795161'}),
+            ['namo-2', 'raga']
+        )
+
+    @asynctest.fail_on(active_handles=True)
+    async def test_search_nicknames(self) -> None:
+        namo = self.address_data['namo']
+        raga = self.address_data['raga']
+        await self.addr_db.create_address(namo, 'namo')
+        self.assertEqual(  # type: ignore
+            await self.addr_db.search_nicknames('ra', 10), ['namo']
+        )
+
+        await self.addr_db.create_address(raga, 'raga')
+        self.assertEqual(  # type: ignore
+            await self.addr_db.search_nicknames('ra', 10), ['raga', 'namo']
+        )
+        self.assertEqual(  # type: ignore
+            await self.addr_db.search_nicknames('Gandhi Tughlak', 10),
+            ['raga']
+        )
+        self.assertEqual(  # type: ignore
+            await self.addr_db.search_nicknames('ra', 1), ['raga']
+        )
+
+        await self.addr_db.update_address('raga', namo)
+        await self.addr_db.write_addresses([
+            AddressWrite(WRITE_CREATE, 'raga-2', raga),
+            AddressWrite(WRITE_DELETE, 'namo'),
+        ])
+        self.assertEqual(  # type: ignore
+            await self.addr_db.search_nicknames('rahul', 10), ['raga-2']
+        )
+        self.assertEqual(  # type: ignore
+            await self.addr_db.search_nicknames('modi', 10), ['raga']
+        )
+        self.assertEqual(  # type: ignore
+            await self.addr_db.search_nicknames('', 10), []
+        )
+
+    @asynctest.fail_on(active_handles=True)
+    async def test_write_addresses(self) -> None:
+        addrs = list(self.address_data.values())
+        results = await self.addr_db.write_addresses([
+            AddressWrite(WRITE_CREATE, 'nick-a', addrs[0]),
+            AddressWrite(WRITE_CREATE, 'nick-b', addrs[0]),
+            AddressWrite(WRITE_UPDATE, 'nick-a', addrs[1]),
+            AddressWrite(WRITE_CREATE, 'nick-a', addrs[0]),
+            AddressWrite(WRITE_DELETE, 'nick-b'),
+            AddressWrite(WRITE_DELETE, 'nick-b'),
+            AddressWrite(WRITE_UPDATE, 'nick-c', addrs[1]),
+        ])
+
+        self.assertEqual(  # type: ignore
+            [error is None for error in results],
+            [True, True, True, False, True, False, False]
+        )
+        for error in results:
+            if error is not None:
+                self.assertIsInstance(error, KeyError)  # type: ignore
+
+        self.assertEqual(self.addr_count(), 1)  # type: ignore
+        addr = await self.addr_db.read_address('nick-a')
+        self.assertEqual(  # type: ignore
+            addr.to_api_dm(), addrs[1].to_api_dm()
+        )
+        with self.assertRaises(KeyError):  # type: ignore
+            await self.addr_db.read_address('nick-b')
+        page = await self.addr_db.read_addresses_page(10)
+        self.assertEqual(  # type: ignore
+            [nickname for nickname, _ in page], ['nick-a']
+        )
+
 
 class InMemoryAddressBookDBTest(
     AbstractAddressBookDBTestCase,
@@ -125,24 +675,301 @@ class InMemoryAddressBookDBTest(
         return len(self.mem_db.db)
 
 
+class SnapshotInMemoryAddressBookDBTest(InMemoryAddressBookDBTest):
+    db_class = InMemoryAddressBookDB
+    durability = 'batch'
+
+    def make_addr_db(self) -> AbstractAddressBookDB:
+        self.tmp_dir = tempfile.TemporaryDirectory(prefix='addrbook-snapshot')
+        self.snapshot_path = os.path.join(self.tmp_dir.name, 'addresses.snap')
+        return self.reopen()
+
+    def reopen(self) -> InMemoryAddressBookDB:
+        self.mem_db = self.db_class(
+            self.snapshot_path, durability=self.durability
+        )
+        self.mem_db.start()
+        return self.mem_db
+
+    def tearDown(self):
+        self.mem_db.stop()
+        self.tmp_dir.cleanup()
+        super().tearDown()
+
+    def crash(self) -> None:
+        # Leaves the files as they are, without saving a snapshot
+        for wal in self.mem_db._old_wals:
+            wal.close()
+        if self.mem_db.wal is not None:
+            self.mem_db.wal.close()
+
+    def files(self) -> List[str]:
+        return sorted(os.listdir(self.tmp_dir.name))
+
+    async def book(self) -> Dict[str, bytes]:
+        return {
+            nickname: addr
+            async for nickname, addr in self.mem_db.read_all_addresses_raw()
+        }
+
+    async def test_restore(self):
+        for nickname, addr in self.address_data.items():
+            await self.mem_db.create_address(addr, nickname)
+        await self.mem_db.delete_address('raga')
+        await self.mem_db.create_address(self.address_data['raga'], 'ragu')
+        book = await self.book()
+        city = self.address_data['namo'].addresses[0].city
+        found = await self.mem_db.find_nicknames({'city': city})
+        self.mem_db.stop()
+        self.assertEqual(self.files(), ['addresses.snap'])
+
+        self.reopen()
+        self.assertEqual(await self.book(), book)
+        self.assertEqual(
+            (await self.mem_db.read_address('ragu')).to_api_dm(),
+            self.address_data['raga'].to_api_dm()
+        )
+        # The index is built by the first query
+        self.assertIsNone(self.mem_db.secondary)
+        self.assertEqual(
+            await self.mem_db.find_nicknames({'city': city}), found
+        )
+        await self.mem_db.delete_address('namo')
+        self.assertEqual(
+            await self.mem_db.find_nicknames({'city': city}),
+            [n for n in found if n != 'namo']
+        )
+        self.assertEqual(self.addr_count(), 1)
+
+        with self.assertRaises(RuntimeError):
+            self.db_class(self.snapshot_path, durability='batch').start()
+
+    async def test_replay(self):
+        addr = self.address_data['namo']
+        for i in range(5):
+            await self.mem_db.create_address(addr, 'nick-{}'.format(i))
+        self.mem_db.stop()
+
+        self.reopen()
+        await self.mem_db.delete_address('nick-0')
+        await self.mem_db.update_address('nick-1', self.address_data['raga'])
+        await self.mem_db.create_address(addr, 'nick-5')
+        book = await self.book()
+        self.crash()
+
+        self.reopen()
+        self.assertEqual(await self.book(), book)
+        # The log replayed is saved to a new snapshot, and removed
+        self.assertEqual(
+            self.files(), ['addresses.snap', 'addresses.snap.log.2']
+        )
+        self.assertEqual(self.mem_db.wal.size, 0)
+
+    @unittest.mock.patch.object(addressbook_db, 'SNAPSHOT_BATCH', 1)
+    async def test_snapshot(self):
+        addrs = list(self.address_data.values())
+        for i in range(50):
+            await self.mem_db.create_address(addrs[i % 2], 'nick-{}'.format(i))
+        before = await self.book()
+        old_log = self.mem_db.wal.path
+
+        # Writes carry on while the snapshot is saved, an entry per step;
+        # those made once it began go to the next log
+        snapshot = asyncio.ensure_future(self.mem_db.snapshot())
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        await asyncio.gather(
+            self.mem_db.delete_address('nick-40'),
+            self.mem_db.update_address('nick-30', addrs[1]),
+            self.mem_db.create_address(addrs[0], 'nick-50'),
+        )
+        await snapshot
+        self.assertFalse(os.path.exists(old_log))
+        _, entries = snapshot_file.read_snapshot(self.snapshot_path)
+        self.assertEqual(dict(entries), before)
+
+        await self.mem_db.delete_address('nick-20')
+        book = await self.book()
+        self.crash()
+        self.reopen()
+        self.assertEqual(await self.book(), book)
+
+    async def test_corrupt_snapshot(self):
+        await self.mem_db.create_address(self.address_data['namo'], 'namo')
+        self.mem_db.stop()
+        with open(self.snapshot_path, 'r+b') as f:
+            f.seek(-10, os.SEEK_END)
+            f.write(b'x')
+
+        with self.assertRaises(ValueError):
+            self.reopen()
+
+
+class SnapshotColumnarAddressBookDBTest(SnapshotInMemoryAddressBookDBTest):
+    db_class = ColumnarAddressBookDB
+
+    async def test_load_undecoded(self):
+        for nickname, addr in self.address_data.items():
+            await self.mem_db.create_address(addr, nickname)
+        self.mem_db.stop()
+
+        with unittest.mock.patch.object(
+            columnar_db.EntryColumns, 'put', autospec=True,
+            side_effect=columnar_db.EntryColumns.put
+        ) as put:
+            # Entries are kept as JSON until written
+            self.reopen()
+            for nickname, addr in self.address_data.items():
+                value = await self.mem_db.read_address(nickname)
+                self.assertEqual(type(value), LazyAddressEntry)
+                self.assertEqual(value.to_api_dm(), addr.to_api_dm())
+            self.assertEqual(put.call_count, 0)
+
+            # A write also moves others into the columns
+            raga = self.address_data['raga']
+            await self.mem_db.update_address('namo', raga)
+            self.assertEqual(put.call_count, len(self.address_data))
+        for nickname in self.address_data:
+            value = await self.mem_db.read_address(nickname)
+            self.assertEqual(type(value), AddressEntry)
+            self.assertEqual(value.to_api_dm(), raga.to_api_dm())
+
+
+class ColumnarAddressBookDBTest(InMemoryAddressBookDBTest):
+    def make_addr_db(self) -> AbstractAddressBookDB:
+        self.mem_db = ColumnarAddressBookDB()
+        return self.mem_db
+
+    async def test_columns(self):
+        entry = AddressEntry(
+            full_name='Dätä Mödel',
+            addresses=[
+                Address(
+                    kind=AddressType.home,
+                    street_name='Microservices Ave',
+                    pincode='560 001',
+                    country='India',
+                    unit_number=1.5,  # type: ignore
+                    street_number='4B',
+                ),
+                Address(
+                    kind=AddressType.work,
+                    street_name='Microservices Ave',
+                    pincode=560001,
+                    country='India',
+                    city='Bangalore',
+                ),
+            ],
+            phone_numbers=[
+                Phone(AddressType.home, 91, 2 ** 70, 80),
+                Phone(AddressType.work, 91, 9876543210),
+            ],
+            fax_numbers=[Phone(AddressType.work, 1, 1.5)],  # type: ignore
+            emails=[Email(AddressType.work, 'datamodel@microservices.py')],
+        )
+        await self.mem_db.create_address(entry, 'dm')
+        addr = await self.mem_db.read_address('dm')
+        self.assertEqual(addr.to_api_dm(), entry.to_api_dm())
+        for nickname, value in self.address_data.items():
+            await self.mem_db.create_address(value, nickname)
+            addr = await self.mem_db.read_address(nickname)
+            self.assertEqual(addr.to_api_dm(), value.to_api_dm())
+
+        # Distinct values are stored once
+        columns = self.mem_db.db.columns  # type: ignore
+        values = len(columns.values)
+        await self.mem_db.create_address(entry, 'dm-2')
+        self.assertEqual(len(columns.values), values)
+
+    async def test_compaction(self):
+        entries = list(self.address_data.values())
+        old_columns = self.mem_db.db.columns  # type: ignore
+        with unittest.mock.patch.multiple(
+            columnar_db, COMPACTION_MIN_ROWS=10, COMPACTION_MIN_BYTES=100
+        ):
+            for i in range(5):
+                await self.mem_db.create_address(entries[0], str(i))
+            for _ in range(10):
+                for i in range(5):
+                    await self.mem_db.update_address(str(i), entries[1])
+            await self.mem_db.delete_address('0')
+
+        columns = self.mem_db.db.columns  # type: ignore
+        self.assertIsNot(columns, old_columns)
+        self.assertLessEqual(columns.dead_rows, columns.live_rows)
+        for i in range(1, 5):
+            addr = await self.mem_db.read_address(str(i))
+            self.assertEqual(addr.to_api_dm(), entries[1].to_api_dm())
+
+    async def test_write_starts_compaction(self):
+        entries = list(self.address_data.values())
+        store = self.mem_db.db
+        expected = {}
+        with unittest.mock.patch.multiple(
+            columnar_db, COMPACTION_MIN_ROWS=10, COMPACTION_MIN_BYTES=10 ** 9,
+            COMPACTION_STEP=2
+        ):
+            for i in range(10):
+                await self.mem_db.create_address(entries[0], str(i))
+                expected[str(i)] = entries[0]
+            old_columns = store.columns  # type: ignore
+            i = 0
+            while not store.compacting:  # type: ignore
+                await self.mem_db.update_address(str(i % 10), entries[1])
+                expected[str(i % 10)] = entries[1]
+                i += 1
+
+            # The write that started compaction moved only a few entries
+            self.assertIs(store.columns, old_columns)  # type: ignore
+
+            # Entries are read and written wherever they are meanwhile
+            await self.mem_db.delete_address('0')
+            del expected['0']
+            await self.mem_db.create_address(entries[0], 'new')
+            expected['new'] = entries[0]
+            i = 1
+            while store.compacting:  # type: ignore
+                self.assertEqual(len(store), len(expected))
+                for nickname, entry in expected.items():
+                    addr = await self.mem_db.read_address(nickname)
+                    self.assertEqual(addr.to_api_dm(), entry.to_api_dm())
+                await self.mem_db.update_address(str(i), entries[0])
+                expected[str(i)] = entries[0]
+                i += 1
+
+        columns = store.columns  # type: ignore
+        self.assertIsNot(columns, old_columns)
+        self.assertLessEqual(columns.dead_rows, columns.live_rows)
+        self.assertEqual(set(store), set(expected))
+        for nickname, entry in expected.items():
+            addr = await self.mem_db.read_address(nickname)
+            self.assertEqual(addr.to_api_dm(), entry.to_api_dm())
+
+
 class FilesystemAddressBookDBTest(
     AbstractAddressBookDBTestCase,
     asynctest.TestCase
 ):
+    io = 'threads'
+    shards = 0
+
     def make_addr_db(self) -> AbstractAddressBookDB:
         self.tmp_dir = tempfile.TemporaryDirectory(prefix='addrbook-fsdb')
         self.store_dir = self.tmp_dir.name
-        self.fs_db = FilesystemAddressBookDB(self.store_dir)
+        self.fs_db = FilesystemAddressBookDB(
+            self.store_dir, io=self.io, shards=self.shards
+        )
         return self.fs_db
 
     def addr_count(self) -> int:
         return len([
-            name for name in os.listdir(self.store_dir)
-            if os.path.isfile(os.path.join(self.store_dir, name))
+            name
+            for _, _, names in os.walk(self.store_dir)
+            for name in names if name.endswith('.json')
         ])
-        return len(self.addr_db.db)
 
     def tearDown(self):
+        self.fs_db.stop()
         self.tmp_dir.cleanup()
         super().tearDown()
 
@@ -156,6 +983,1076 @@ class FilesystemAddressBookDBTest(
             with self.assertRaises(ValueError):
                 FilesystemAddressBookDB(tmpfilename)
 
+    async def test_file_io_batches(self):
+        addr = self.address_data['namo']
+        nicknames = ['nick-{}'.format(i) for i in range(5)]
+        for nickname in nicknames:
+            await self.fs_db.create_address(addr, nickname)
+        with open(os.path.join(self.store_dir, 'notes.txt'), 'w') as f:
+            f.write('not an entry')
+
+        with unittest.mock.patch.object(file_io, 'FILE_READ_BATCH', 2):
+            batches = [
+                sorted(file_name for file_name, _ in batch)
+                async for batch in self.fs_db.io.read_dir(
+                    self.store_dir, '.json'
+                )
+            ]
+            page = await self.fs_db.read_addresses_page(10)
+
+        files = sorted(nickname + '.json' for nickname in nicknames)
+        self.assertEqual(sorted(sum(batches, [])), files)
+        if self.io == 'threads':
+            # Each batch is one call in the pool, which also lists the
+            # directory
+            self.assertTrue(all(len(batch) <= 2 for batch in batches))
+        self.assertEqual([nickname for nickname, _ in page], nicknames)
+
+        self.fs_db.stop()
+        if self.io == 'threads':
+            with self.assertRaises(RuntimeError):
+                await self.fs_db.read_address('nick-0')
+        self.fs_db.start()
+        value = await self.fs_db.read_address('nick-0')
+        self.assertEqual(value.to_api_dm(), addr.to_api_dm())
+
+    async def test_parallel_scan(self):
+        addr = self.address_data['namo']
+        for i in range(9):
+            await self.fs_db.create_address(addr, 'nick-{}'.format(i))
+        with os.scandir(self.store_dir) as entries:
+            listing = [
+                entry.name for entry in entries if entry.name.endswith('.json')
+            ]
+
+        # Reads of batches, by the name of their first file, wait until
+        # their gate is opened
+        in_flight = 0
+        max_in_flight = 0
+        gates: Dict[str, asyncio.Event] = {}
+        started: asyncio.Queue = asyncio.Queue()
+        read_many = self.fs_db.io.read_many
+
+        async def gated_read_many(paths):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            try:
+                name = os.path.basename(paths[0])
+                gate = gates.setdefault(name, asyncio.Event())
+                started.put_nowait(name)
+                await gate.wait()
+                return await read_many(paths)
+            finally:
+                in_flight -= 1
+
+        async def scan(ordered):
+            return [
+                file_name
+                async for batch in self.fs_db.io.read_dir(
+                    self.store_dir, '.json', concurrency=3, ordered=ordered
+                )
+                for file_name, _ in batch
+            ]
+
+        with unittest.mock.patch.object(file_io, 'FILE_READ_BATCH', 2), \
+                unittest.mock.patch.object(
+                    self.fs_db.io, 'read_many', gated_read_many
+                ):
+            for ordered in (True, False):
+                gates.clear()
+                max_in_flight = 0
+                scanning = asyncio.ensure_future(scan(ordered))
+                self.assertEqual(
+                    [await started.get() for _ in range(3)],
+                    listing[0:6:2]
+                )
+
+                # The second batch is read first
+                gates[listing[2]].set()
+                if not ordered:
+                    # Yielded, so that the fourth batch is read
+                    self.assertEqual(await started.get(), listing[6])
+                for name in listing[0::2]:
+                    gates.setdefault(name, asyncio.Event()).set()
+                names = await scanning
+
+                self.assertEqual(max_in_flight, 3)
+                if ordered:
+                    self.assertEqual(names, listing)
+                else:
+                    self.assertEqual(sorted(names), sorted(listing))
+                    self.assertEqual(names[:2], listing[2:4])
+                while not started.empty():
+                    started.get_nowait()
+
+    async def test_concurrent_create(self):
+        # Only the first of concurrent creates of a nickname succeeds
+        namo = self.address_data['namo']
+        raga = self.address_data['raga']
+        results = await asyncio.gather(
+            self.fs_db.create_address(namo, 'x'),
+            self.fs_db.create_address(raga, 'x'),
+            self.fs_db.write_addresses([
+                AddressWrite(WRITE_CREATE, 'x', raga)
+            ]),
+            return_exceptions=True
+        )
+        self.assertEqual(results[0], 'x')
+        self.assertIsInstance(results[1], KeyError)
+        self.assertIsInstance(results[2][0], KeyError)
+        value = await self.fs_db.read_address('x')
+        self.assertEqual(value.to_api_dm(), namo.to_api_dm())
+        self.assertEqual(len(self.fs_db._write_locks), 0)
+
+    async def test_read_addresses_page_shared(self):
+        # Another process writing to the same store
+        other = FilesystemAddressBookDB(self.store_dir, shards=self.shards)
+        addr = self.address_data['namo']
+        for nickname in ('nick-a', 'nick-b', 'nick-c'):
+            await self.fs_db.create_address(addr, nickname)
+
+        async def page_nicknames(limit):
+            page = await self.fs_db.read_addresses_page(limit)
+            return [nickname for nickname, _ in page]
+
+        await other.create_address(addr, 'nick-d')
+        await other.delete_address('nick-a')
+        self.assertEqual(
+            await page_nicknames(10), ['nick-b', 'nick-c', 'nick-d']
+        )
+
+        # Deleted, with the directory mtime as when it was last listed
+        os.utime(self.store_dir, ns=(0, 0))
+        self.assertEqual(await page_nicknames(1), ['nick-b'])
+        await other.delete_address('nick-b')
+        os.utime(self.store_dir, ns=(0, 0))
+        self.assertEqual(await page_nicknames(2), ['nick-c', 'nick-d'])
+        other.stop()
+
+    async def test_read_addresses_version_other_process(self):
+        # Processes sharing the store agree on its version, and see the
+        # writes of each other, also those within a timestamp tick
+        other = FilesystemAddressBookDB(self.store_dir, shards=self.shards)
+        addr = self.address_data['namo']
+        await self.fs_db.create_address(addr, 'namo')
+        version = await self.fs_db.read_addresses_version()
+        self.assertEqual(await other.read_addresses_version(), version)
+
+        mtime = os.stat(self.store_dir).st_mtime_ns
+        await other.update_address('namo', addr)
+        os.utime(self.store_dir, ns=(mtime, mtime))
+        self.assertNotEqual(
+            await self.fs_db.read_addresses_version(), version
+        )
+
+        # Not modified lately, the mtime of the directory is trusted
+        os.utime(self.store_dir, ns=(0, 0))
+        version = await self.fs_db.read_addresses_version()
+        self.assertEqual(await other.read_addresses_version(), version)
+        await other.delete_address('namo')
+        self.assertNotEqual(
+            await self.fs_db.read_addresses_version(), version
+        )
+        other.stop()
+
+    async def test_find_nicknames_deleted_while_indexing(self):
+        addr = self.address_data['namo']
+        await self.fs_db.create_address(addr, 'namo')
+        await self.fs_db.create_address(addr, 'namo-2')
+
+        files_read = asyncio.Event()
+        deleted = asyncio.Event()
+        read_many = self.fs_db.io.read_many
+
+        async def gated_read_many(paths):
+            contents = await read_many(paths)
+            files_read.set()
+            await deleted.wait()
+            return contents
+
+        with unittest.mock.patch.object(
+            self.fs_db.io, 'read_many', gated_read_many
+        ):
+            find = asyncio.ensure_future(
+                self.addr_db.find_nicknames({'city': 'New Delhi'})
+            )
+            await files_read.wait()
+            await self.addr_db.delete_address('namo')
+            deleted.set()
+            self.assertEqual(await find, ['namo-2'])
+
+    async def test_find_nicknames_shared(self):
+        # Another process writing to the same store
+        other = FilesystemAddressBookDB(self.store_dir, shards=self.shards)
+        addr = self.address_data['namo']
+        criteria = {'city': 'New Delhi'}
+        await self.fs_db.create_address(addr, 'one')
+        self.assertEqual(await self.fs_db.find_nicknames(criteria), ['one'])
+
+        await other.create_address(addr, 'two')
+        self.assertEqual(
+            await self.fs_db.find_nicknames(criteria), ['one', 'two']
+        )
+
+        # Not modified lately, the index is kept until the directory is
+        os.utime(self.store_dir, ns=(0, 0))
+        self.assertEqual(
+            await self.fs_db.find_nicknames(criteria), ['one', 'two']
+        )
+        index = self.fs_db._secondary
+        self.assertEqual(
+            await self.fs_db.find_nicknames(criteria), ['one', 'two']
+        )
+        self.assertIs(self.fs_db._secondary, index)
+        await other.delete_address('one')
+        self.assertEqual(await self.fs_db.find_nicknames(criteria), ['two'])
+        other.stop()
+
+
+class AiofilesFilesystemAddressBookDBTest(FilesystemAddressBookDBTest):
+    io = 'aiofiles'
+
+
+class ShardedFilesystemAddressBookDBTest(FilesystemAddressBookDBTest):
+    shards = 16
+
+    @unittest.skip('entry files are not in the store directory')
+    async def test_file_io_batches(self):
+        pass
+
+    @unittest.skip('entry files are not in the store directory')
+    async def test_parallel_scan(self):
+        pass
+
+    async def test_shards(self):
+        addr = self.address_data['namo']
+        for i in range(100):
+            await self.fs_db.create_address(addr, 'nick-{}'.format(i))
+
+        shard_dirs = fs_layout.entry_dirs(self.store_dir, 16)
+        self.assertEqual(
+            sorted(os.listdir(self.store_dir)),
+            sorted([fs_layout.LAYOUT_FILE_NAME] + [
+                os.path.basename(path) for path in shard_dirs
+            ])
+        )
+        counts = [len(os.listdir(path)) for path in shard_dirs]
+        self.assertEqual(sum(counts), 100)
+        self.assertTrue(all(count < 20 for count in counts))
+        self.assertTrue(os.path.isfile(os.path.join(
+            shard_dirs[fs_layout.shard_of('nick-0', 16)], 'nick-0.json'
+        )))
+
+    async def test_read_addresses_version_shared(self):
+        # Writes to a shard directory also modify the store directory, which
+        # is how other processes see them
+        addr = self.address_data['namo']
+        await self.fs_db.create_address(addr, 'namo')
+        for write in (
+            lambda: self.fs_db.update_address('namo', addr),
+            lambda: self.fs_db.delete_address('namo'),
+        ):
+            os.utime(self.store_dir, ns=(0, 0))
+            await write()
+            self.assertNotEqual(os.stat(self.store_dir).st_mtime_ns, 0)
+
+
+class FilesystemLayoutTest(asynctest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory(prefix='addrbook-fsdb')
+        self.store_dir = self.tmp_dir.name
+        self.addr = AddressEntry.from_api_dm(
+            address_data_suite()['namo']
+        )
+        self.nicknames = ['nick-{}'.format(i) for i in range(50)]
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    async def assert_entries(self, shards: int) -> None:
+        db = FilesystemAddressBookDB(self.store_dir, shards=shards)
+        try:
+            self.assertEqual(list(db.nicknames), sorted(self.nicknames))
+            for nickname in self.nicknames:
+                value = await db.read_address(nickname)
+                self.assertEqual(value.to_api_dm(), self.addr.to_api_dm())
+        finally:
+            db.stop()
+
+    async def test_migrate(self):
+        db = FilesystemAddressBookDB(self.store_dir)
+        for nickname in self.nicknames:
+            await db.create_address(self.addr, nickname)
+        db.stop()
+        with self.assertRaises(ValueError):
+            FilesystemAddressBookDB(self.store_dir, shards=16)
+
+        self.assertEqual(fs_layout.migrate(self.store_dir, 16), 50)
+        await self.assert_entries(16)
+        with self.assertRaises(ValueError):
+            FilesystemAddressBookDB(self.store_dir)
+
+        # Files whose shard directory has the same name stay, and the
+        # other shard directories of the old layout are removed
+        moved = [
+            nickname for nickname in self.nicknames
+            if fs_layout.shard_of(nickname, 16) !=
+            fs_layout.shard_of(nickname, 4)
+        ]
+        self.assertEqual(fs_layout.migrate(self.store_dir, 4), len(moved))
+        self.assertEqual(len(os.listdir(self.store_dir)), 5)
+        await self.assert_entries(4)
+
+        fs_layout.migrate(self.store_dir, 0)
+        self.assertEqual(len(os.listdir(self.store_dir)), 50)
+        await self.assert_entries(0)
+
+    async def test_migrate_other_dirs(self):
+        # Directories that are not shards of the old layout stay as they are
+        # even with hex names
+        db = FilesystemAddressBookDB(self.store_dir)
+        for nickname in self.nicknames:
+            await db.create_address(self.addr, nickname)
+        db.stop()
+        others = ['cafe', '00']
+        for name in others:
+            os.mkdir(os.path.join(self.store_dir, name))
+            with open(os.path.join(self.store_dir, name, 'x.json'), 'w'):
+                pass
+        empty = os.path.join(self.store_dir, 'beef')
+        os.mkdir(empty)
+
+        for shards in (16, 4, 0):
+            fs_layout.migrate(self.store_dir, shards)
+            await self.assert_entries(shards)
+            self.assertTrue(os.path.isdir(empty))
+            for name in others:
+                self.assertEqual(
+                    os.listdir(os.path.join(self.store_dir, name)),
+                    ['x.json']
+                )
+
+    def interrupted_migrate(self, shards: int) -> None:
+        # Fails after a few entry files were moved
+        replace = os.replace
+        moved: List[str] = []
+
+        def failing_replace(src, dst):
+            if dst.endswith('.json'):
+                if len(moved) == 10:
+                    raise OSError()
+                moved.append(dst)
+            replace(src, dst)
+
+        with unittest.mock.patch.object(
+            fs_layout.os, 'replace', failing_replace
+        ):
+            with self.assertRaises(OSError):
+                fs_layout.migrate(self.store_dir, shards)
+
+    async def test_interrupted_migration(self):
+        db = FilesystemAddressBookDB(self.store_dir)
+        for nickname in self.nicknames:
+            await db.create_address(self.addr, nickname)
+        db.stop()
+
+        self.interrupted_migrate(16)
+        with self.assertRaises(ValueError):
+            FilesystemAddressBookDB(self.store_dir, shards=16)
+
+        fs_layout.migrate(self.store_dir, 16)
+        await self.assert_entries(16)
+
+        # Run again with another number of shards
+        self.interrupted_migrate(4)
+        fs_layout.migrate(self.store_dir, 2)
+        await self.assert_entries(2)
+        self.assertEqual(
+            sorted(os.listdir(self.store_dir)),
+            ['0', '1', fs_layout.LAYOUT_FILE_NAME]
+        )
+
+    async def test_migrate_open_store(self):
+        db = FilesystemAddressBookDB(self.store_dir, durability='batch')
+        db.start()
+        try:
+            with self.assertRaises(RuntimeError):
+                fs_layout.migrate(self.store_dir, 16)
+        finally:
+            db.stop()
+
+
+class FilesystemWALAddressBookDBTest(FilesystemAddressBookDBTest):
+    durability = 'batch'
+
+    def make_addr_db(self) -> AbstractAddressBookDB:
+        super().make_addr_db()
+        self.fs_db = FilesystemAddressBookDB(
+            self.store_dir, durability=self.durability
+        )
+        self.fs_db.start()
+        return self.fs_db
+
+    def tearDown(self):
+        self.fs_db.stop()
+        super().tearDown()
+
+    def reopen(self) -> FilesystemAddressBookDB:
+        self.fs_db = FilesystemAddressBookDB(
+            self.store_dir, durability=self.durability
+        )
+        self.fs_db.start()
+        return self.fs_db
+
+    @unittest.skip('only one process may open a store with a log')
+    async def test_read_addresses_page_shared(self):
+        pass
+
+    @unittest.skip('only one process may open a store with a log')
+    async def test_read_addresses_version_other_process(self):
+        pass
+
+    @unittest.skip('only one process may open a store with a log')
+    async def test_find_nicknames_shared(self):
+        pass
+
+    async def test_replay(self):
+        namo = self.address_data['namo']
+        raga = self.address_data['raga']
+        await self.fs_db.create_address(namo, 'namo')
+        await self.fs_db.create_address(raga, 'raga')
+
+        # Another process can not open the store while the log is open
+        with self.assertRaises(RuntimeError):
+            FilesystemAddressBookDB(
+                self.store_dir, durability=self.durability
+            ).start()
+
+        # Crash after logging a write, before applying it, and in the
+        # middle of logging another
+        wal = self.fs_db.wal
+        wal.append(OP_PUT, 'namo', json.dumps(raga.to_api_dm()).encode())
+        with open(wal.path, mode='ab') as f:
+            f.write(b'torn record')
+        wal.close()
+
+        self.reopen()
+        value = await self.fs_db.read_address('namo')
+        self.assertEqual(value.to_api_dm(), raga.to_api_dm())
+        self.assertEqual(self.addr_count(), 2)
+        self.assertEqual(self.fs_db.wal.size, 0)
+
+    async def test_group_commit(self):
+        addrs = list(self.address_data.values())
+        wal = self.fs_db.wal
+        syncs = wal.syncs
+        await asyncio.gather(*(
+            self.fs_db.create_address(addrs[i % 2], 'nick-{}'.format(i))
+            for i in range(10)
+        ))
+        self.assertEqual(self.addr_count(), 10)
+        self.assertLessEqual(wal.syncs - syncs, 2)
+
+        # A batch is synced once
+        syncs = wal.syncs
+        results = await self.fs_db.write_addresses([
+            AddressWrite(WRITE_UPDATE, 'nick-{}'.format(i), addrs[0])
+            for i in range(10)
+        ])
+        self.assertEqual(results, [None] * 10)
+        self.assertEqual(wal.syncs - syncs, 1)
+
+    async def test_checkpoint(self):
+        addr = self.address_data['namo']
+        threads = []
+        truncate_file = wal_log.truncate_file
+
+        def recorded_truncate_file(fd):
+            threads.append(threading.get_ident())
+            truncate_file(fd)
+
+        with unittest.mock.patch.object(
+            addressbook_db, 'WAL_CHECKPOINT_BYTES', 1
+        ), unittest.mock.patch.object(
+            wal_log, 'truncate_file', recorded_truncate_file
+        ):
+            await self.fs_db.create_address(addr, 'nick-0')
+            # Writes wait for the checkpoint, which empties the log off the
+            # event loop
+            await self.fs_db.create_address(addr, 'nick-1')
+        self.assertTrue(threads)
+        self.assertNotIn(threading.get_ident(), threads)
+        self.assertEqual(
+            self.fs_db.wal.size,
+            RECORD_PREFIX_SIZE + len('nick-1') +
+            os.path.getsize(os.path.join(self.store_dir, 'nick-1.json'))
+        )
+        self.assertEqual(self.addr_count(), 2)
+
+    async def test_apply_off_loop(self):
+        namo = self.address_data['namo']
+        raga = self.address_data['raga']
+        threads = set()
+        replace_file = addressbook_db.replace_file
+
+        def recorded_replace_file(path, data):
+            threads.add(threading.get_ident())
+            replace_file(path, data)
+
+        with unittest.mock.patch.object(
+            addressbook_db, 'replace_file', recorded_replace_file
+        ):
+            await asyncio.gather(
+                self.fs_db.create_address(namo, 'nick-0'),
+                self.fs_db.write_addresses([
+                    AddressWrite(WRITE_CREATE, 'nick-1', namo),
+                    AddressWrite(WRITE_UPDATE, 'nick-1', raga),
+                ]),
+                self.fs_db.create_address(namo, 'nick-2'),
+            )
+            await self.fs_db.update_address('nick-0', raga)
+            await self.fs_db.delete_address('nick-2')
+
+        # Files are written by the file I/O threads, in log order
+        self.assertTrue(threads)
+        self.assertNotIn(threading.get_ident(), threads)
+        self.assertEqual(self.addr_count(), 2)
+        for nickname in ('nick-0', 'nick-1'):
+            value = await self.fs_db.read_address(nickname)
+            self.assertEqual(value.to_api_dm(), raga.to_api_dm())
+
+
+class FilesystemWriteWALAddressBookDBTest(FilesystemWALAddressBookDBTest):
+    durability = 'write'
+
+    async def test_group_commit(self):
+        addr = self.address_data['namo']
+        wal = self.fs_db.wal
+        syncs = wal.syncs
+        await asyncio.gather(*(
+            self.fs_db.create_address(addr, 'nick-{}'.format(i))
+            for i in range(10)
+        ))
+        self.assertEqual(wal.syncs - syncs, 10)
+
+
+class SegmentAddressBookDBTest(
+    AbstractAddressBookDBTestCase,
+    asynctest.TestCase
+):
+    read_mode = 'pread'
+
+    def make_addr_db(self) -> AbstractAddressBookDB:
+        self.tmp_dir = tempfile.TemporaryDirectory(prefix='addrbook-segdb')
+        self.seg_path = os.path.join(self.tmp_dir.name, 'addresses.seg')
+        self.seg_db = SegmentAddressBookDB(
+            self.seg_path, read_mode=self.read_mode
+        )
+        self.seg_db.start()
+        return self.seg_db
+
+    def addr_count(self) -> int:
+        return len(self.seg_db.nicknames)
+
+    def tearDown(self):
+        self.seg_db.stop()
+        self.tmp_dir.cleanup()
+        super().tearDown()
+
+    def reopen(self) -> SegmentAddressBookDB:
+        self.seg_db.stop()
+        self.seg_db = SegmentAddressBookDB(
+            self.seg_path, read_mode=self.read_mode
+        )
+        self.seg_db.start()
+        return self.seg_db
+
+    async def test_write_addresses_replay(self):
+        addrs = list(self.address_data.values())
+        await self.seg_db.create_address(addrs[0], 'nick-a')
+        size = self.seg_db.size
+        await self.seg_db.write_addresses([
+            AddressWrite(WRITE_CREATE, 'nick-b', addrs[0]),
+            AddressWrite(WRITE_UPDATE, 'nick-a', addrs[1]),
+            AddressWrite(WRITE_DELETE, 'nick-b'),
+        ])
+        self.assertGreater(self.seg_db.size, size)
+
+        db = self.reopen()
+        self.assertEqual(list(db.nicknames), ['nick-a'])
+        addr = await db.read_address('nick-a')
+        self.assertEqual(addr.to_api_dm(), addrs[1].to_api_dm())
+
+    async def test_group_append(self):
+        addrs = list(self.address_data.values())
+        appends = self.seg_db.appends
+        await asyncio.gather(*(
+            self.seg_db.create_address(addrs[i % 2], 'nick-{}'.format(i))
+            for i in range(10)
+        ))
+        self.assertEqual(self.addr_count(), 10)
+        self.assertLessEqual(self.seg_db.appends - appends, 2)
+
+        # Writes queued for an append are seen by the next ones
+        results = await asyncio.gather(
+            self.seg_db.create_address(addrs[0], 'nick-new'),
+            self.seg_db.create_address(addrs[1], 'nick-new'),
+            self.seg_db.delete_address('nick-0'),
+            self.seg_db.delete_address('nick-0'),
+            return_exceptions=True
+        )
+        self.assertEqual(results[0], 'nick-new')
+        self.assertIsInstance(results[1], KeyError)
+        self.assertIsNone(results[2])
+        self.assertIsInstance(results[3], KeyError)
+        value = await self.seg_db.read_address('nick-new')
+        self.assertEqual(value.to_api_dm(), addrs[0].to_api_dm())
+
+    async def test_replay(self):
+        nickname, addr = list(self.address_data.items())[0]
+        await self.seg_db.create_address(addr, nickname)
+        await self.seg_db.create_address(addr, 'deleted')
+        await self.seg_db.delete_address('deleted')
+        size = self.seg_db.size
+
+        # A torn record at the tail is dropped on replay
+        with open(self.seg_path, 'ab') as f:
+            f.write(b'\x01\x02\x03 torn write')
+
+        db = self.reopen()
+        self.assertEqual(db.size, size)
+        self.assertEqual(os.path.getsize(self.seg_path), size)
+        self.assertEqual(list(db.nicknames), [nickname])
+        value = await db.read_address(nickname)
+        self.assertEqual(value.to_api_dm(), addr.to_api_dm())
+        with self.assertRaises(KeyError):
+            await db.read_address('deleted')
+
+    async def test_compaction(self):
+        addrs = list(self.address_data.values())
+        for i in range(20):
+            await self.seg_db.create_address(addrs[0], 'nick-{}'.format(i))
+        for i in range(10):
+            await self.seg_db.update_address('nick-{}'.format(i), addrs[1])
+        for i in range(15, 20):
+            await self.seg_db.delete_address('nick-{}'.format(i))
+        garbage_bytes = self.seg_db.garbage_bytes
+        self.assertGreater(garbage_bytes, 0)
+
+        # Writes that land while compaction runs are carried over
+        self.seg_db.compaction_batch = 1
+        compaction = asyncio.ensure_future(self.seg_db.compact())
+        await asyncio.sleep(0)
+        await self.seg_db.update_address('nick-10', addrs[1])
+        await self.seg_db.delete_address('nick-14')
+        await self.seg_db.create_address(addrs[1], 'nick-new')
+        await compaction
+
+        expected = {'nick-{}'.format(i): addrs[1] for i in range(11)}
+        expected.update({'nick-{}'.format(i): addrs[0] for i in (11, 12, 13)})
+        expected['nick-new'] = addrs[1]
+
+        for reopen in [False, True]:
+            db = self.reopen() if reopen else self.seg_db
+            self.assertLess(db.garbage_bytes, garbage_bytes)
+            self.assertEqual(db.size, os.path.getsize(self.seg_path))
+            all_addrs = {
+                nickname: addr.to_api_dm()
+                async for nickname, addr in db.read_all_addresses()
+            }
+            self.assertEqual(
+                all_addrs,
+                {k: v.to_api_dm() for k, v in expected.items()}
+            )
+
+    async def test_compaction_during_scan(self):
+        addr = self.address_data['namo']
+        for i in range(20):
+            await self.seg_db.create_address(addr, 'nick-{}'.format(i))
+        for i in range(10):
+            await self.seg_db.delete_address('nick-{}'.format(i))
+
+        # Compaction does not wait for the scan, which keeps reading the
+        # segment it began on
+        with unittest.mock.patch.object(segment_db, 'SCAN_CHUNK_SIZE', 1):
+            scan = self.seg_db.read_all_addresses_raw()
+            scanned = [(await scan.__anext__())[0]]
+            await asyncio.wait_for(self.seg_db.compact(), 5)
+            self.assertEqual(self.seg_db.garbage_bytes, 0)
+            scanned.extend([nickname async for nickname, _ in scan])
+
+        self.assertEqual(
+            sorted(scanned), sorted('nick-{}'.format(i) for i in range(10, 20))
+        )
+        value = await self.seg_db.read_address('nick-10')
+        self.assertEqual(value.to_api_dm(), addr.to_api_dm())
+
+
+class MmapSegmentAddressBookDBTest(SegmentAddressBookDBTest):
+    read_mode = 'mmap'
+
+    async def test_read_after_append(self):
+        # Reads past the end of the current mapping extend it
+        addrs = list(self.address_data.values())
+        for i, addr in enumerate(addrs * 5):
+            await self.seg_db.create_address(addr, 'nick-{}'.format(i))
+            value = await self.seg_db.read_address('nick-{}'.format(i))
+            self.assertEqual(value.to_api_dm(), addr.to_api_dm())
+
+        with self.assertRaises(ValueError):
+            SegmentAddressBookDB(self.seg_path, read_mode='mmmap')
+
+
+class SqliteAddressBookDBTest(
+    AbstractAddressBookDBTestCase,
+    asynctest.TestCase
+):
+    def make_addr_db(self) -> AbstractAddressBookDB:
+        self.tmp_dir = tempfile.TemporaryDirectory(prefix='addrbook-sqlite')
+        self.db_path = os.path.join(self.tmp_dir.name, 'addresses.sqlite')
+        self.sqlite_db = SqliteAddressBookDB(self.db_path, readers=2)
+        self.sqlite_db.start()
+        return self.sqlite_db
+
+    def addr_count(self) -> int:
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return conn.execute('SELECT COUNT(*) FROM addresses').fetchone()[0]
+        finally:
+            conn.close()
+
+    def tearDown(self):
+        self.sqlite_db.stop()
+        self.tmp_dir.cleanup()
+        super().tearDown()
+
+    async def test_shared_db(self):
+        # Another instance, as in another process, sees the same entries,
+        # versions and indexes
+        other = SqliteAddressBookDB(self.db_path)
+        other.start()
+        try:
+            namo = self.address_data['namo']
+            raga = self.address_data['raga']
+            await self.sqlite_db.create_address(namo, 'namo')
+            self.assertEqual(
+                await other.read_addresses_version(),
+                await self.sqlite_db.read_addresses_version()
+            )
+            await other.update_address('namo', raga)
+            self.assertEqual(
+                (await self.sqlite_db.read_address('namo')).to_api_dm(),
+                raga.to_api_dm()
+            )
+            self.assertEqual(
+                await self.sqlite_db.read_address_version('namo'),
+                await other.read_address_version('namo')
+            )
+            self.assertEqual(
+                await self.sqlite_db.find_nicknames({'city': 'Varanasi'}),
+                []
+            )
+        finally:
+            other.stop()
+
+        # Entries and versions survive a restart
+        version = await self.sqlite_db.read_address_version('namo')
+        self.sqlite_db.stop()
+        self.sqlite_db = SqliteAddressBookDB(self.db_path)
+        self.sqlite_db.start()
+        self.assertEqual(
+            await self.sqlite_db.read_address_version('namo'), version
+        )
+
+        with self.assertRaises(RuntimeError):
+            await other.read_address('namo')
+
+    async def test_scan_cancelled(self):
+        # The connection of a scan cancelled while the reader thread reads
+        # a page is closed once the read is done
+        await self.sqlite_db.create_address(self.address_data['namo'], 'namo')
+        connections = len(self.sqlite_db._connections)
+        reading = threading.Event()
+        release = threading.Event()
+        read_page_raw = SqliteAddressBookDB._read_page_raw
+
+        def blocked_read_page_raw(conn, limit, after):
+            reading.set()
+            release.wait(5)
+            return read_page_raw(conn, limit, after)
+
+        async def scan():
+            return [
+                nickname async for nickname, _ in
+                self.sqlite_db.read_all_addresses_raw()
+            ]
+
+        with unittest.mock.patch.object(
+            SqliteAddressBookDB, '_read_page_raw',
+            staticmethod(blocked_read_page_raw)
+        ):
+            task = asyncio.ensure_future(scan())
+            await self.loop.run_in_executor(None, reading.wait, 5)
+            task.cancel()
+            for _ in range(3):
+                await asyncio.sleep(0)
+            self.assertFalse(task.done())
+            self.assertEqual(
+                len(self.sqlite_db._connections), connections + 1
+            )
+
+            release.set()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        self.assertEqual(len(self.sqlite_db._connections), connections)
+
+
+class CachedInMemoryAddressBookDBTest(
+    AbstractAddressBookDBTestCase,
+    asynctest.TestCase
+):
+    def make_addr_db(self) -> AbstractAddressBookDB:
+        self.mem_db = InMemoryAddressBookDB()
+        self.cached_db = CachedAddressBookDB(self.mem_db, max_size=2)
+        return self.cached_db
+
+    def addr_count(self) -> int:
+        return len(self.mem_db.db)
+
+    async def test_cache(self):
+        nickname, addr = list(self.address_data.items())[0]
+        for i in range(3):
+            await self.cached_db.create_address(addr, 'nick-{}'.format(i))
+
+        await self.cached_db.read_address('nick-0')
+        await self.cached_db.read_address('nick-0')
+        self.assertEqual((self.cached_db.hits, self.cached_db.misses), (1, 1))
+
+        # Raw reads of cached entries are hits too
+        self.assertEqual(
+            await self.cached_db.read_address_raw('nick-0'),
+            encode_entry(addr)
+        )
+        self.assertEqual((self.cached_db.hits, self.cached_db.misses), (2, 1))
+
+        # Least recently used entry is evicted
+        await self.cached_db.read_address('nick-1')
+        await self.cached_db.read_address('nick-0')
+        await self.cached_db.read_address('nick-2')
+        self.assertEqual(len(self.cached_db), 2)
+        await self.cached_db.read_address('nick-1')
+        self.assertEqual((self.cached_db.hits, self.cached_db.misses), (3, 4))
+
+        # Update and delete invalidate
+        other = list(self.address_data.values())[1]
+        await self.cached_db.update_address('nick-1', other)
+        value = await self.cached_db.read_address('nick-1')
+        self.assertIs(value, other)
+        await self.cached_db.delete_address('nick-1')
+        with self.assertRaises(KeyError):
+            await self.cached_db.read_address('nick-1')
+
+        # Expired entries are read again
+        self.cached_db.ttl = 0.01
+        await self.cached_db.read_address('nick-0')
+        misses = self.cached_db.misses
+        await asyncio.sleep(0.02)
+        await self.cached_db.read_address('nick-0')
+        self.assertEqual(self.cached_db.misses, misses + 1)
+
+
+class CachedFilesystemAddressBookDBTest(FilesystemAddressBookDBTest):
+    def make_addr_db(self) -> AbstractAddressBookDB:
+        return CachedAddressBookDB(super().make_addr_db())
+
+
+class TieredInMemoryAddressBookDBTest(
+    AbstractAddressBookDBTestCase,
+    asynctest.TestCase
+):
+    def make_addr_db(self) -> AbstractAddressBookDB:
+        self.mem_db = InMemoryAddressBookDB()
+        self.tiered_db = TieredAddressBookDB(self.mem_db, max_bytes=65536)
+        return self.tiered_db
+
+    def addr_count(self) -> int:
+        return len(self.mem_db.db)
+
+    def test_frequency_sketch(self):
+        sketch = FrequencySketch(16)
+        for _ in range(3):
+            sketch.add('namo')
+        self.assertGreaterEqual(sketch.estimate('namo'), 3)
+        for _ in range(20):
+            sketch.add('raga')
+        self.assertEqual(sketch.estimate('raga'), FrequencySketch.MAX_COUNT)
+
+        # Counters are halved once 10 additions per counter were made
+        for i in range(160 - 23):
+            sketch.add('nick-{}'.format(i))
+        self.assertLessEqual(
+            sketch.estimate('raga'), FrequencySketch.MAX_COUNT // 2
+        )
+
+    @unittest.mock.patch.object(tiered_db, 'SKETCH_ENTRY_BYTES', 1)
+    def test_admission(self):
+        # A candidate that needs two entries evicted is compared with both
+        # before either is evicted
+        namo = self.address_data['namo']
+        raga = self.address_data['raga']
+        db = TieredAddressBookDB(self.mem_db, max_bytes=65536)
+        db._main_bytes = 2 * entry_size(raga)
+        for nickname, reads in (('cold', 1), ('hot', 5)):
+            for _ in range(reads):
+                db._sketch.add(nickname)
+            db._admit_main(nickname, raga, entry_size(raga))
+
+        for _ in range(3):
+            db._sketch.add('namo')
+        db._admit_main('namo', namo, entry_size(namo))
+        self.assertEqual(sorted(db._segments), ['cold', 'hot'])
+
+        for _ in range(3):
+            db._sketch.add('namo')
+        db._admit_main('namo', namo, entry_size(namo))
+        self.assertEqual(sorted(db._segments), ['namo'])
+
+    # A wide sketch, so that the estimates of these few keys are exact
+    @unittest.mock.patch.object(tiered_db, 'SKETCH_ENTRY_BYTES', 1)
+    async def test_tiered(self):
+        addr = list(self.address_data.values())[0]
+        size = entry_size(addr)
+        max_bytes = 10 * size
+        db = TieredAddressBookDB(self.mem_db, max_bytes=max_bytes)
+        nicknames = ['nick-{}'.format(i) for i in range(100)]
+        for nickname in nicknames:
+            await db.create_address(addr, nickname)
+
+        # The main space holds 9 entries, 7 of them protected
+        hot = nicknames[:5]
+        for _ in range(3):
+            for nickname in hot:
+                self.assertEqual(
+                    (await db.read_address(nickname)).to_api_dm(),
+                    addr.to_api_dm()
+                )
+        self.assertEqual((db.hits, db.misses), (10, 5))
+
+        # Raw reads of entries in memory are hits too
+        self.assertEqual(await db.read_address_raw(hot[0]), encode_entry(addr))
+        self.assertEqual((db.hits, db.misses), (11, 5))
+
+        # Entries read once do not evict the hot ones, nor each other
+        for nickname in nicknames[10:]:
+            await db.read_address(nickname)
+        self.assertEqual(len(db), 9)
+        self.assertLessEqual(db.size, max_bytes)
+
+        # An entry read more often than the probation's LRU one replaces it
+        await db.read_address(nicknames[99])
+        kept = hot + nicknames[11:14] + nicknames[99:]
+        hits = db.hits
+        for nickname in kept:
+            await db.read_address(nickname)
+        self.assertEqual(db.hits, hits + len(kept))
+        self.assertEqual(len(db), 9)
+
+        # Update and delete drop entries from memory
+        other = list(self.address_data.values())[1]
+        await db.update_address(hot[0], other)
+        value = await db.read_address(hot[0])
+        self.assertEqual(value.to_api_dm(), other.to_api_dm())
+        await db.delete_address(hot[1])
+        with self.assertRaises(KeyError):
+            await db.read_address(hot[1])
+        self.assertLessEqual(db.size, max_bytes)
+
+        # Entries larger than the budget are never kept
+        db = TieredAddressBookDB(self.mem_db, max_bytes=size // 2)
+        await db.read_address(hot[2])
+        await db.read_address(hot[2])
+        self.assertEqual((len(db), db.size, db.hits), (0, 0, 0))
+
+        with self.assertRaises(ValueError):
+            TieredAddressBookDB(self.mem_db, max_bytes=0)
+
+
+class TieredFilesystemAddressBookDBTest(FilesystemAddressBookDBTest):
+    def make_addr_db(self) -> AbstractAddressBookDB:
+        return TieredAddressBookDB(super().make_addr_db())
+
+    async def test_decoded(self):
+        # Entries are kept as stored until admitted to the main space, even
+        # those read raw
+        nickname, addr = list(self.address_data.items())[0]
+        await self.addr_db.create_address(addr, nickname)
+        value = await self.addr_db.read_address_raw(nickname)
+        self.assertEqual(value, encode_entry(addr))
+        self.assertEqual(len(self.addr_db), 1)
+        value = await self.addr_db.read_address(nickname)
+        self.assertEqual(type(value), LazyAddressEntry)
+
+        # With a window smaller than the entry, it is admitted on read
+        db = TieredAddressBookDB(self.addr_db.db, max_bytes=100 * 1024)
+        await db.read_address(nickname)
+        value = await db.read_address(nickname)
+        self.assertEqual(type(value), AddressEntry)
+        self.assertEqual(value.to_api_dm(), addr.to_api_dm())
+        self.assertEqual((db.hits, db.misses), (1, 1))
+
+
+class SlowScanInMemoryAddressBookDB(InMemoryAddressBookDB):
+    # Other tasks run between reading each entry and yielding it
+    async def read_all_addresses(self):
+        async for nickname, addr in super().read_all_addresses():
+            await asyncio.sleep(0)
+            yield nickname, addr
+
+
+class SearchIndexedInMemoryAddressBookDBTest(
+    AbstractAddressBookDBTestCase,
+    asynctest.TestCase
+):
+    def make_addr_db(self) -> AbstractAddressBookDB:
+        self.mem_db = SlowScanInMemoryAddressBookDB()
+        self.search_db = SearchIndexedAddressBookDB(self.mem_db)
+        return self.search_db
+
+    def addr_count(self) -> int:
+        return len(self.mem_db.db)
+
+    async def test_index_build(self):
+        namo = self.address_data['namo']
+        raga = self.address_data['raga']
+        for i in range(3):
+            await self.search_db.create_address(namo, 'namo-{}'.format(i))
+
+        # Writes made while the index is built are not undone by the scan
+        search = asyncio.ensure_future(
+            self.search_db.search_nicknames('modi', 10)
+        )
+        # The search starts the build, which then reads the first entry
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        await self.search_db.delete_address('namo-0')
+        await self.search_db.update_address('namo-1', raga)
+        self.assertEqual(await search, ['namo-2'])
+        self.assertEqual(
+            await self.search_db.search_nicknames('rahul', 10), ['namo-1']
+        )
+
+        # Writes that bypass the layer are not seen
+        await self.mem_db.delete_address('namo-2')
+        self.assertEqual(
+            await self.search_db.search_nicknames('modi', 10), ['namo-2']
+        )
+
+
+class SearchIndexedFilesystemAddressBookDBTest(FilesystemAddressBookDBTest):
+    def make_addr_db(self) -> AbstractAddressBookDB:
+        return SearchIndexedAddressBookDB(super().make_addr_db())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,11 +1,14 @@
 # Copyright (c) 2020. All rights reserved.
 
+import json
 import unittest
 
 from addrservice.datamodel import (
-    AddressType, Address, Phone, Email, AddressEntry
+    AddressType, Address, Phone, Email, AddressEntry, LazyAddressEntry
 )
 
+from data import address_data_suite
+
 
 class DataModelTest(unittest.TestCase):
     def test_data_model(self) -> None:
@@ -230,6 +233,107 @@ class DataModelTest(unittest.TestCase):
         with self.assertRaises(ValueError):
             a.full_name = None  # type: ignore
 
+    def test_setters_and_slots(self) -> None:
+        address = Address(
+            kind=AddressType.home,
+            street_name='Microservices Ave',
+            pincode=560001,
+            country='India'
+        )
+        self.assertEqual(
+            address.to_api_dm(),
+            {
+                'kind': 'home',
+                'street_name': 'Microservices Ave',
+                'pincode': 560001,
+                'country': 'India',
+            }
+        )
+        # These two setters used to assign to a stray attribute
+        address.city = 'Bangalore'
+        self.assertEqual(address.city, 'Bangalore')
+        self.assertEqual(address.to_api_dm()['city'], 'Bangalore')
+
+        phone = Phone(
+            kind=AddressType.home,
+            country_code=91,
+            local_number=12345678
+        )
+        self.assertNotIn('area_code', phone.to_api_dm())
+        phone.area_code = 80
+        self.assertEqual(phone.area_code, 80)
+        self.assertEqual(phone.to_api_dm()['area_code'], 80)
+
+        for obj in [address, phone, AddressEntry(full_name='Data Model')]:
+            with self.assertRaises(AttributeError):
+                obj.nickname = 'dm'  # type: ignore
+
+    def test_lazy_entry(self) -> None:
+        for vars in address_data_suite().values():
+            eager = AddressEntry.from_api_dm(vars).to_api_dm()
+
+            # Nothing decoded or modified: the mapping itself
+            lazy = LazyAddressEntry.from_api_dm(eager)
+            self.assertEqual(lazy.full_name, eager['full_name'])
+            with self.assertRaises(AttributeError):
+                lazy._addresses  # type: ignore
+            self.assertIs(lazy.to_api_dm(), eager)
+
+            # Decoded lists are encoded again, as they may have changed
+            lazy = LazyAddressEntry.from_api_dm(eager)
+            self.assertEqual(
+                [x.to_api_dm() for x in lazy.emails], eager['emails']
+            )
+            self.assertIsNot(lazy.to_api_dm(), eager)
+            self.assertEqual(lazy.to_api_dm(), eager)
+            if lazy.addresses:
+                lazy.addresses[0].city = 'Elsewhere'
+                self.assertEqual(
+                    lazy.to_api_dm()['addresses'][0]['city'], 'Elsewhere'
+                )
+
+            lazy = LazyAddressEntry.from_api_dm(eager)
+            lazy.full_name = 'Someone Else'
+            self.assertEqual(
+                lazy.to_api_dm(), dict(eager, full_name='Someone Else')
+            )
+            lazy.phone_numbers = []
+            self.assertEqual(lazy.to_api_dm()['phone_numbers'], [])
+
+            # From JSON: parsed on first access, passed through unchanged
+            data = json.dumps(eager).encode('utf-8')
+            lazy = LazyAddressEntry.from_json(data)
+            with self.assertRaises(AttributeError):
+                lazy._vars  # type: ignore
+            self.assertIs(lazy.to_json(), data)
+            self.assertEqual(lazy.full_name, eager['full_name'])
+            self.assertEqual(lazy.to_api_dm(), eager)
+            self.assertIs(lazy.to_json(), data)
+
+            lazy = LazyAddressEntry.from_json(data)
+            lazy.full_name = 'Someone Else'
+            self.assertEqual(
+                json.loads(lazy.to_json()),
+                dict(eager, full_name='Someone Else')
+            )
+            lazy = LazyAddressEntry.from_json(data)
+            self.assertEqual(len(lazy.emails), len(eager['emails']))
+            self.assertIsNot(lazy.to_json(), data)
+            self.assertEqual(json.loads(lazy.to_json()), eager)
+
+        # Lists missing from the mapping are empty
+        lazy = LazyAddressEntry({'full_name': 'abc'})
+        self.assertEqual(lazy.fax_numbers, [])
+        self.assertEqual(
+            lazy.to_api_dm(),
+            AddressEntry(full_name='abc').to_api_dm()
+        )
+
+        with self.assertRaises(ValueError):
+            LazyAddressEntry({'full_name': ''})
+        with self.assertRaises(AttributeError):
+            lazy.nickname = 'dm'  # type: ignore
+
 
 if __name__ == '__main__':
     unittest.main()
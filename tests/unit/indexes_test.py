@@ -0,0 +1,150 @@
+# Copyright (c) 2020. All rights reserved.
+
+import random
+import unittest
+
+from addrservice.database.indexes import (
+    SearchIndex, SecondaryIndex, SortedKeyIndex
+)
+from addrservice.datamodel import AddressEntry
+
+from data import address_data_suite
+
+
+class SmallBucketSortedKeyIndex(SortedKeyIndex):
+    BUCKET_SIZE = 4
+
+
+class SortedKeyIndexTest(unittest.TestCase):
+    def test_sorted_key_index(self) -> None:
+        keys = ['k{:03d}'.format(i) for i in range(100)]
+        shuffled = list(keys)
+        random.shuffle(shuffled)
+
+        index = SmallBucketSortedKeyIndex(shuffled[:50])
+        for k in shuffled[50:]:
+            index.add(k)
+        index.add(keys[0])  # duplicate is ignored
+
+        self.assertEqual(len(index), 100)
+        self.assertEqual(list(index), keys)
+        self.assertIn('k042', index)
+        self.assertNotIn('zzz', index)
+        self.assertNotIn(42, index)
+
+        # Pages
+        self.assertEqual(index.page(3), keys[:3])
+        self.assertEqual(index.page(5, 'k009'), keys[10:15])
+        self.assertEqual(index.page(5, 'k0095'), keys[10:15])
+        self.assertEqual(index.page(5, 'k097'), keys[98:])
+        self.assertEqual(index.page(5, 'k099'), [])
+        self.assertEqual(index.page(200, ''), keys)
+
+        # Ranges
+        self.assertEqual(list(index.between('k009', 'k014')), keys[10:15])
+        self.assertEqual(list(index.between('k0095', 'k0145')), keys[10:15])
+        self.assertEqual(list(index.between(None, 'k002')), keys[:3])
+        self.assertEqual(list(index.between('k096')), keys[97:])
+        self.assertEqual(list(index.between('k050', 'k050')), [])
+        self.assertEqual(list(index.between()), keys)
+
+        # Prefixes
+        self.assertEqual(list(index.prefixed('k01')), keys[10:20])
+        self.assertEqual(list(index.prefixed('k099')), ['k099'])
+        self.assertEqual(list(index.prefixed('k1')), [])
+        self.assertEqual(list(index.prefixed('')), keys)
+
+        # Remove every other key
+        for k in keys[::2]:
+            index.discard(k)
+        index.discard('does not exist')
+        index.discard('zzz')
+
+        self.assertEqual(len(index), 50)
+        self.assertEqual(list(index), keys[1::2])
+        self.assertEqual(index.page(2, 'k010'), ['k011', 'k013'])
+
+        for k in keys:
+            index.discard(k)
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.page(10), [])
+        self.assertNotIn('k001', index)
+
+
+class SecondaryIndexTest(unittest.TestCase):
+    def test_secondary_index(self) -> None:
+        address_data = address_data_suite()
+        namo = AddressEntry.from_api_dm(address_data['namo'])
+        raga = AddressEntry.from_api_dm(address_data['raga'])
+        index = SecondaryIndex()
+        index.put('namo', namo)
+        index.put('raga', raga)
+        self.assertEqual(len(index), 2)
+
+        self.assertEqual(index.find({'city': 'new delhi'}), {'namo', 'raga'})
+        self.assertEqual(index.find({'city': ' Varanasi '}), {'namo'})
+        self.assertEqual(index.find({'pincode': '110 011'}), {'namo', 'raga'})
+        self.assertEqual(
+            index.find({'email': 'Office@RahulGandhi.in'}), {'raga'}
+        )
+        self.assertEqual(index.find({'phone': '+91 11 2379-5161'}), {'raga'})
+        self.assertEqual(
+            index.find({'city': 'New Delhi', 'pincode': 221005}), {'namo'}
+        )
+        self.assertEqual(
+            index.find({'city': 'Varanasi', 'email': 'nobody@example.com'}),
+            set()
+        )
+
+        # Replaced entries are reindexed, deleted ones dropped
+        index.put('raga', namo)
+        self.assertEqual(index.find({'city': 'Varanasi'}), {'namo', 'raga'})
+        self.assertEqual(index.find({'email': 'office@rahulgandhi.in'}), set())
+        index.discard('namo')
+        index.discard('nobody')
+        self.assertEqual(index.find({'city': 'Varanasi'}), {'raga'})
+        self.assertNotIn('namo', index)
+
+        with self.assertRaises(ValueError):
+            index.find({'full_name': 'Rahul Gandhi'})
+        with self.assertRaises(ValueError):
+            index.find({})
+
+
+class SearchIndexTest(unittest.TestCase):
+    def test_search_index(self) -> None:
+        address_data = address_data_suite()
+        namo = AddressEntry.from_api_dm(address_data['namo'])
+        raga = AddressEntry.from_api_dm(address_data['raga'])
+        index = SearchIndex()
+        index.put('namo', namo)
+        index.put('raga', raga)
+        self.assertEqual(len(index), 2)
+
+        # Name words rank above address words, whole words above prefixes,
+        # then nicknames break ties
+        self.assertEqual(index.search('ra', 10), ['raga', 'namo'])
+        self.assertEqual(index.search('Rd', 10), ['namo', 'raga'])
+        self.assertEqual(index.search('ra rd', 10), ['raga', 'namo'])
+        self.assertEqual(index.search('rahul', 10), ['raga'])
+        self.assertEqual(index.search('race course', 10), ['namo'])
+        self.assertEqual(index.search('gandhi lane', 10), ['raga'])
+        self.assertEqual(index.search('gandhi south', 10), [])
+        self.assertEqual(index.search('ra', 1), ['raga'])
+        self.assertEqual(index.search(' -- ', 10), [])
+
+        # Replaced entries are reindexed, deleted ones dropped
+        index.put('raga', namo)
+        self.assertEqual(index.search('rahul', 10), [])
+        self.assertEqual(index.search('modi', 10), ['namo', 'raga'])
+        index.discard('namo')
+        index.discard('nobody')
+        self.assertEqual(index.search('modi', 10), ['raga'])
+        self.assertNotIn('namo', index)
+        index.discard('raga')
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.search('modi', 10), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
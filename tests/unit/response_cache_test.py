@@ -0,0 +1,49 @@
+# Copyright (c) 2020. All rights reserved.
+
+import gzip
+import unittest
+
+from addrservice.utils.response_cache import GZIP_MIN_LENGTH, ResponseCache
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def test_response_cache(self) -> None:
+        cache = ResponseCache(max_entries=2, compress=True)
+
+        small = cache.make('v1', b'{}')
+        self.assertIsNone(small.gzip_body)
+        big_body = b'[' + b'1, ' * GZIP_MIN_LENGTH + b'1]'
+        big = cache.make('v1', big_body)
+        self.assertEqual(gzip.decompress(big.gzip_body or b''), big_body)
+
+        cache.put('a', small)
+        cache.put('b', big)
+        self.assertIs(cache.get('a', 'v1'), small)
+        self.assertIsNone(cache.get('a', 'v2'))  # other version
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # Least recently used is evicted
+        cache.put('c', small)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b', 'v1'))
+        self.assertIs(cache.get('c', 'v1'), small)
+
+        cache.invalidate('c')
+        cache.invalidate('does not exist')
+        self.assertIsNone(cache.get('c', 'v1'))
+
+    def test_disabled_response_cache(self) -> None:
+        cache = ResponseCache(compress=True)
+        big_body = b'x' * GZIP_MIN_LENGTH
+        response = cache.make('v1', big_body)
+        self.assertIsNone(response.gzip_body)
+        cache.put('a', response)
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(cache.get('a', 'v1'))
+
+        with self.assertRaises(ValueError):
+            ResponseCache(max_entries=-1)
+
+
+if __name__ == '__main__':
+    unittest.main()
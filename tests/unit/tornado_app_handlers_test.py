@@ -12,7 +12,7 @@ from tornado.ioloop import IOLoop
 import tornado.testing
 
 from addrservice import LOGGER_NAME
-from addrservice.tornado.app import make_addrservice_app
+from addrservice.tornado.app import BaseRequestHandler, make_addrservice_app
 
 from data import address_data_suite
 
@@ -24,6 +24,10 @@ service:
 addr-db:
   memory: null
 
+response-cache:
+  max-entries: 16
+  gzip: true
+
 logging:
   version: 1
   root:
@@ -56,6 +60,7 @@ class AddressServiceTornadoAppTestSetup(tornado.testing.AsyncHTTPTestCase):
 
         addr_service.start()
         atexit.register(lambda: addr_service.stop())
+        self.addr_service = addr_service
 
         return app
 
@@ -78,6 +83,12 @@ class AddressServiceTornadoAppUnitTests(AddressServiceTornadoAppTestSetup):
         self.assertEqual(info['code'], 404)
         self.assertEqual(info['message'], 'Unknown Endpoint')
 
+    def test_requests_in_flight(self):
+        for uri in ['/does-not-exist', '/addresses', '/addresses/nobody']:
+            self.fetch(uri, method='GET', headers=None)
+        self.fetch('/addresses', method='PATCH', body='')
+        self.assertEqual(BaseRequestHandler.in_flight, 0)
+
 
 if __name__ == '__main__':
     tornado.testing.main()